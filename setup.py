@@ -6,6 +6,9 @@ setup(
   description="Backup ZFS to the cloud",
   packages=find_packages(),
   test_suite="tests",
+  extras_require={
+    "native": ["cryptography"],
+  },
   entry_points={
     "console_scripts": [
       "zfs2cloud=zfs2cloud:main"
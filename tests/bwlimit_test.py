@@ -0,0 +1,77 @@
+import datetime
+import unittest
+from unittest.mock import MagicMock, patch
+
+from zfs2cloud.bwlimit import BandwidthGovernor, format_rate, parse_rate, parse_timetable, scheduled_rate
+
+
+class BandwidthTest(unittest.TestCase):
+  def test_parse_rate(self):
+    self.assertEqual(parse_rate("2.5M"), int(2.5 * 1024 ** 2))
+    self.assertEqual(parse_rate("512"), 512 * 1024)
+    self.assertEqual(parse_rate("1g"), 1024 ** 3)
+    self.assertIsNone(parse_rate("off"))
+    self.assertEqual(format_rate(3 * 1024 ** 2), "3072K")
+
+    with self.assertRaises(ValueError):
+      parse_rate("20Mbit")
+
+  def test_timetable(self):
+    timetable = parse_timetable("07:00,2.5M 00:00,off 19:30,10M")
+    self.assertEqual(timetable, [(0, None), (420, int(2.5 * 1024 ** 2)), (1170, 10 * 1024 ** 2)])
+
+    at = lambda hour, minute: datetime.datetime(2020, 5, 20, hour, minute)
+    self.assertIsNone(scheduled_rate(timetable, at(6, 59)))
+    self.assertEqual(scheduled_rate(timetable, at(7, 0)), int(2.5 * 1024 ** 2))
+    self.assertEqual(scheduled_rate(timetable, at(23, 0)), 10 * 1024 ** 2)
+
+    # Before the first entry, the last one of the day before applies.
+    self.assertEqual(scheduled_rate(parse_timetable("08:00,1M 20:00,off"), at(3, 0)), None)
+    self.assertEqual(parse_timetable("4M"), [(0, 4 * 1024 ** 2)])
+
+    with self.assertRaises(ValueError):
+      parse_timetable("Mon-07:00,2M")
+
+
+class BandwidthGovernorTest(unittest.TestCase):
+  def setUp(self):
+    self.client = MagicMock()
+    self.client.call.side_effect = lambda method, **params: {"speed": 40 * 1024 ** 2} if method == "core/stats" else {}
+
+  def rates(self):
+    return [params["rate"] for (method,), params in self.client.call.call_args_list if method == "core/bwlimit"]
+
+  def test_follows_the_timetable(self):
+    governor = BandwidthGovernor(parse_timetable("00:00,off 07:00,2M"), interval=0)
+    governor.tick(self.client, now=datetime.datetime(2020, 5, 20, 6, 0))
+    governor.tick(self.client, now=datetime.datetime(2020, 5, 20, 6, 30))
+    governor.tick(self.client, now=datetime.datetime(2020, 5, 20, 7, 0))
+
+    self.assertEqual(self.rates(), ["off", "2048K"])
+
+  def test_checks_at_most_every_interval(self):
+    governor = BandwidthGovernor(parse_timetable("2M"), interval=3600)
+    governor.tick(self.client)
+    governor.tick(self.client)
+
+    self.assertEqual(self.rates(), ["2048K"])
+
+  @patch("zfs2cloud.bwlimit.probe_latency")
+  def test_backs_off_while_latency_is_high(self, probe_latency):
+    governor = BandwidthGovernor(None, probe="10.0.0.1:22", max_latency=0.05, min_rate=8 * 1024 ** 2, interval=0)
+    for latency in [0.01, 0.2, 0.2, 0.2, 0.04, 0.01, 0.01, 0.01]:
+      probe_latency.return_value = latency
+      governor.tick(self.client)
+
+    # From the 40M it reached without a limit, halving down to the 8M
+    # minimum, holding while the latency is just under the limit, and back.
+    self.assertEqual(self.rates(), ["off", "20480K", "10240K", "8192K", "16384K", "32768K", "off"])
+
+  @patch("zfs2cloud.bwlimit.probe_latency")
+  def test_backs_off_below_the_timetable(self, probe_latency):
+    governor = BandwidthGovernor(parse_timetable("4M"), probe="10.0.0.1:22", min_rate=1024 ** 2, interval=0)
+    for latency in [None, 0.001, 0.001]:
+      probe_latency.return_value = latency
+      governor.tick(self.client)
+
+    self.assertEqual(self.rates(), ["2048K", "4096K"])
@@ -1,8 +1,9 @@
 import os
+import subprocess
 import textwrap
 
 from .test_case import Zfs2CloudTestCase
-from zfs2cloud.command import Lock, Unlock
+from zfs2cloud.command import Command, Lock, Unlock
 from zfs2cloud.config import Config
 
 
@@ -53,3 +54,17 @@ class CommandTest(Zfs2CloudTestCase):
     cmd.run()
 
     self.assertFalse(os.path.exists(lock_path))
+
+  def test_execute_passes_arguments_without_a_shell(self):
+    cmd = Command(self.config, self.default_args())
+    result = cmd._execute(["echo", "data/a b; rm -rf $HOME"], capture=True)
+
+    self.assertEqual(result.stdout, "data/a b; rm -rf $HOME\n")
+    self.assertEqual(cmd.executed, [result])
+
+  def test_execute_kills_after_timeout(self):
+    cmd = Command(self.config, self.default_args())
+    with self.assertRaises(subprocess.TimeoutExpired):
+      cmd._execute(["sleep", "10"], timeout=0.1)
+
+    self.assertTrue(cmd.executed[0].timed_out)
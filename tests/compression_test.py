@@ -0,0 +1,48 @@
+from unittest.mock import patch
+import unittest
+
+from zfs2cloud import compression
+
+
+class CompressionTest(unittest.TestCase):
+  def test_compress_command(self):
+    self.assertIsNone(compression.compress_command("none"))
+    self.assertEqual(compression.compress_command("zstd"), "zstd -q -c -T0 -3")
+    self.assertEqual(compression.compress_command("zstd", "21"), "zstd -q -c -T0 --ultra -21")
+    self.assertEqual(compression.compress_command("lz4", "9"), "lz4 -q -c -T0 -9")
+
+  @patch("zfs2cloud.compression.lz4_version", return_value=(1, 10, 0))
+  def test_validate(self, lz4_version):
+    compression.validate("zstd", "19")
+    compression.validate("none", "100")
+    compression.validate("lz4", "")
+
+    with self.assertRaises(ValueError):
+      compression.validate("gzip", "")
+
+    with self.assertRaises(ValueError):
+      compression.validate("lz4", "13")
+
+  def test_validate_requires_multi_threaded_lz4(self):
+    for version, found in [((1, 9, 4), "1.9.4"), (None, "none")]:
+      with patch("zfs2cloud.compression.lz4_version", return_value=version):
+        with self.assertRaises(ValueError) as r:
+          compression.validate("lz4", "")
+
+      self.assertEqual(str(r.exception), "compression = lz4 requires lz4 1.10 or later to compress on all cores (found {}), use zstd otherwise".format(found))
+
+  def test_lz4_version(self):
+    with patch("subprocess.run") as run:
+      run.return_value.stdout = b"*** LZ4 command line interface 64-bits v1.10.0, by Yann Collet ***\n"
+      self.assertEqual(compression.lz4_version(), (1, 10, 0))
+
+  def test_detect(self):
+    self.assertEqual(compression.detect(["data-test@1.zfs.gpg.0000", "data-test@1.zfs.gpg.0001"]), "none")
+    self.assertEqual(compression.detect(["data-test@1.zfs.zst.gpg.0000"]), "zstd")
+    self.assertEqual(compression.detect(["data-test@1.zfs.lz4.gpg.0000", "unrelated"]), "lz4")
+
+    with self.assertRaises(ValueError):
+      compression.detect(["data-test@1.zfs.zst.gpg.0000", "data-test@1.zfs.gpg.0001"])
+
+    with self.assertRaises(ValueError):
+      compression.detect([])
@@ -1,6 +1,7 @@
 import os
 
 from .test_case import Zfs2CloudTestCase
+from zfs2cloud.config import parse_size
 
 
 class ConfigTest(Zfs2CloudTestCase):
@@ -48,3 +49,202 @@ class ConfigTest(Zfs2CloudTestCase):
         pass
 
     self.assertEqual(str(r.exception), "oldest_snapshot_days must be greater than full_every_x_days so that incremental backups based on the last full backup can take place")
+
+  def test_parse_size(self):
+    self.assertEqual(parse_size("1G"), 1024 ** 3)
+    self.assertEqual(parse_size("10MB"), 10 * 1000 ** 2)
+    self.assertEqual(parse_size("512"), 512)
+
+    with self.assertRaises(ValueError):
+      parse_size("1X")
+
+  def test_validate_spool_max_bytes(self):
+    data = """\
+    [main]
+    encryption_passphrase = 123456
+    zfs_fs                = data/test
+    intermediate_basedir  = {}
+    remote                = b2:bucket/whatever
+    rclone_conf           = ./rclone.conf
+    export_mode           = spool
+    spool_max_bytes       = 512M
+
+    [backup_sequences]
+    step01 = snapshot
+    """.format(self.intermediate_basedir)
+
+    with self.assertRaises(ValueError) as r:
+      with self.config(data):
+        pass
+
+    self.assertEqual(str(r.exception), "spool_max_bytes must be at least split_size")
+
+  def test_validate_dedup_requires_native_encryption(self):
+    data = """\
+    [main]
+    encryption_passphrase = 123456
+    zfs_fs                = data/test
+    intermediate_basedir  = {}
+    remote                = b2:bucket/whatever
+    rclone_conf           = ./rclone.conf
+    dedup                 = yes
+
+    [backup_sequences]
+    step01 = snapshot
+    """.format(self.intermediate_basedir)
+
+    with self.assertRaises(ValueError) as r:
+      with self.config(data):
+        pass
+
+    self.assertEqual(str(r.exception), "dedup requires encryption = native")
+
+  def test_validate_full_postpone_max_days(self):
+    data = """\
+    [main]
+    encryption_passphrase    = 123456
+    zfs_fs                   = data/test
+    intermediate_basedir     = {}
+    remote                   = b2:bucket/whatever
+    rclone_conf              = ./rclone.conf
+    oldest_snapshot_days     = 45
+    full_every_x_days        = 30
+    full_postpone_size_ratio = 0.1
+    full_postpone_max_days   = 15
+
+    [backup_sequences]
+    step01 = snapshot
+    """.format(self.intermediate_basedir)
+
+    with self.assertRaises(ValueError) as r:
+      with self.config(data):
+        pass
+
+    self.assertEqual(str(r.exception), "full_every_x_days + full_postpone_max_days must be less than oldest_snapshot_days so that a postponed full backup is not pruned")
+
+  def test_validate_incremental_strategy(self):
+    data = """\
+    [main]
+    encryption_passphrase = 123456
+    zfs_fs                = data/test
+    intermediate_basedir  = {}
+    remote                = b2:bucket/whatever
+    rclone_conf           = ./rclone.conf
+    incremental_strategy  = tiered
+    differential_every_x_days = 30
+
+    [backup_sequences]
+    step01 = snapshot
+    """.format(self.intermediate_basedir)
+
+    with self.assertRaises(ValueError) as r:
+      with self.config(data):
+        pass
+
+    self.assertEqual(str(r.exception), "differential_every_x_days must be between 0 and full_every_x_days")
+
+  def test_validate_hook_timeout(self):
+    data = """\
+    [main]
+    encryption_passphrase = 123456
+    zfs_fs                = data/test
+    intermediate_basedir  = {}
+    remote                = b2:bucket/whatever
+    rclone_conf           = ./rclone.conf
+    hook_timeout          = 0
+
+    [backup_sequences]
+    step01 = snapshot
+    """.format(self.intermediate_basedir)
+
+    with self.assertRaises(ValueError) as r:
+      with self.config(data):
+        pass
+
+    self.assertEqual(str(r.exception), "hook_timeout must be greater than 0")
+
+  def test_validate_dataset_folders(self):
+    data = """\
+    [main]
+    encryption_passphrase = 123456
+    zfs_fs                = data/a/b-c data/a-b/c
+    intermediate_basedir  = {}
+    remote                = b2:bucket/whatever
+    rclone_conf           = ./rclone.conf
+
+    [backup_sequences]
+    step01 = snapshot
+    """.format(self.intermediate_basedir)
+
+    with self.assertRaises(ValueError) as r:
+      with self.config(data):
+        pass
+
+    self.assertEqual(str(r.exception), "data/a/b-c and data/a-b/c would both be backed up to the folder data-a-b-c, rename one of them")
+
+  def test_validate_rclone_backend(self):
+    data = """\
+    [main]
+    encryption_passphrase = 123456
+    zfs_fs                = data/test
+    intermediate_basedir  = {}
+    remote                = b2:bucket/whatever
+    rclone_conf           = ./rclone.conf
+    rclone_backend        = daemon
+
+    [backup_sequences]
+    step01 = snapshot
+    """.format(self.intermediate_basedir)
+
+    with self.assertRaises(ValueError) as r:
+      with self.config(data):
+        pass
+
+    self.assertEqual(str(r.exception), "rclone_backend = daemon is not valid")
+
+  def test_validate_upload_shards(self):
+    data = """\
+    [main]
+    mode                  = file
+    zfs_fs                = data/test
+    intermediate_basedir  = {}
+    remote                = b2:bucket/whatever
+    rclone_conf           = ./rclone.conf
+    rclone_backend        = rcd
+    upload_shards         = 4
+
+    [backup_sequences]
+    step01 = snapshot
+    """.format(self.intermediate_basedir)
+
+    with self.assertRaises(ValueError) as r:
+      with self.config(data):
+        pass
+
+    self.assertEqual(str(r.exception), "upload_shards requires rclone_backend = cli")
+
+  def test_validate_bwlimit(self):
+    data = """\
+    [main]
+    encryption_passphrase = 123456
+    zfs_fs                = data/test
+    intermediate_basedir  = {}
+    remote                = b2:bucket/whatever
+    rclone_conf           = ./rclone.conf
+    rclone_bwlimit        = 00:00,off 7:00,20M
+
+    [backup_sequences]
+    step01 = snapshot
+    """.format(self.intermediate_basedir)
+
+    with self.assertRaises(ValueError) as r:
+      with self.config(data):
+        pass
+
+    self.assertEqual(str(r.exception), "invalid bandwidth timetable entry: 7:00,20M (expected HH:MM,bandwidth)")
+
+    with self.assertRaises(ValueError) as r:
+      with self.config(data.replace("7:00,20M", "07:00,20M\n    bwlimit_probe         = 10.0.0.1:22")):
+        pass
+
+    self.assertEqual(str(r.exception), "bwlimit_probe requires rclone_backend = rcd")
@@ -0,0 +1,91 @@
+import io
+import os
+import unittest
+
+from .test_case import Zfs2CloudTestCase
+from zfs2cloud import crypto
+from zfs2cloud.pipeline import write_chunks
+
+
+@unittest.skipIf(crypto.AESGCM is None, "cryptography is not installed")
+class ChunkCipherTest(Zfs2CloudTestCase):
+  def setUp(self):
+    super().setUp()
+    self.prefix = os.path.join(self.intermediate_basedir, "data-test@1.zfs.aead.")
+    self.data = os.urandom(3000)
+
+  def encrypt(self, data, split_size=1000, segment_size=300):
+    old_segment_size = crypto.SEGMENT_SIZE
+    crypto.SEGMENT_SIZE = segment_size
+    try:
+      with crypto.ChunkCipher("123456", workers=2) as cipher:
+        return [path for path, _, _ in write_chunks(cipher.encrypt(io.BytesIO(data), split_size), self.prefix, split_size)]
+    finally:
+      crypto.SEGMENT_SIZE = old_segment_size
+
+  def decrypt(self, paths, passphrase="123456"):
+    with crypto.ChunkCipher.for_chunk(passphrase, paths[0], workers=2) as cipher:
+      return b"".join(cipher.decrypt(paths))
+
+  def test_roundtrip(self):
+    paths = self.encrypt(self.data)
+    self.assertEqual(len(paths), 3)
+    self.assertEqual(self.decrypt(paths), self.data)
+
+  def test_roundtrip_empty_and_exact_multiple(self):
+    self.assertEqual(self.decrypt(self.encrypt(b"")), b"")
+
+    paths = self.encrypt(self.data[:2000])
+    self.assertEqual(len(paths), 2)
+    self.assertEqual(self.decrypt(paths), self.data[:2000])
+
+  def test_wrong_passphrase(self):
+    paths = self.encrypt(self.data)
+    with self.assertRaises(crypto.IntegrityError):
+      self.decrypt(paths, passphrase="654321")
+
+  def test_missing_chunks(self):
+    paths = self.encrypt(self.data)
+
+    with self.assertRaises(crypto.IntegrityError) as r:
+      self.decrypt([paths[0], paths[2]])
+    self.assertIn("missing or out of order", str(r.exception))
+
+    with self.assertRaises(crypto.IntegrityError) as r:
+      self.decrypt(paths[:2])
+    self.assertIn("missing chunks after", str(r.exception))
+
+  def test_reordered_chunks(self):
+    paths = self.encrypt(self.data)
+    os.rename(paths[0], self.prefix + "tmp")
+    os.rename(paths[1], paths[0])
+    os.rename(self.prefix + "tmp", paths[1])
+
+    with self.assertRaises(crypto.IntegrityError):
+      self.decrypt(paths)
+
+  def test_tampered_chunk(self):
+    paths = self.encrypt(self.data)
+    with open(paths[1], "r+b") as f:
+      f.seek(crypto.HEADER.size + crypto.RECORD.size + 10)
+      byte = f.read(1)
+      f.seek(-1, os.SEEK_CUR)
+      f.write(bytes([byte[0] ^ 1]))
+
+    with self.assertRaises(crypto.IntegrityError) as r:
+      self.decrypt(paths)
+    self.assertIn("failed authentication", str(r.exception))
+
+  def test_chunk_from_another_backup(self):
+    paths = self.encrypt(self.data)
+    other_prefix = self.prefix
+    self.prefix = os.path.join(self.intermediate_basedir, "other.")
+    other_paths = self.encrypt(self.data)
+
+    with self.assertRaises(crypto.IntegrityError) as r:
+      self.decrypt([paths[0], other_paths[1], paths[2]])
+    self.assertIn("different backup", str(r.exception))
+
+  def test_detect(self):
+    self.assertEqual(crypto.detect(["fs@1.zfs.gpg.0000"]), "gpg")
+    self.assertEqual(crypto.detect(["fs@1.zfs.zst.aead.0000", "fs@1.zfs.zst.aead.0001"]), "native")
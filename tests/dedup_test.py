@@ -0,0 +1,112 @@
+import io
+import os
+import time
+import unittest
+
+from .sendstream_test import send_stream
+from .test_case import Zfs2CloudTestCase
+from zfs2cloud import crypto, dedup
+
+
+@unittest.skipIf(crypto.AESGCM is None, "cryptography is not installed")
+class BlockStoreTest(Zfs2CloudTestCase):
+  def setUp(self):
+    super().setUp()
+    self.index = dedup.BlockIndex(os.path.join(self.intermediate_basedir, "_dedup_index"))
+    self.blocks = [os.urandom(4096) for _ in range(8)]
+
+  def tearDown(self):
+    self.index.close()
+    super().tearDown()
+
+  def export(self, folder_name, data, uploaded_since=0):
+    folder = os.path.join(self.intermediate_basedir, folder_name)
+    os.makedirs(folder, exist_ok=True)
+    store = dedup.BlockStore(self.index, "123456", folder, os.path.join(folder, "data-test.pack."), 10000, uploaded_since)
+    reader = store.recipe(io.BytesIO(data))
+    recipe = b""
+    while True:
+      piece = reader.read(1000)
+      if not piece:
+        break
+      recipe += piece
+
+    return store, recipe
+
+  def rebuild(self, recipe):
+    return b"".join(dedup.rebuild([recipe], self.intermediate_basedir, "123456"))
+
+  def test_round_trip(self):
+    data = send_stream(self.blocks + self.blocks[:2])
+    store, recipe = self.export("1-full", data)
+
+    self.assertEqual(store.stored_bytes, 8 * 4096)
+    self.assertEqual(store.reused_bytes, 2 * 4096)
+    self.assertEqual([name for name, _, _ in store.packs], ["data-test.pack.0000", "data-test.pack.0001", "data-test.pack.0002"])
+    self.assertLess(len(recipe), 8 * 4096)
+    self.assertEqual(self.rebuild(recipe), data)
+
+  def test_reuses_blocks_of_uploaded_folders(self):
+    self.export("1-full", send_stream(self.blocks))
+    self.index.mark_uploaded("1-full", time.time())
+
+    new_block = os.urandom(4096)
+    data = send_stream(self.blocks[1:] + [new_block])
+    store, recipe = self.export("2-full", data)
+
+    self.assertEqual(store.stored_bytes, 4096)
+    self.assertEqual(store.reused_bytes, 7 * 4096)
+    self.assertEqual(self.rebuild(recipe), data)
+
+  def test_does_not_reuse_blocks_that_were_not_uploaded(self):
+    self.export("1-full", send_stream(self.blocks))
+    store, _ = self.export("2-full", send_stream(self.blocks))
+    self.assertEqual(store.reused_bytes, 0)
+
+  def test_stores_blocks_uploaded_too_long_ago_again(self):
+    self.export("1-full", send_stream(self.blocks))
+    self.index.mark_uploaded("1-full", time.time() - 40 * 86400)
+
+    data = send_stream(self.blocks)
+    store, recipe = self.export("2-full", data, uploaded_since=time.time() - 30 * 86400)
+    self.assertEqual(store.reused_bytes, 0)
+    self.assertEqual(store.stored_bytes, 8 * 4096)
+
+    # The recipe only needs the new packs.
+    for fn in os.listdir(os.path.join(self.intermediate_basedir, "1-full")):
+      os.remove(os.path.join(self.intermediate_basedir, "1-full", fn))
+
+    self.assertEqual(self.rebuild(recipe), data)
+
+    # Later exports refer to the blocks stored again.
+    self.index.mark_uploaded("2-full", time.time())
+    store, _ = self.export("3", data, uploaded_since=time.time() - 30 * 86400)
+    self.assertEqual(store.reused_bytes, 8 * 4096)
+
+  def test_rebuild_detects_tampered_packs(self):
+    _, recipe = self.export("1-full", send_stream(self.blocks))
+    with open(os.path.join(self.intermediate_basedir, "1-full", "data-test.pack.0001"), "r+b") as f:
+      f.seek(100)
+      f.write(b"tampered")
+
+    with self.assertRaises(crypto.IntegrityError) as r:
+      self.rebuild(recipe)
+
+    self.assertIn("1-full/data-test.pack.0001 failed authentication", str(r.exception))
+
+  def test_rebuild_fails_on_missing_packs(self):
+    self.export("1-full", send_stream(self.blocks))
+    self.index.mark_uploaded("1-full", time.time())
+    _, recipe = self.export("2-full", send_stream(self.blocks))
+    os.remove(os.path.join(self.intermediate_basedir, "1-full", "data-test.pack.0000"))
+
+    with self.assertRaises(ValueError) as r:
+      self.rebuild(recipe)
+
+    self.assertIn("is needed by this backup but does not exist", str(r.exception))
+
+  def test_passes_through_streams_it_cannot_parse(self):
+    data = os.urandom(5000)
+    store, recipe = self.export("1-full", data)
+    self.assertEqual(store.packs, [])
+    self.assertEqual(self.rebuild(recipe), data)
@@ -0,0 +1,41 @@
+import subprocess
+import time
+import unittest
+
+from zfs2cloud import execution
+
+
+class RunAllTest(unittest.TestCase):
+  def test_runs_commands_at_the_same_time(self):
+    started = time.monotonic()
+    results = execution.run_all([["sh", "-c", "sleep 0.5; echo {}".format(i)] for i in range(4)], capture=True)
+
+    self.assertLess(time.monotonic() - started, 1.5)
+    self.assertEqual([result.stdout for result in results], [b"0\n", b"1\n", b"2\n", b"3\n"])
+    for result in results:
+      self.assertEqual(result.returncode, 0)
+      self.assertGreaterEqual(result.wall_seconds, 0.5)
+
+  def test_kills_commands_after_timeout(self):
+    started = time.monotonic()
+    slow, fast = execution.run_all([["sleep", "10"], ["true"]], timeout=0.5, check=False)
+
+    self.assertLess(time.monotonic() - started, 5)
+    self.assertTrue(slow.timed_out)
+    self.assertNotEqual(slow.returncode, 0)
+    self.assertEqual((fast.timed_out, fast.returncode), (False, 0))
+
+    with self.assertRaises(subprocess.TimeoutExpired):
+      slow.check()
+
+  def test_raises_once_every_command_is_done(self):
+    with self.assertRaises(subprocess.CalledProcessError) as r:
+      execution.run_all([["sh", "-c", "exit 3"], ["true"]])
+
+    self.assertEqual(r.exception.returncode, 3)
+    self.assertEqual(r.exception.cmd, ["sh", "-c", "exit 3"])
+
+  def test_captures_stderr_with_stdout(self):
+    result, = execution.run_all([["sh", "-c", "echo out; echo err >&2"]], capture=True, stderr=subprocess.STDOUT)
+    self.assertEqual(result.stdout, b"out\nerr\n")
+
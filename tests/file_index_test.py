@@ -0,0 +1,68 @@
+from unittest.mock import patch
+import hashlib
+import os
+
+from .test_case import Zfs2CloudTestCase
+from zfs2cloud import file_index
+from zfs2cloud.file_index import FileIndex
+
+
+class FileIndexTest(Zfs2CloudTestCase):
+  def setUp(self):
+    super().setUp()
+    self.root = os.path.join(self.intermediate_basedir, "mnt")
+    os.makedirs(os.path.join(self.root, "photos"))
+    self.write("a.txt", b"a")
+    self.write("photos/b.jpg", b"b")
+    os.symlink("a.txt", os.path.join(self.root, "link"))
+
+    self.index = FileIndex(os.path.join(self.intermediate_basedir, "_file_index"), "sha1")
+    self.addCleanup(self.index.close)
+
+  def write(self, path, data):
+    with open(os.path.join(self.root, path), "wb") as f:
+      f.write(data)
+
+  def test_hashes_regular_files(self):
+    self.assertEqual(self.index.update(self.root), 2)
+    self.assertEqual(self.index.files(), ["a.txt", "photos/b.jpg"])
+    self.assertEqual(self.index.pending(), ["a.txt", "photos/b.jpg"])
+
+    self.index.mark_uploaded(self.index.pending())
+    self.assertEqual(self.index.uploaded(), {"a.txt": hashlib.sha1(b"a").hexdigest(), "photos/b.jpg": hashlib.sha1(b"b").hexdigest()})
+    self.assertEqual(self.index.pending(), [])
+
+  def test_rehashes_only_changed_files(self):
+    self.index.update(self.root)
+    self.index.mark_uploaded(self.index.pending())
+
+    self.write("a.txt", b"changed")
+    with patch.object(file_index, "hash_file", wraps=file_index.hash_file) as hash_file:
+      self.assertEqual(self.index.update(self.root), 1)
+
+    hash_file.assert_called_once_with(os.path.join(self.root, "a.txt"), "sha1")
+    self.assertEqual(self.index.pending(), ["a.txt"])
+
+  def test_removed_files_wait_for_their_deletion(self):
+    self.index.update(self.root)
+    self.index.mark_uploaded(["a.txt"])
+
+    os.remove(os.path.join(self.root, "a.txt"))
+    os.remove(os.path.join(self.root, "photos/b.jpg"))
+    self.index.update(self.root, ["a.txt", "photos/b.jpg"])
+
+    self.assertEqual(self.index.files(), [])
+    self.assertEqual(self.index.removed(), ["a.txt"])
+
+    self.index.mark_deleted(["a.txt"])
+    self.assertEqual(self.index.removed(), [])
+    self.assertFalse(self.index.has_uploads())
+
+  def test_another_hash_type_starts_over(self):
+    self.index.update(self.root)
+    self.index.mark_uploaded(self.index.pending())
+    self.index.close()
+
+    self.index = FileIndex(os.path.join(self.intermediate_basedir, "_file_index"), "md5")
+    self.assertFalse(self.index.has_uploads())
+    self.assertEqual(self.index.update(self.root), 2)
@@ -0,0 +1,379 @@
+from unittest.mock import patch
+import datetime
+import hashlib
+import json
+import os
+import shlex
+import textwrap
+
+from .test_case import Zfs2CloudTestCase
+
+from zfs2cloud.config import Config
+from zfs2cloud.file_index import FileIndex
+from zfs2cloud.file_mode import MountSnapshot, RestoreFile, UploadSnapshotFilesToRemote, VerifySnapshotFiles
+
+
+SNAPSHOTS = [
+  ("data/test@20200520120805", datetime.datetime(2020, 5, 20, 12, 8, 5)),
+  ("data/test@20200517121005", datetime.datetime(2020, 5, 17, 12, 10, 5)),
+]
+
+
+class UploadSnapshotFilesTest(Zfs2CloudTestCase):
+  def setUp(self):
+    super().setUp()
+    self.config = self.file_mode_config("")
+    self.mount_path = os.path.join(self.intermediate_basedir, "20200520120805-full")
+
+  def file_mode_config(self, options):
+    config_data = """\
+    [main]
+    mode                  = file
+    zfs_fs                = data/test
+    intermediate_basedir  = {}
+    remote                = b2:bucket/whatever
+    rclone_conf           = ./rclone.conf
+    {}
+
+    [backup_sequences]
+    step01 = snapshot
+    """.format(self.intermediate_basedir, options)
+
+    path = os.path.join(self.config_dir, "config.ini")
+    with open(path, "w") as f:
+      f.write(textwrap.dedent(config_data))
+
+    return Config(path)
+
+  def set_last_file_upload(self, snapshot):
+    with open(os.path.join(self.intermediate_basedir, "_last_file_upload"), "w") as f:
+      json.dump([snapshot, "2020-05-17 12:10:05"], f)
+
+  def last_file_upload(self):
+    with open(os.path.join(self.intermediate_basedir, "_last_file_upload")) as f:
+      return json.load(f)[0]
+
+  def mock_zfs(self, run_sync, diff, mountpoint="/data/test"):
+    """Answers zfs get and zfs diff, and records the commands run with the files_from they were given."""
+    executed = []
+
+    def run(argv, **kwargs):
+      cmd = shlex.join(argv)
+      files_from = os.path.join(self.intermediate_basedir, "_files_from")
+      if "--files-from" in cmd:
+        with open(files_from) as f:
+          executed.append((cmd, f.read().splitlines()))
+      else:
+        executed.append((cmd, None))
+
+      stdout = None
+      if cmd.startswith("zfs get"):
+        stdout = mountpoint.encode("utf-8") + b"\n"
+      elif cmd.startswith("zfs diff"):
+        stdout = diff
+
+      return self.command_result(argv, stdout=stdout)
+
+    run_sync.side_effect = run
+    return executed
+
+  def upload(self, discover_snapshots):
+    discover_snapshots.return_value = SNAPSHOTS
+    UploadSnapshotFilesToRemote(self.config, self.default_args()).run()
+
+  @patch.object(UploadSnapshotFilesToRemote, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_first_upload_syncs_everything(self, run_sync, discover_snapshots):
+    executed = self.mock_zfs(run_sync, b"")
+    self.upload(discover_snapshots)
+
+    self.assertEqual([cmd for cmd, _ in executed], [
+      "zfs get -H -o value mountpoint data/test",
+      "rclone sync -v --stats=60s {}/ b2:bucket/whatever".format(self.mount_path),
+      "rclone touch b2:bucket/whatever/__zfs2cloud_last_updated__",
+    ])
+    self.assertEqual(self.last_file_upload(), "data/test@20200520120805")
+
+  @patch.object(UploadSnapshotFilesToRemote, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_uploads_only_what_zfs_diff_reports(self, run_sync, discover_snapshots):
+    self.set_last_file_upload("data/test@20200517121005")
+    executed = self.mock_zfs(run_sync, b"".join([
+      b"M\t/\t/data/test/photos\n",
+      b"+\tF\t/data/test/photos/new\\0040one.jpg\n",
+      b"M\tF\t/data/test/notes.txt\n",
+      b"-\tF\t/data/test/old.txt\n",
+      b"R\tF\t/data/test/a.txt\t/data/test/photos/caf\\0303\\0251.txt\n",
+      b"+\t@\t/data/test/link\n",
+    ]))
+    self.upload(discover_snapshots)
+
+    self.assertEqual(executed, [
+      ("zfs get -H -o value mountpoint data/test", None),
+      ("zfs diff -FH data/test@20200517121005 data/test@20200520120805", None),
+      (
+        "rclone copy -v --stats=60s --files-from {0}/_files_from --no-traverse {1}/ b2:bucket/whatever".format(self.intermediate_basedir, self.mount_path),
+        ["notes.txt", "photos/café.txt", "photos/new one.jpg"],
+      ),
+      (
+        "rclone delete -v --stats=60s --files-from {}/_files_from --no-traverse b2:bucket/whatever".format(self.intermediate_basedir),
+        ["a.txt", "old.txt"],
+      ),
+      ("rclone touch b2:bucket/whatever/__zfs2cloud_last_updated__", None),
+    ])
+    self.assertFalse(os.path.exists(os.path.join(self.intermediate_basedir, "_files_from")))
+    self.assertEqual(self.last_file_upload(), "data/test@20200520120805")
+
+  @patch.object(UploadSnapshotFilesToRemote, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_renamed_directory_syncs_everything(self, run_sync, discover_snapshots):
+    self.set_last_file_upload("data/test@20200517121005")
+    executed = self.mock_zfs(run_sync, b"R\t/\t/data/test/photos\t/data/test/pictures\n")
+    self.upload(discover_snapshots)
+
+    self.assertEqual([cmd for cmd, _ in executed][2:], [
+      "rclone sync -v --stats=60s {}/ b2:bucket/whatever".format(self.mount_path),
+      "rclone touch b2:bucket/whatever/__zfs2cloud_last_updated__",
+    ])
+
+  @patch.object(UploadSnapshotFilesToRemote, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_pruned_last_upload_syncs_everything(self, run_sync, discover_snapshots):
+    self.set_last_file_upload("data/test@20200101000000")
+    executed = self.mock_zfs(run_sync, b"")
+    self.upload(discover_snapshots)
+
+    self.assertEqual([cmd for cmd, _ in executed][1], "rclone sync -v --stats=60s {}/ b2:bucket/whatever".format(self.mount_path))
+
+  @patch.object(UploadSnapshotFilesToRemote, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_dry_run_does_not_record_the_upload(self, run_sync, discover_snapshots):
+    self.set_last_file_upload("data/test@20200517121005")
+    executed = self.mock_zfs(run_sync, b"M\tF\t/data/test/notes.txt\n")
+    discover_snapshots.return_value = SNAPSHOTS
+    UploadSnapshotFilesToRemote(self.config, self.default_args(dry_run=True)).run()
+
+    self.assertEqual([cmd for cmd, _ in executed], [
+      "zfs get -H -o value mountpoint data/test",
+      "zfs diff -FH data/test@20200517121005 data/test@20200520120805",
+    ])
+    self.assertEqual(self.last_file_upload(), "data/test@20200517121005")
+
+  def write_files(self, files):
+    for path, data in files.items():
+      path = os.path.join(self.mount_path, path)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(path, "wb") as f:
+        f.write(data)
+
+  @patch.object(UploadSnapshotFilesToRemote, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_file_index_uploads_what_the_remote_lacks(self, run_sync, discover_snapshots):
+    self.config = self.file_mode_config("file_index = yes")
+    self.write_files({"a.txt": b"a", "photos/b.jpg": b"b"})
+    executed = self.mock_zfs(run_sync, b"")
+    self.upload(discover_snapshots)
+
+    self.assertEqual([cmd for cmd, _ in executed][1], "rclone sync -v --stats=60s {}/ b2:bucket/whatever".format(self.mount_path))
+
+    # The next snapshot changes a.txt, and b.jpg is touched without zfs diff
+    # noticing, so only a.txt is looked at.
+    self.write_files({"a.txt": b"changed", "photos/b.jpg": b"also changed"})
+    self.set_last_file_upload("data/test@20200517121005")
+    executed = self.mock_zfs(run_sync, b"M\tF\t/data/test/a.txt\n+\tF\t/data/test/gone.txt\n")
+    self.upload(discover_snapshots)
+
+    self.assertEqual(executed[2:], [
+      (
+        "rclone copy -v --stats=60s --files-from {0}/_files_from --no-traverse {1}/ b2:bucket/whatever".format(self.intermediate_basedir, self.mount_path),
+        ["a.txt"],
+      ),
+      ("rclone touch b2:bucket/whatever/__zfs2cloud_last_updated__", None),
+    ])
+
+    with FileIndex(self.config.file_index_file, "sha1") as index:
+      self.assertEqual(index.uploaded()["a.txt"], hashlib.sha1(b"changed").hexdigest())
+      self.assertEqual(index.pending(), [])
+
+  @patch("zfs2cloud.execution.run_sync")
+  def test_verify_compares_remote_hashes_with_the_index(self, run_sync):
+    self.config = self.file_mode_config("file_index = yes")
+    self.write_files({"a.txt": b"a", "b.txt": b"b", "c.txt": b"c"})
+    with FileIndex(self.config.file_index_file, "sha1") as index:
+      index.update(self.mount_path)
+      index.mark_uploaded(index.files())
+
+    remote = [
+      {"Path": "a.txt", "Hashes": {"sha1": hashlib.sha1(b"a").hexdigest()}},
+      {"Path": "b.txt", "Hashes": {"sha1": hashlib.sha1(b"not b").hexdigest()}},
+      {"Path": "__zfs2cloud_last_updated__", "Hashes": {"sha1": ""}},
+    ]
+    run_sync.return_value = self.command_result([], stdout=json.dumps(remote).encode("utf-8"))
+
+    with self.assertRaises(RuntimeError) as r:
+      VerifySnapshotFiles(self.config, self.default_args()).run()
+
+    self.assertEqual(str(r.exception), "1 files are missing from the remote and 1 differ: c.txt, b.txt")
+    self.assertEqual(shlex.join(run_sync.call_args[0][0]), "rclone lsjson -R --files-only --hash --hash-type sha1 b2:bucket/whatever")
+
+  def test_verify_requires_the_file_index(self):
+    with self.assertRaises(RuntimeError):
+      VerifySnapshotFiles(self.config, self.default_args()).run()
+
+  def snapdir(self):
+    """A dataset mounted at a directory whose .zfs holds the newest snapshot."""
+    mountpoint = os.path.join(self.config_dir, "mnt")
+    os.makedirs(os.path.join(mountpoint, ".zfs", "snapshot", "20200520120805"))
+    return mountpoint
+
+  @patch.object(UploadSnapshotFilesToRemote, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_reads_the_snapshot_from_the_snapdir(self, run_sync, discover_snapshots):
+    mountpoint = self.snapdir()
+    executed = self.mock_zfs(run_sync, b"", mountpoint)
+    self.upload(discover_snapshots)
+
+    self.assertEqual([cmd for cmd, _ in executed][1], "rclone sync -v --stats=60s {}/.zfs/snapshot/20200520120805/ b2:bucket/whatever".format(mountpoint))
+
+  @patch.object(MountSnapshot, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_mount_is_skipped_with_the_snapdir(self, run_sync, discover_snapshots):
+    executed = self.mock_zfs(run_sync, b"", self.snapdir())
+    discover_snapshots.return_value = SNAPSHOTS
+    MountSnapshot(self.config, self.default_args()).run()
+
+    self.assertEqual([cmd for cmd, _ in executed], ["zfs get -H -o value mountpoint data/test"])
+
+  @patch.object(MountSnapshot, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_mount_without_the_snapdir(self, run_sync, discover_snapshots):
+    executed = self.mock_zfs(run_sync, b"", "legacy")
+    discover_snapshots.return_value = SNAPSHOTS
+    MountSnapshot(self.config, self.default_args()).run()
+
+    self.assertEqual([cmd for cmd, _ in executed][1:], [
+      "mkdir -p {}".format(self.mount_path),
+      "mount -t zfs data/test@20200520120805 {}".format(self.mount_path),
+    ])
+
+  @patch.object(MountSnapshot, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_snapshot_access_mount_never_looks_at_the_snapdir(self, run_sync, discover_snapshots):
+    self.config = self.file_mode_config("snapshot_access = mount")
+    executed = self.mock_zfs(run_sync, b"", self.snapdir())
+    discover_snapshots.return_value = SNAPSHOTS
+    MountSnapshot(self.config, self.default_args()).run()
+
+    self.assertEqual([cmd for cmd, _ in executed][0], "mkdir -p {}".format(self.mount_path))
+
+  @patch.object(UploadSnapshotFilesToRemote, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_snapshot_access_snapdir_requires_it(self, run_sync, discover_snapshots):
+    self.config = self.file_mode_config("snapshot_access = snapdir")
+    self.mock_zfs(run_sync, b"", "none")
+    with self.assertRaises(RuntimeError):
+      self.upload(discover_snapshots)
+
+  @patch.object(UploadSnapshotFilesToRemote, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_packs_small_files_and_restores_one(self, run_sync, discover_snapshots):
+    self.config = self.file_mode_config("file_index = yes\n    pack_small_files = 1K\n    pack_size = 6K")
+    small = {"mail/{}".format(i): os.urandom(700) for i in range(5)}
+    self.write_files(dict(small, **{"big.bin": os.urandom(2000)}))
+
+    # A remote kept in memory: the packs as copied, and the objects rcat wrote.
+    remote = {}
+    executed = self.mock_zfs(run_sync, b"")
+    mock_run = run_sync.side_effect
+
+    def run(argv, **kwargs):
+      cmd = shlex.join(argv)
+      if cmd.startswith("rclone copy -v --stats=60s {}/_packs ".format(self.intermediate_basedir)):
+        pack_dir = os.path.join(self.intermediate_basedir, "_packs")
+        for name in os.listdir(pack_dir):
+          with open(os.path.join(pack_dir, name), "rb") as f:
+            remote["b2:bucket/whatever/__zfs2cloud_packs__/" + name] = f.read()
+      elif cmd.startswith("rclone rcat"):
+        remote[cmd.split()[-1]] = kwargs["input"]
+      elif cmd.startswith("rclone cat"):
+        args = cmd.split()
+        data = remote[args[-1]]
+        if "--offset" in args:
+          offset, count = int(args[3]), int(args[5])
+          data = data[offset:offset + count]
+
+        return self.command_result(argv, stdout=data)
+
+      return mock_run(argv, **kwargs)
+
+    run_sync.side_effect = run
+    self.upload(discover_snapshots)
+
+    index_size = len(remote["b2:bucket/whatever/__zfs2cloud_packs__/index.jsonl"])
+    self.assertEqual([cmd for cmd, _ in executed], [
+      "zfs get -H -o value mountpoint data/test",
+      "rclone copy -v --stats=60s --files-from {0}/_files_from --no-traverse {1}/ b2:bucket/whatever".format(self.intermediate_basedir, self.mount_path),
+      "rclone copy -v --stats=60s {}/_packs b2:bucket/whatever/__zfs2cloud_packs__".format(self.intermediate_basedir),
+      "rclone rcat -v --stats=60s --size {} b2:bucket/whatever/__zfs2cloud_packs__/index.jsonl".format(index_size),
+      "rclone touch b2:bucket/whatever/__zfs2cloud_last_updated__",
+    ])
+    self.assertEqual(executed[1][1], ["big.bin"])
+    packs = sorted(name.rsplit("/", 1)[1] for name in remote if name.endswith(".tar"))
+    self.assertGreater(len(packs), 1)
+    self.assertEqual(packs, ["20200520120805-{:04d}.tar".format(i) for i in range(len(packs))])
+    self.assertFalse(os.path.exists(os.path.join(self.intermediate_basedir, "_packs")))
+
+    with FileIndex(self.config.file_index_file, "sha1") as index:
+      self.assertEqual(index.pending(), [])
+      self.assertEqual(sorted(index.packs()), sorted(small))
+
+    # Only the bytes of the file are read from its pack.
+    output = os.path.join(self.config_dir, "restored")
+    RestoreFile(self.config, self.default_args(path="mail/3", output=output)).run()
+    with open(output, "rb") as f:
+      self.assertEqual(f.read(), small["mail/3"])
+
+    self.assertRegex(shlex.join(run_sync.call_args[0][0]), r"^rclone cat --offset \d+ --count 700 b2:bucket/whatever/__zfs2cloud_packs__/20200520120805-000\d\.tar$")
+
+  @patch("zfs2cloud.execution.run_sync")
+  def test_restore_file_not_in_a_pack(self, run_sync):
+    RestoreFile(self.config, self.default_args(path="photos/a b.jpg", output="/tmp/a b.jpg")).run()
+    self.assertEqual(shlex.join(run_sync.call_args[0][0]), "rclone copyto -v --stats=60s 'b2:bucket/whatever/photos/a b.jpg' '/tmp/a b.jpg'")
+
+  @patch.object(UploadSnapshotFilesToRemote, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_sharded_sync_merges_the_reports(self, run_sync, discover_snapshots):
+    self.config = self.file_mode_config("upload_shards = 2")
+    self.write_files({"a/1": b"x" * 100, "b/2": b"x" * 100, "top": b"x"})
+    filters = {}
+
+    def run(argv, **kwargs):
+      cmd = shlex.join(argv)
+      if cmd.startswith("zfs get"):
+        return self.command_result(argv, stdout=b"legacy\n")
+
+      args = argv
+      with open(args[args.index("--filter-from") + 1]) as f:
+        rules = f.read().splitlines()
+
+      filters[tuple(rules)] = cmd
+      with open(args[args.index("--combined") + 1], "w") as f:
+        f.write("+ b/2\n= top\n" if rules[0] == "- /a/**" else "! a/1\n")
+
+      if rules[0] == "+ /a/**":
+        return self.command_result(argv, returncode=1)
+
+      return self.command_result(argv)
+
+    run_sync.side_effect = run
+    with self.assertRaises(RuntimeError) as r:
+      self.upload(discover_snapshots)
+
+    self.assertEqual(str(r.exception), "shards 1 of the upload failed")
+    self.assertEqual(sorted(filters), [("+ /a/**", "- **"), ("- /a/**", "+ **")])
+    shard_dir = os.path.join(self.intermediate_basedir, "_shards")
+    self.assertEqual(filters[("- /a/**", "+ **")], "rclone sync -v --stats=60s --filter-from {0}/0.filter --combined {0}/0.combined {1}/ b2:bucket/whatever".format(shard_dir, self.mount_path))
+    self.assertFalse(os.path.exists(shard_dir))
+
+    with open(os.path.join(self.intermediate_basedir, "_upload_report")) as f:
+      self.assertEqual(f.read(), "! a/1\n+ b/2\n= top\n")
@@ -1,17 +1,47 @@
 from unittest.mock import patch, call
+import unittest.mock
 import datetime
+import hashlib
+import io
+import json
 import os
+import subprocess
 import textwrap
+import unittest
 
+from .sendstream_test import send_stream
 from .test_case import Zfs2CloudTestCase
 
+from zfs2cloud import crypto
 from zfs2cloud.intermediate import ExportIntermediate, PruneIntermediate, UploadIntermediateToRemote
 from zfs2cloud.config import Config
+from zfs2cloud.manifest import Checkpoint, Manifest
+from zfs2cloud.pipeline import ChunkSpool, split_stream, write_chunks
+
+
+def stage_calls(*commands):
+  return [
+    call(command, stdout=subprocess.PIPE, shell=True, executable="/bin/bash", **({"stdin": unittest.mock.ANY} if i > 0 else {}))
+    for i, command in enumerate(commands)
+  ]
+
+
+def patch_wait4(test):
+  """Reaps the mocked stages of a StagePipeline, which have no /proc to measure them by."""
+  rusage = unittest.mock.Mock(ru_utime=0.25, ru_stime=0.0)
+  for patcher in [
+    patch("zfs2cloud.stages.os.wait4", return_value=(1, 0, rusage)),
+    patch("zfs2cloud.stages.os.waitid"),
+    patch("zfs2cloud.stages._proc_io", return_value={}),
+  ]:
+    patcher.start()
+    test.addCleanup(patcher.stop)
 
 
 class IntermediateTest(Zfs2CloudTestCase):
   def setUp(self):
     super().setUp()
+    patch_wait4(self)
 
     config_data = """\
     [main]
@@ -39,30 +69,35 @@ class IntermediateTest(Zfs2CloudTestCase):
   # the code with a bit more confidence without resorting to full
   # integration testing, which is hard to setup (requires root).
   def incremental_subprocess_calls(self, snapshot_name, base_snapshot_name):
-    basedir = os.path.join(self.intermediate_basedir, snapshot_name.split("@")[1])
-    fileprefix = os.path.join(basedir, "{}.zfs.gpg.".format(snapshot_name.replace("/", "-")))
-    return [
-      call("mkdir -p {}".format(basedir), stdout=None, check=True, shell=True, env=None),
-      call(
-        "zfs send -i {} {} | gpg1 -c --cipher-algo AES256 --batch --passphrase 123456 | split - --bytes 1G --suffix-length=4 --numeric-suffixes {}".format(base_snapshot_name, snapshot_name, fileprefix),
-        stdout=None, check=True, shell=True, env=None
-      )
-    ]
+    return (
+      [],
+      stage_calls(
+        "zfs send -i {} {}".format(base_snapshot_name, snapshot_name),
+        "gpg1 -c --compress-algo none --cipher-algo AES256 --batch --passphrase 123456",
+      ),
+    )
 
   def full_subprocess_calls(self, snapshot_name):
-    basedir = os.path.join(self.intermediate_basedir, snapshot_name.split("@")[1] + "-full")
-    fileprefix = os.path.join(basedir, "{}.zfs.gpg.".format(snapshot_name.replace("/", "-")))
-    return [
-      call("mkdir -p {}".format(basedir), stdout=None, check=True, shell=True, env=None),
-      call(
-        "zfs send  {} | gpg1 -c --cipher-algo AES256 --batch --passphrase 123456 | split - --bytes 1G --suffix-length=4 --numeric-suffixes {}".format(snapshot_name, fileprefix),
-        stdout=None, check=True, shell=True, env=None
+    return (
+      [],
+      stage_calls(
+        "zfs send  {}".format(snapshot_name),
+        "gpg1 -c --compress-algo none --cipher-algo AES256 --batch --passphrase 123456",
       ),
-    ]
+    )
+
+  def mock_popen(self, popen, data=b"stream"):
+    # Every stage gets its own process, all of which output data.
+    def stage(*args, **kwargs):
+      proc = unittest.mock.MagicMock()
+      proc.stdout = io.BytesIO(data)
+      return proc
+
+    popen.side_effect = stage
 
   @patch.object(ExportIntermediate, "_discover_snapshots")
-  @patch("subprocess.run")
-  def test_export_intermediate_does_nothing_in_dryrun(self, subprocess_run, discover_snapshots):
+  @patch("zfs2cloud.execution.run_sync")
+  def test_export_intermediate_does_nothing_in_dryrun(self, run_sync, discover_snapshots):
     discover_snapshots.return_value = [
       ("data/test@20200515121005", datetime.datetime(2020, 5, 15, 12, 10, 5)),
     ]
@@ -70,24 +105,27 @@ class IntermediateTest(Zfs2CloudTestCase):
     cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False, dry_run=True))
     cmd.run()
 
-    subprocess_run.assert_not_called()
+    run_sync.assert_not_called()
 
   @patch.object(ExportIntermediate, "_discover_snapshots")
-  @patch("subprocess.run")
-  def test_export_intermediate_exports_full_on_initial_snapshot(self, subprocess_run, discover_snapshots):
+  @patch("zfs2cloud.execution.run_sync")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_exports_full_on_initial_snapshot(self, popen, run_sync, discover_snapshots):
     discover_snapshots.return_value = [
       ("data/test@20200515121005", datetime.datetime(2020, 5, 15, 12, 10, 5)),
     ]
 
     cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    self.mock_popen(popen)
     cmd.run()
 
-    self.assertEqual(subprocess_run.mock_calls, self.full_subprocess_calls("data/test@20200515121005"))
+    self.assertEqual((run_sync.call_args_list, popen.call_args_list), self.full_subprocess_calls("data/test@20200515121005"))
 
   @patch("zfs2cloud.intermediate.datetime")
   @patch.object(ExportIntermediate, "_discover_snapshots")
-  @patch("subprocess.run")
-  def test_export_intermediate_exports_increment_normally_and_full_if_forced_full(self, subprocess_run, discover_snapshots, datetime_mock):
+  @patch("zfs2cloud.execution.run_sync")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_exports_increment_normally_and_full_if_forced_full(self, popen, run_sync, discover_snapshots, datetime_mock):
     mocked_now = datetime.datetime(2020, 5, 20, 12, 10, 5)
     self.datetime_mock_now(datetime_mock, mocked_now)
 
@@ -100,14 +138,16 @@ class IntermediateTest(Zfs2CloudTestCase):
     self.set_last_full_backup(*discover_snapshots.return_value[-1])
 
     cmd = ExportIntermediate(self.config, self.default_args(full=True, incremental=False))
+    self.mock_popen(popen)
     cmd.run()
 
-    self.assertEqual(subprocess_run.mock_calls, self.full_subprocess_calls("data/test@20200520120805"))
+    self.assertEqual((run_sync.call_args_list, popen.call_args_list), self.full_subprocess_calls("data/test@20200520120805"))
 
   @patch("zfs2cloud.intermediate.datetime")
   @patch.object(ExportIntermediate, "_discover_snapshots")
-  @patch("subprocess.run")
-  def test_export_intermediate_exports_full_if_no_last_full_backup(self, subprocess_run, discover_snapshots, datetime_mock):
+  @patch("zfs2cloud.execution.run_sync")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_exports_full_if_no_last_full_backup(self, popen, run_sync, discover_snapshots, datetime_mock):
     mocked_now = datetime.datetime(2020, 5, 20, 12, 10, 5)
     self.datetime_mock_now(datetime_mock, mocked_now)
 
@@ -118,14 +158,16 @@ class IntermediateTest(Zfs2CloudTestCase):
     ]
 
     cmd = ExportIntermediate(self.config, self.default_args(full=True, incremental=False))
+    self.mock_popen(popen)
     cmd.run()
 
-    self.assertEqual(subprocess_run.mock_calls, self.full_subprocess_calls("data/test@20200520120805"))
+    self.assertEqual((run_sync.call_args_list, popen.call_args_list), self.full_subprocess_calls("data/test@20200520120805"))
 
   @patch("zfs2cloud.intermediate.datetime")
   @patch.object(ExportIntermediate, "_discover_snapshots")
-  @patch("subprocess.run")
-  def test_export_intermediate_exports_full_if_full_every_x_days_passed(self, subprocess_run, discover_snapshots, datetime_mock):
+  @patch("zfs2cloud.execution.run_sync")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_exports_full_if_full_every_x_days_passed(self, popen, run_sync, discover_snapshots, datetime_mock):
     mocked_now = datetime.datetime(2020, 5, 20, 12, 10, 5)
     self.datetime_mock_now(datetime_mock, mocked_now)
 
@@ -138,14 +180,16 @@ class IntermediateTest(Zfs2CloudTestCase):
     self.set_last_full_backup("data/test@{}".format(old_creation_date.strftime("%Y%m%d%H%M%S")), old_creation_date)
 
     cmd = ExportIntermediate(self.config, self.default_args(full=True, incremental=False))
+    self.mock_popen(popen)
     cmd.run()
 
-    self.assertEqual(subprocess_run.mock_calls, self.full_subprocess_calls("data/test@20200520120805"))
+    self.assertEqual((run_sync.call_args_list, popen.call_args_list), self.full_subprocess_calls("data/test@20200520120805"))
 
   @patch("zfs2cloud.intermediate.datetime")
   @patch.object(ExportIntermediate, "_discover_snapshots")
-  @patch("subprocess.run")
-  def test_export_intermediate_exports_incremental(self, subprocess_run, discover_snapshots, datetime_mock):
+  @patch("zfs2cloud.execution.run_sync")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_exports_incremental(self, popen, run_sync, discover_snapshots, datetime_mock):
     mocked_now = datetime.datetime(2020, 5, 20, 12, 10, 5)
     self.datetime_mock_now(datetime_mock, mocked_now)
 
@@ -158,14 +202,203 @@ class IntermediateTest(Zfs2CloudTestCase):
     self.set_last_full_backup(*discover_snapshots.return_value[-1])
 
     cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    self.mock_popen(popen)
+    cmd.run()
+
+    self.assertEqual((run_sync.call_args_list, popen.call_args_list), self.incremental_subprocess_calls("data/test@20200520120805", "data/test@20200515121005"))
+
+  def mock_estimates(self, run_all, incremental_size, full_size):
+    def run(commands, **kwargs):
+      results = []
+      for argv in commands:
+        size = incremental_size if "-i" in argv else full_size
+        results.append(self.command_result(argv, stdout="full\tdata/test@x\t{0}\nsize\t{0}\n".format(size).encode("utf-8")))
+
+      return results
+
+    run_all.side_effect = run
+
+  def size_policy_snapshots(self, discover_snapshots, datetime_mock, days_since_full):
+    mocked_now = datetime.datetime(2020, 5, 20, 12, 10, 5)
+    self.datetime_mock_now(datetime_mock, mocked_now)
+    last_full = mocked_now - datetime.timedelta(days=days_since_full)
+
+    discover_snapshots.return_value = [
+      ("data/test@20200520120805", datetime.datetime(2020, 5, 20, 12, 8, 5)),
+      ("data/test@{}".format(last_full.strftime("%Y%m%d%H%M%S")), last_full),
+    ]
+    self.set_last_full_backup(*discover_snapshots.return_value[-1])
+
+  @patch("zfs2cloud.intermediate.datetime")
+  @patch.object(ExportIntermediate, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_all")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_exports_full_early_if_incremental_is_large(self, popen, run_all, discover_snapshots, datetime_mock):
+    self.config.main["full_size_ratio"] = "0.5"
+    self.size_policy_snapshots(discover_snapshots, datetime_mock, 10)
+    self.mock_estimates(run_all, 600, 1000)
+
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    self.mock_popen(popen)
+    cmd.run()
+
+    run_all.assert_called_once_with(
+      [
+        ["zfs", "send", "-nvP", "-i", discover_snapshots.return_value[-1][0], "data/test@20200520120805"],
+        ["zfs", "send", "-nvP", "data/test@20200520120805"],
+      ],
+      capture=True, stderr=subprocess.STDOUT, env=None, timeout=None, check=False,
+    )
+    self.assertEqual(popen.call_args_list, self.full_subprocess_calls("data/test@20200520120805")[1])
+
+  @patch("zfs2cloud.intermediate.datetime")
+  @patch.object(ExportIntermediate, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_all")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_postpones_full_if_incremental_is_small(self, popen, run_all, discover_snapshots, datetime_mock):
+    self.config.main["full_postpone_size_ratio"] = "0.1"
+    self.config.main["full_postpone_max_days"] = "5"
+    self.size_policy_snapshots(discover_snapshots, datetime_mock, 33)
+    self.mock_estimates(run_all, 50, 1000)
+
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    self.mock_popen(popen)
+    cmd.run()
+
+    self.assertEqual(popen.call_args_list, self.incremental_subprocess_calls("data/test@20200520120805", discover_snapshots.return_value[-1][0])[1])
+
+  @patch("zfs2cloud.intermediate.datetime")
+  @patch.object(ExportIntermediate, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_all")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_postpones_full_at_most_full_postpone_max_days(self, popen, run_all, discover_snapshots, datetime_mock):
+    self.config.main["full_postpone_size_ratio"] = "0.1"
+    self.config.main["full_postpone_max_days"] = "5"
+    self.size_policy_snapshots(discover_snapshots, datetime_mock, 36)
+    self.mock_estimates(run_all, 50, 1000)
+
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    self.mock_popen(popen)
+    cmd.run()
+
+    self.assertEqual(popen.call_args_list, self.full_subprocess_calls("data/test@20200520120805")[1])
+
+  def strategy_snapshots(self, discover_snapshots, datetime_mock, strategy, last_backups):
+    self.config.main["incremental_strategy"] = strategy
+    self.datetime_mock_now(datetime_mock, datetime.datetime(2020, 5, 20, 12, 10, 5))
+    discover_snapshots.return_value = [
+      ("data/test@20200520120805", datetime.datetime(2020, 5, 20, 12, 8, 5)),
+      ("data/test@20200518121005", datetime.datetime(2020, 5, 18, 12, 10, 5)),
+      ("data/test@20200517121005", datetime.datetime(2020, 5, 17, 12, 10, 5)),
+      ("data/test@20200510121005", datetime.datetime(2020, 5, 10, 12, 10, 5)),
+    ]
+    self.set_last_full_backup(*discover_snapshots.return_value[-1])
+
+    with open(os.path.join(self.intermediate_basedir, "_last_backups"), "w") as f:
+      json.dump({level: [name, "2020-05-{} 12:10:05".format(name[-8:-6])] for level, name in last_backups.items()}, f)
+
+  def last_backups(self):
+    with open(os.path.join(self.intermediate_basedir, "_last_backups")) as f:
+      return json.load(f)
+
+  @patch("zfs2cloud.intermediate.datetime")
+  @patch.object(ExportIntermediate, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_exports_since_last_incremental(self, popen, run_sync, discover_snapshots, datetime_mock):
+    self.strategy_snapshots(discover_snapshots, datetime_mock, "since_last_incremental", {"incremental": "data/test@20200518121005"})
+
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    self.mock_popen(popen)
     cmd.run()
 
-    self.assertEqual(subprocess_run.mock_calls, self.incremental_subprocess_calls("data/test@20200520120805", "data/test@20200515121005"))
+    self.assertEqual(popen.call_args_list, self.incremental_subprocess_calls("data/test@20200520120805", "data/test@20200518121005")[1])
+    self.assertEqual(self.last_backups(), {"incremental": ["data/test@20200520120805", "2020-05-20 12:08:05"]})
 
   @patch("zfs2cloud.intermediate.datetime")
   @patch.object(ExportIntermediate, "_discover_snapshots")
-  @patch("subprocess.run")
-  def test_export_intermediate_errors_if_last_full_not_found(self, subprocess_run, discover_snapshots, datetime_mock):
+  @patch("zfs2cloud.execution.run_sync")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_never_incremental_exports_full(self, popen, run_sync, discover_snapshots, datetime_mock):
+    self.strategy_snapshots(discover_snapshots, datetime_mock, "never_incremental", {"incremental": "data/test@20200518121005"})
+
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    self.mock_popen(popen)
+    self.assertTrue(cmd.run())
+
+    self.assertEqual(popen.call_args_list, self.full_subprocess_calls("data/test@20200520120805")[1])
+    self.assertEqual(self.last_backups(), {})
+
+  @patch("zfs2cloud.intermediate.datetime")
+  @patch.object(ExportIntermediate, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_tiered_exports_differential_when_due(self, popen, run_sync, discover_snapshots, datetime_mock):
+    self.strategy_snapshots(discover_snapshots, datetime_mock, "tiered", {"incremental": "data/test@20200517121005"})
+
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    self.mock_popen(popen)
+    cmd.run()
+
+    self.assertEqual(popen.call_args_list, self.incremental_subprocess_calls("data/test@20200520120805", "data/test@20200510121005")[1])
+    self.assertEqual(self.last_backups(), {
+      "differential": ["data/test@20200520120805", "2020-05-20 12:08:05"],
+      "incremental": ["data/test@20200520120805", "2020-05-20 12:08:05"],
+    })
+
+  @patch("zfs2cloud.intermediate.datetime")
+  @patch.object(ExportIntermediate, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_tiered_exports_incremental_against_differential(self, popen, run_sync, discover_snapshots, datetime_mock):
+    self.strategy_snapshots(discover_snapshots, datetime_mock, "tiered", {
+      "differential": "data/test@20200517121005",
+      "incremental": "data/test@20200518121005",
+    })
+
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    self.mock_popen(popen)
+    cmd.run()
+
+    self.assertEqual(popen.call_args_list, self.incremental_subprocess_calls("data/test@20200520120805", "data/test@20200517121005")[1])
+    self.assertEqual(self.last_backups(), {
+      "differential": ["data/test@20200517121005", "2020-05-17 12:10:05"],
+      "incremental": ["data/test@20200520120805", "2020-05-20 12:08:05"],
+    })
+
+  @patch("zfs2cloud.intermediate.datetime")
+  @patch.object(ExportIntermediate, "_discover_bookmarks")
+  @patch.object(ExportIntermediate, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_sends_incremental_from_bookmark(self, popen, run_sync, discover_snapshots, discover_bookmarks, datetime_mock):
+    self.config.main["use_bookmarks"] = "yes"
+    self.datetime_mock_now(datetime_mock, datetime.datetime(2020, 5, 20, 12, 10, 5))
+
+    # The last full snapshot was pruned, only its bookmark is left.
+    discover_snapshots.return_value = [
+      ("data/test@20200520120805", datetime.datetime(2020, 5, 20, 12, 8, 5)),
+      ("data/test@20200517121005", datetime.datetime(2020, 5, 17, 12, 10, 5)),
+    ]
+    discover_bookmarks.return_value = [
+      ("data/test#20200515121005", datetime.datetime(2020, 5, 15, 12, 10, 5)),
+    ]
+    self.set_last_full_backup("data/test@20200515121005", datetime.datetime(2020, 5, 15, 12, 10, 5))
+
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    self.mock_popen(popen)
+    cmd.run()
+
+    self.assertEqual(popen.call_args_list, self.incremental_subprocess_calls("data/test@20200520120805", "data/test#20200515121005")[1])
+    self.assertEqual(run_sync.call_args_list, [self.execute_call("zfs bookmark data/test@20200520120805 data/test#20200520120805")])
+
+    manifest = Manifest.load(os.path.join(self.intermediate_basedir, "20200520120805"))
+    self.assertEqual(manifest.base_snapshot, "data/test@20200515121005")
+
+  @patch("zfs2cloud.intermediate.datetime")
+  @patch.object(ExportIntermediate, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_export_intermediate_errors_if_last_full_not_found(self, run_sync, discover_snapshots, datetime_mock):
     mocked_now = datetime.datetime(2020, 5, 20, 12, 10, 5)
     self.datetime_mock_now(datetime_mock, mocked_now)
 
@@ -181,7 +414,7 @@ class IntermediateTest(Zfs2CloudTestCase):
       cmd.run()
 
     self.assertEqual(str(r.exception), "last full snapshot deleted? looked for data/test@20200515121005 but couldn't find it.")
-    subprocess_run.assert_not_called()
+    run_sync.assert_not_called()
 
   @patch.object(PruneIntermediate, "_discover_snapshots")
   def test_prune_intermediate(self, discover_snapshots):
@@ -227,8 +460,8 @@ class IntermediateTest(Zfs2CloudTestCase):
     self.assertTrue(unrelated_path)
 
   @patch.object(UploadIntermediateToRemote, "_discover_snapshots")
-  @patch("subprocess.run")
-  def test_upload_intermediate_uploads_last_full_backup(self, subprocess_run, discover_snapshots):
+  @patch("zfs2cloud.execution.run_sync")
+  def test_upload_intermediate_uploads_last_full_backup(self, run_sync, discover_snapshots):
     discover_snapshots.return_value = [
       ("data/test@20200520120805", datetime.datetime(2020, 5, 20, 12, 8, 5)),
       ("data/test@20200517121005", datetime.datetime(2020, 5, 17, 12, 10, 5)),
@@ -247,17 +480,11 @@ class IntermediateTest(Zfs2CloudTestCase):
     cmd = UploadIntermediateToRemote(self.config, self.default_args(snapshot=None))
     cmd.run()
 
-    subprocess_run.assert_called_once_with(
-      "rclone sync -v --stats=60s {0}/{1} b2:bucket/whatever/{1}".format(self.intermediate_basedir, "20200520120805-full"),
-      check=True,
-      env={"RCLONE_CONFIG": os.path.join(self.config_dir, "rclone.conf")},
-      shell=True,
-      stdout=None,
-    )
+    self.assertEqual(run_sync.call_args_list, [self.execute_call("rclone sync -v --stats=60s {0}/{1} b2:bucket/whatever/{1}".format(self.intermediate_basedir, "20200520120805-full"), env=self.rclone_env())])
 
   @patch.object(UploadIntermediateToRemote, "_discover_snapshots")
-  @patch("subprocess.run")
-  def test_upload_intermediate_uploads_last_incremental_backup(self, subprocess_run, discover_snapshots):
+  @patch("zfs2cloud.execution.run_sync")
+  def test_upload_intermediate_uploads_last_incremental_backup(self, run_sync, discover_snapshots):
     discover_snapshots.return_value = [
       ("data/test@20200520120805", datetime.datetime(2020, 5, 20, 12, 8, 5)),
       ("data/test@20200517121005", datetime.datetime(2020, 5, 17, 12, 10, 5)),
@@ -274,17 +501,11 @@ class IntermediateTest(Zfs2CloudTestCase):
     cmd = UploadIntermediateToRemote(self.config, self.default_args(snapshot=None))
     cmd.run()
 
-    subprocess_run.assert_called_once_with(
-      "rclone sync -v --stats=60s {0}/{1} b2:bucket/whatever/{1}".format(self.intermediate_basedir, "20200520120805"),
-      check=True,
-      env={"RCLONE_CONFIG": os.path.join(self.config_dir, "rclone.conf")},
-      shell=True,
-      stdout=None,
-    )
+    self.assertEqual(run_sync.call_args_list, [self.execute_call("rclone sync -v --stats=60s {0}/{1} b2:bucket/whatever/{1}".format(self.intermediate_basedir, "20200520120805"), env=self.rclone_env())])
 
   @patch.object(UploadIntermediateToRemote, "_discover_snapshots")
-  @patch("subprocess.run")
-  def test_upload_intermediate_fails_if_backup_not_found_in_path(self, subprocess_run, discover_snapshots):
+  @patch("zfs2cloud.execution.run_sync")
+  def test_upload_intermediate_fails_if_backup_not_found_in_path(self, run_sync, discover_snapshots):
     discover_snapshots.return_value = [
       ("data/test@20200520120805", datetime.datetime(2020, 5, 20, 12, 8, 5)),
       ("data/test@20200517121005", datetime.datetime(2020, 5, 17, 12, 10, 5)),
@@ -296,12 +517,12 @@ class IntermediateTest(Zfs2CloudTestCase):
     with self.assertRaises(RuntimeError) as r:
       cmd.run()
 
-    subprocess_run.assert_not_called()
+    run_sync.assert_not_called()
     self.assertTrue("cannot find the snapshot intermediate or have too many candidates:" in str(r.exception))
 
   @patch.object(UploadIntermediateToRemote, "_discover_snapshots")
-  @patch("subprocess.run")
-  def test_upload_intermediate_uploads_specified_full_backup(self, subprocess_run, discover_snapshots):
+  @patch("zfs2cloud.execution.run_sync")
+  def test_upload_intermediate_uploads_specified_full_backup(self, run_sync, discover_snapshots):
     discover_snapshots.return_value = [
       ("data/test@20200520120805", datetime.datetime(2020, 5, 20, 12, 8, 5)),
       ("data/test@20200517121005", datetime.datetime(2020, 5, 17, 12, 10, 5)),
@@ -318,17 +539,11 @@ class IntermediateTest(Zfs2CloudTestCase):
     cmd = UploadIntermediateToRemote(self.config, self.default_args(snapshot="data/test@20200515121005"))
     cmd.run()
 
-    subprocess_run.assert_called_once_with(
-      "rclone sync -v --stats=60s {0}/{1} b2:bucket/whatever/{1}".format(self.intermediate_basedir, "20200515121005-full"),
-      check=True,
-      env={"RCLONE_CONFIG": os.path.join(self.config_dir, "rclone.conf")},
-      shell=True,
-      stdout=None,
-    )
+    self.assertEqual(run_sync.call_args_list, [self.execute_call("rclone sync -v --stats=60s {0}/{1} b2:bucket/whatever/{1}".format(self.intermediate_basedir, "20200515121005-full"), env=self.rclone_env())])
 
   @patch.object(UploadIntermediateToRemote, "_discover_snapshots")
-  @patch("subprocess.run")
-  def test_upload_intermediate_uploads_specified_incremental_backup(self, subprocess_run, discover_snapshots):
+  @patch("zfs2cloud.execution.run_sync")
+  def test_upload_intermediate_uploads_specified_incremental_backup(self, run_sync, discover_snapshots):
     discover_snapshots.return_value = [
       ("data/test@20200520120805", datetime.datetime(2020, 5, 20, 12, 8, 5)),
       ("data/test@20200517121005", datetime.datetime(2020, 5, 17, 12, 10, 5)),
@@ -345,10 +560,468 @@ class IntermediateTest(Zfs2CloudTestCase):
     cmd = UploadIntermediateToRemote(self.config, self.default_args(snapshot="data/test@20200515121005"))
     cmd.run()
 
-    subprocess_run.assert_called_once_with(
-      "rclone sync -v --stats=60s {0}/{1} b2:bucket/whatever/{1}".format(self.intermediate_basedir, "20200515121005"),
-      check=True,
-      env={"RCLONE_CONFIG": os.path.join(self.config_dir, "rclone.conf")},
-      shell=True,
-      stdout=None,
-    )
+    self.assertEqual(run_sync.call_args_list, [self.execute_call("rclone sync -v --stats=60s {0}/{1} b2:bucket/whatever/{1}".format(self.intermediate_basedir, "20200515121005"), env=self.rclone_env())])
+
+  @patch("zfs2cloud.execution.run_sync")
+  def test_export_spooled_moves_each_chunk_to_remote(self, run_sync):
+    self.config.main["export_mode"] = "spool"
+    self.config.main["split_size"] = "1K"
+    self.config.main["spool_max_chunks"] = "1"
+    self.config.main["upload_concurrency"] = "1"
+
+    folder = os.path.join(self.intermediate_basedir, "20200520120805")
+    os.mkdir(folder)
+    prefix = os.path.join(folder, "data-test@20200520120805.zfs.gpg.")
+
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    with patch("subprocess.Popen") as popen:
+      self.mock_popen(popen, b"a" * 2500)
+      cmd._export_spooled([("zfs send", "zfs send data/test@20200520120805"), ("gpg1", "gpg1")], folder, prefix)
+
+    self.assertEqual(sorted(run_sync.call_args_list), [
+      self.execute_call("rclone moveto -v --stats=60s {0}{1} b2:bucket/whatever/20200520120805/data-test@20200520120805.zfs.gpg.{1}".format(prefix, i), env=self.rclone_env())
+      for i in ["0000", "0001", "0002"]
+    ])
+
+  @patch("zfs2cloud.execution.run_sync")
+  def test_export_spooled_raises_on_upload_failure(self, run_sync):
+    run_sync.side_effect = subprocess.CalledProcessError(1, "rclone")
+    folder = os.path.join(self.intermediate_basedir, "20200520120805")
+    os.mkdir(folder)
+
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    spool = ChunkSpool(max_chunks=1)
+    chunks = write_chunks(split_stream(io.BytesIO(b"a" * 5000), 1000), os.path.join(folder, "x."), 1000, spool)
+    with self.assertRaises(RuntimeError) as r:
+      cmd._pump_chunks(chunks, spool, lambda rclone, path: rclone.moveto(path, "b2:bucket/whatever/x"))
+
+    self.assertEqual(str(r.exception), "failed to upload chunks")
+    self.assertIsInstance(r.exception.__cause__, subprocess.CalledProcessError)
+
+    # The writer stops once the first upload fails.
+    self.assertEqual(run_sync.call_count, 1)
+    self.assertEqual(sorted(os.listdir(folder)), ["x.0000"])
+
+  @patch("zfs2cloud.execution.run_sync")
+  def test_export_streamed_rcats_each_chunk_without_touching_disk(self, run_sync):
+    self.config.main["export_mode"] = "stream"
+    self.config.main["split_size"] = "1K"
+
+    folder = os.path.join(self.intermediate_basedir, "20200520120805")
+    prefix = os.path.join(folder, "data-test@20200520120805.zfs.gpg.")
+    data = os.urandom(2500)
+
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    with patch("subprocess.Popen") as popen:
+      self.mock_popen(popen, data)
+      cmd._export_streamed([("zfs send", "zfs send data/test@20200520120805"), ("gpg1", "gpg1")], folder, prefix)
+
+    self.assertEqual(os.listdir(self.intermediate_basedir), [])
+    self.assertEqual(sorted(run_sync.call_args_list), [
+      self.execute_call("rclone rcat -v --stats=60s --size {0} b2:bucket/whatever/20200520120805/data-test@20200520120805.zfs.gpg.{1}".format(len(piece), i), env=self.rclone_env(), input=piece)
+      for i, piece in [("0000", data[:1024]), ("0001", data[1024:2048]), ("0002", data[2048:])]
+    ])
+
+  @patch.object(UploadIntermediateToRemote, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_upload_intermediate_copies_leftovers_in_spool_mode(self, run_sync, discover_snapshots):
+    self.config.main["export_mode"] = "spool"
+    discover_snapshots.return_value = [
+      ("data/test@20200520120805", datetime.datetime(2020, 5, 20, 12, 8, 5)),
+    ]
+
+    os.mkdir(os.path.join(self.intermediate_basedir, "20200520120805-full"))
+
+    cmd = UploadIntermediateToRemote(self.config, self.default_args(snapshot=None))
+    cmd.run()
+
+    self.assertEqual(run_sync.call_args_list, [self.execute_call("rclone copy -v --stats=60s {0}/{1} b2:bucket/whatever/{1}".format(self.intermediate_basedir, "20200520120805-full"), env=self.rclone_env())])
+
+  def manifest_folder(self, name, chunks):
+    folder = os.path.join(self.intermediate_basedir, name)
+    os.mkdir(folder)
+    manifest = Manifest("data/test@20200520120805", None, True, "none", "gpg")
+    for i, data in enumerate(chunks):
+      chunk_name = "data-test@20200520120805.zfs.gpg.{:04d}".format(i)
+      with open(os.path.join(folder, chunk_name), "wb") as f:
+        f.write(data)
+
+      manifest.add_chunk(chunk_name, len(data), hashlib.sha256(data).hexdigest())
+
+    manifest.write(folder)
+    return folder, manifest
+
+  def mock_remote(self, run_sync, folder, dropped=(), copyto_failures=None):
+    """
+    Keeps the files rclone uploads from folder in self.remote, except the
+    dropped ones which make the batch copy fail, and lists them with lsjson.
+    copyto fails for a file as many times as copyto_failures says.
+    """
+    self.remote = {}
+    self.copied = []
+    copyto_failures = dict(copyto_failures or {})
+
+    def run(argv, **kwargs):
+      if "lsjson" in argv:
+        entries = [{"Name": name, "Size": size} for name, size in self.remote.items()]
+        return self.command_result(argv, stdout=json.dumps(entries).encode("utf-8"))
+
+      if "copyto" in argv:
+        name = os.path.basename(argv[-1])
+        self.copied.append([name])
+        if copyto_failures.get(name):
+          copyto_failures[name] -= 1
+          return self.command_result(argv, returncode=1)
+
+        self.remote[name] = os.path.getsize(os.path.join(folder, name))
+        return self.command_result(argv)
+
+      with open(argv[argv.index("--files-from") + 1]) as f:
+        names = f.read().split()
+
+      self.copied.append(names)
+      for name in names:
+        if name not in dropped:
+          self.remote[name] = os.path.getsize(os.path.join(folder, name))
+
+      if set(names) & set(dropped):
+        return self.command_result(argv, returncode=1)
+
+      return self.command_result(argv)
+
+    run_sync.side_effect = run
+
+  def journal(self):
+    with open(os.path.join(self.intermediate_basedir, "_upload_journal")) as f:
+      return json.load(f)
+
+  @patch.object(UploadIntermediateToRemote, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_upload_intermediate_copies_only_unconfirmed_files_of_the_manifest(self, run_sync, discover_snapshots):
+    discover_snapshots.return_value = [("data/test@20200520120805", datetime.datetime(2020, 5, 20, 12, 8, 5))]
+    folder, manifest = self.manifest_folder("20200520120805-full", [b"a" * 10, b"b" * 4])
+    self.mock_remote(run_sync, folder)
+
+    UploadIntermediateToRemote(self.config, self.default_args(snapshot=None)).run()
+
+    env = self.rclone_env()
+    self.assertEqual(run_sync.call_args_list, [
+      self.execute_call("rclone copy -v --stats=60s --files-from {0}/_files_from --no-traverse {1} b2:bucket/whatever/20200520120805-full".format(self.intermediate_basedir, folder), env=env),
+      self.execute_call("rclone lsjson --files-only b2:bucket/whatever/20200520120805-full", capture=True, env=env),
+    ])
+    self.assertEqual(self.copied, [sorted([name for name, _, _ in manifest.chunks] + ["manifest.json"])])
+    self.assertFalse(os.path.exists(os.path.join(self.intermediate_basedir, "_files_from")))
+
+    # Everything is confirmed now, so nothing is listed or copied again.
+    run_sync.reset_mock()
+    UploadIntermediateToRemote(self.config, self.default_args(snapshot=None)).run()
+    run_sync.assert_not_called()
+
+  @patch("zfs2cloud.intermediate.time.sleep")
+  @patch.object(UploadIntermediateToRemote, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_upload_intermediate_retries_chunks_that_did_not_make_it(self, run_sync, discover_snapshots, sleep):
+    discover_snapshots.return_value = [("data/test@20200520120805", datetime.datetime(2020, 5, 20, 12, 8, 5))]
+    folder, manifest = self.manifest_folder("20200520120805-full", [b"a" * 10, b"b" * 4])
+    chunk = manifest.chunks[1][0]
+    self.mock_remote(run_sync, folder, dropped={chunk}, copyto_failures={chunk: 2})
+
+    UploadIntermediateToRemote(self.config, self.default_args(snapshot=None)).run()
+
+    self.assertEqual(self.copied[1:], [[chunk]] * 3)
+    self.assertEqual(sleep.call_args_list, [call(10), call(20)])
+    self.assertEqual(self.journal()["20200520120805-full"]["complete"], True)
+    self.assertEqual(sorted(self.journal()["20200520120805-full"]["files"]), sorted([name for name, _, _ in manifest.chunks] + ["manifest.json"]))
+
+  @patch.object(PruneIntermediate, "_discover_snapshots")
+  @patch.object(UploadIntermediateToRemote, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_upload_intermediate_journal_keeps_unfinished_folders_until_resumed(self, run_sync, discover_snapshots, prune_discover_snapshots):
+    self.config.main["export_mode"] = "spool"
+    discover_snapshots.return_value = prune_discover_snapshots.return_value = [
+      ("data/test@20200521120805", datetime.datetime(2020, 5, 21, 12, 8, 5)),
+      ("data/test@20200520120805", datetime.datetime(2020, 5, 20, 12, 8, 5)),
+    ]
+    folder, manifest = self.manifest_folder("20200520120805-full", [b"a" * 10, b"b" * 4])
+    # The spooled export moved the first chunk, but it never arrived.
+    chunk = manifest.chunks[0][0]
+    os.remove(os.path.join(folder, chunk))
+    self.mock_remote(run_sync, folder)
+
+    with self.assertRaises(RuntimeError) as r:
+      UploadIntermediateToRemote(self.config, self.default_args(snapshot="data/test@20200520120805")).run()
+
+    self.assertEqual(str(r.exception), "{} is missing from b2:bucket/whatever/20200520120805-full and is not here to upload again".format(chunk))
+    self.assertEqual(self.journal()["20200520120805-full"]["complete"], False)
+
+    PruneIntermediate(self.config, self.default_args(yes=True)).run()
+    self.assertTrue(os.path.isdir(folder))
+
+    # It turns up after all, e.g. a delayed listing.
+    self.remote[chunk] = 10
+    run_sync.reset_mock()
+    UploadIntermediateToRemote(self.config, self.default_args(snapshot=None)).resume()
+
+    self.assertEqual(len(run_sync.call_args_list), 1)
+    self.assertEqual(self.journal()["20200520120805-full"]["complete"], True)
+
+    PruneIntermediate(self.config, self.default_args(yes=True)).run()
+    self.assertFalse(os.path.isdir(folder))
+    self.assertEqual(self.journal(), {})
+
+  @patch.object(ExportIntermediate, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_compresses_before_encrypting(self, popen, run_sync, discover_snapshots):
+    self.config.main["compression"] = "zstd"
+    self.config.main["compression_level"] = "7"
+    discover_snapshots.return_value = [
+      ("data/test@20200515121005", datetime.datetime(2020, 5, 15, 12, 10, 5)),
+    ]
+
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    self.mock_popen(popen)
+    cmd.run()
+
+    self.assertEqual(popen.call_args_list, stage_calls(
+      "zfs send  data/test@20200515121005",
+      "zstd -q -c -T0 -7",
+      "gpg1 -c --compress-algo none --cipher-algo AES256 --batch --passphrase 123456",
+    ))
+
+    basedir = os.path.join(self.intermediate_basedir, "20200515121005-full")
+    self.assertEqual(sorted(os.listdir(basedir)), ["data-test@20200515121005.zfs.zst.gpg.0000", "manifest.json"])
+
+  @unittest.skipIf(crypto.AESGCM is None, "cryptography is not installed")
+  @patch.object(ExportIntermediate, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_export_intermediate_encrypts_natively(self, run_sync, discover_snapshots):
+    self.config.main["encryption"] = "native"
+    self.config.main["encryption_workers"] = "2"
+    self.config.main["split_size"] = "1K"
+    discover_snapshots.return_value = [
+      ("data/test@20200515121005", datetime.datetime(2020, 5, 15, 12, 10, 5)),
+    ]
+
+    os.mkdir(os.path.join(self.intermediate_basedir, "20200515121005-full"))
+    data = os.urandom(2500)
+
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    with patch("subprocess.Popen") as popen:
+      self.mock_popen(popen, data)
+      cmd.run()
+
+    self.assertEqual(popen.call_args_list, stage_calls("zfs send  data/test@20200515121005"))
+
+    folder = os.path.join(self.intermediate_basedir, "20200515121005-full")
+    paths = [os.path.join(folder, fn) for fn in sorted(os.listdir(folder)) if fn != "manifest.json"]
+    self.assertEqual([os.path.basename(p) for p in paths], ["data-test@20200515121005.zfs.aead.000{}".format(i) for i in range(3)])
+
+    with crypto.ChunkCipher.for_chunk("123456", paths[0], workers=1) as cipher:
+      self.assertEqual(b"".join(cipher.decrypt(paths)), data)
+
+  @unittest.skipIf(crypto.AESGCM is None, "cryptography is not installed")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_export_intermediate_deduplicates_blocks_of_uploaded_backups(self, run_sync):
+    self.config.main["encryption"] = "native"
+    self.config.main["encryption_workers"] = "1"
+    self.config.main["dedup"] = "yes"
+    blocks = [os.urandom(4096) for _ in range(4)]
+
+    def export(snapshot, data):
+      discover_snapshots = [(snapshot, datetime.datetime(2020, 5, 15, 12, 10, 5))]
+      with patch.object(ExportIntermediate, "_discover_snapshots", return_value=discover_snapshots), patch("subprocess.Popen") as popen:
+        self.mock_popen(popen, data)
+        ExportIntermediate(self.config, self.default_args(full=True, incremental=False)).run()
+
+      folder = os.path.join(self.intermediate_basedir, snapshot.split("@")[1] + "-full")
+      self.mock_remote(run_sync, folder)
+      with patch.object(UploadIntermediateToRemote, "_discover_snapshots", return_value=discover_snapshots):
+        UploadIntermediateToRemote(self.config, self.default_args(snapshot=None)).run()
+
+      return Manifest.load(folder)
+
+    first = export("data/test@20200515121005", send_stream(blocks))
+    self.assertEqual([name for name, _, _ in first.chunks], ["data-test@20200515121005.zfs.dedup.aead.0000"])
+    self.assertEqual([name for name, _, _ in first.packs], ["data-test@20200515121005.pack.0000"])
+
+    second = export("data/test@20200520120805", send_stream(blocks))
+    self.assertEqual([name for name, _, _ in second.chunks], ["data-test@20200520120805.zfs.dedup.aead.0000"])
+    self.assertEqual(second.packs, [])
+    self.assertLess(second.size, 4096)
+
+  @patch("zfs2cloud.intermediate.datetime")
+  @patch.object(ExportIntermediate, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_writes_manifest(self, popen, run_sync, discover_snapshots, datetime_mock):
+    self.datetime_mock_now(datetime_mock, datetime.datetime(2020, 5, 20, 12, 10, 5))
+    self.config.main["split_size"] = "1K"
+    discover_snapshots.return_value = [
+      ("data/test@20200520120805", datetime.datetime(2020, 5, 20, 12, 8, 5)),
+      ("data/test@20200515121005", datetime.datetime(2020, 5, 15, 12, 10, 5)),
+    ]
+    self.set_last_full_backup(*discover_snapshots.return_value[-1])
+
+    data = os.urandom(1500)
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    self.mock_popen(popen, data)
+    cmd.run()
+
+    manifest = Manifest.load(os.path.join(self.intermediate_basedir, "20200520120805"))
+    self.assertEqual(manifest.snapshot, "data/test@20200520120805")
+    self.assertEqual(manifest.base_snapshot, "data/test@20200515121005")
+    self.assertFalse(manifest.full)
+    self.assertEqual(manifest.chunks, [
+      ("data-test@20200520120805.zfs.gpg.0000", 1024, hashlib.sha256(data[:1024]).hexdigest()),
+      ("data-test@20200520120805.zfs.gpg.0001", 476, hashlib.sha256(data[1024:]).hexdigest()),
+    ])
+
+  @patch.object(ExportIntermediate, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  @patch("subprocess.Popen")
+  def test_export_intermediate_records_stage_stats(self, popen, run_sync, discover_snapshots):
+    discover_snapshots.return_value = [
+      ("data/test@20200515121005", datetime.datetime(2020, 5, 15, 12, 10, 5)),
+    ]
+
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    self.mock_popen(popen, b"a" * 1500)
+    with patch("zfs2cloud.stages._proc_io", return_value={"rchar": 1600, "wchar": 1500}):
+      cmd.run()
+
+    with open(os.path.join(self.intermediate_basedir, "_stats.jsonl")) as f:
+      records = [json.loads(line) for line in f]
+
+    self.assertEqual(len(records), 1)
+    self.assertEqual(records[0]["step"], "export-intermediate")
+    self.assertEqual(records[0]["snapshot"], "data/test@20200515121005")
+    stages = records[0]["stages"]
+    self.assertEqual([s["name"] for s in stages], ["zfs send", "gpg1", "zfs2cloud"])
+    self.assertEqual([(s["bytes_in"], s["bytes_out"]) for s in stages], [(None, 1500), (1500, 1500), (1500, 1500)])
+    self.assertEqual([s["cpu_seconds"] for s in stages[:2]], [0.25, 0.25])
+
+
+class InterruptedStream(io.BytesIO):
+  def __init__(self, data, fail_at):
+    super().__init__(data)
+    self.fail_at = fail_at
+
+  def read(self, n=-1):
+    if self.tell() >= self.fail_at:
+      raise OSError("connection lost")
+
+    return super().read(n)
+
+
+@unittest.skipIf(crypto.AESGCM is None, "cryptography is not installed")
+class ResumeExportTest(Zfs2CloudTestCase):
+  def setUp(self):
+    super().setUp()
+
+    config_data = """\
+    [main]
+    encryption_passphrase = 123456
+    zfs_fs                = data/test
+    intermediate_basedir  = {}
+    remote                = b2:bucket/whatever
+    rclone_conf           = ./rclone.conf
+    split_size            = 1K
+    encryption            = native
+    encryption_workers    = 1
+
+    [backup_sequences]
+    step01 = snapshot
+    """.format(self.intermediate_basedir)
+
+    path = os.path.join(self.config_dir, "config.ini")
+    with open(path, "w") as f:
+      f.write(textwrap.dedent(config_data))
+
+    self.config = Config(path)
+    self.folder = os.path.join(self.intermediate_basedir, "20200515121005-full")
+    patch_wait4(self)
+    self.data = os.urandom(6000)
+
+  def export(self, fail_at=None):
+    def popen(*args, **kwargs):
+      proc = unittest.mock.MagicMock()
+      proc.stdout = io.BytesIO(self.data) if fail_at is None else InterruptedStream(self.data, fail_at)
+      return proc
+
+    cmd = ExportIntermediate(self.config, self.default_args(full=False, incremental=False))
+    with patch.object(ExportIntermediate, "_discover_snapshots") as discover_snapshots, patch("subprocess.run"), patch("subprocess.Popen", side_effect=popen):
+      discover_snapshots.return_value = [
+        ("data/test@20200515121005", datetime.datetime(2020, 5, 15, 12, 10, 5)),
+      ]
+      cmd.run()
+
+  def chunk_paths(self):
+    return [os.path.join(self.folder, fn) for fn in sorted(os.listdir(self.folder)) if ".aead." in fn and not fn.endswith(".partial")]
+
+  def read(self, path):
+    with open(path, "rb") as f:
+      return f.read()
+
+  def assert_decrypts(self):
+    paths = self.chunk_paths()
+    with crypto.ChunkCipher.for_chunk("123456", paths[0], workers=1) as cipher:
+      self.assertEqual(b"".join(cipher.decrypt(paths)), self.data)
+
+    manifest = Manifest.load(self.folder)
+    self.assertEqual([name for name, _, _ in manifest.chunks], [os.path.basename(p) for p in paths])
+    self.assertFalse(os.path.exists(os.path.join(self.folder, "checkpoint.json")))
+
+  def test_resumes_after_last_sealed_chunk(self):
+    with self.assertRaises(OSError):
+      self.export(fail_at=4500)
+
+    interrupted = {p: self.read(p) for p in self.chunk_paths()}
+    self.assertGreaterEqual(len(interrupted), 2)
+
+    checkpoint = Checkpoint.load(self.folder)
+    self.assertEqual([name for name, _, _ in checkpoint.manifest.chunks], [os.path.basename(p) for p in sorted(interrupted)])
+    self.assertEqual(checkpoint.stream_offset, len(interrupted) * 1024)
+
+    self.export()
+    self.assertEqual(len(self.chunk_paths()), 6)
+    self.assert_decrypts()
+
+    # All but the last chunk sealed before the interruption are kept as is.
+    for path in sorted(interrupted)[:-1]:
+      self.assertEqual(self.read(path), interrupted[path])
+
+  def test_starts_over_if_the_stream_changed(self):
+    with self.assertRaises(OSError):
+      self.export(fail_at=4500)
+
+    first = self.read(self.chunk_paths()[0])
+    self.data = os.urandom(3000)
+    self.export()
+
+    self.assertEqual(len(self.chunk_paths()), 3)
+    self.assertNotEqual(self.read(self.chunk_paths()[0]), first)
+    self.assert_decrypts()
+
+  def test_gpg_export_removes_leftovers_and_starts_over(self):
+    self.config.main["encryption"] = "gpg"
+    os.makedirs(os.path.join(self.folder, "subdirectory"))
+    for fn in ["data-test@20200515121005.zfs.gpg.0000", "data-test@20200515121005.zfs.gpg.0001.partial", "manifest.json", "notes.txt"]:
+      with open(os.path.join(self.folder, fn), "w") as f:
+        f.write("stale")
+
+    self.data = self.data[:1500]
+    with self.assertLogs("ExportIntermediate", level="WARNING") as logs:
+      self.export()
+
+    self.assertEqual(logs.output, [
+      "WARNING:ExportIntermediate:{} already holds a completed export of data/test@20200515121005, which is replaced".format(self.folder),
+    ])
+    self.assertEqual(sorted(os.listdir(self.folder)), [
+      "data-test@20200515121005.zfs.gpg.0000",
+      "data-test@20200515121005.zfs.gpg.0001",
+      "manifest.json",
+      "notes.txt",
+      "subdirectory",
+    ])
+    self.assertEqual(self.read(os.path.join(self.folder, "data-test@20200515121005.zfs.gpg.0000")), self.data[:1024])
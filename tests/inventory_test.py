@@ -0,0 +1,42 @@
+from datetime import datetime
+from unittest.mock import Mock
+import unittest
+
+from zfs2cloud.inventory import SnapshotInventory
+
+
+class SnapshotInventoryTest(unittest.TestCase):
+  def setUp(self):
+    self.first = int(datetime(2020, 5, 15, 12, 10, 5).timestamp())
+    self.second = int(datetime(2020, 5, 20, 12, 8, 5).timestamp())
+
+    output = "data/test@20200520120805\t{1}\ndata/test#20200515121005\t{0}\ndata/test@20200515121005\t{0}\n".format(self.first, self.second)
+    self.zfs = Mock(return_value=Mock(stdout=output))
+    self.inventory = SnapshotInventory(self.zfs, "data/test")
+
+  def test_lists_snapshots_and_bookmarks_once(self):
+    self.assertEqual(self.inventory.snapshots(), [
+      ("data/test@20200520120805", datetime(2020, 5, 20, 12, 8, 5)),
+      ("data/test@20200515121005", datetime(2020, 5, 15, 12, 10, 5)),
+    ])
+    self.assertEqual(self.inventory.bookmarks(), [
+      ("data/test#20200515121005", datetime(2020, 5, 15, 12, 10, 5)),
+    ])
+
+    self.zfs.assert_called_once_with("list", "-Hp", "-t", "snapshot,bookmark", "-o", "name,creation", "-S", "creation", "-d1", "data/test")
+
+  def test_updates_in_place(self):
+    self.inventory.snapshots()
+    self.inventory.add("data/test@20200521000000", datetime(2020, 5, 21))
+    self.inventory.remove("data/test@20200515121005")
+
+    self.assertEqual([name for name, _ in self.inventory.snapshots()], ["data/test@20200521000000", "data/test@20200520120805"])
+    self.assertEqual(self.zfs.call_count, 1)
+
+    self.inventory.invalidate()
+    self.assertEqual(len(self.inventory.snapshots()), 2)
+    self.assertEqual(self.zfs.call_count, 2)
+
+  def test_empty(self):
+    self.zfs.return_value = Mock(stdout="")
+    self.assertEqual(self.inventory.snapshots(), [])
@@ -0,0 +1,155 @@
+import json
+import os
+import textwrap
+import threading
+from unittest.mock import patch
+
+from .test_case import Zfs2CloudTestCase
+from zfs2cloud.command import Command
+from zfs2cloud.config import Config
+from zfs2cloud.perform import Perform
+
+
+class RecordDataset(Command):
+  runs = []
+  lock = threading.Lock()
+
+  def run(self):
+    if self.config.main["zfs_fs"] == "data/broken":
+      raise RuntimeError("broken")
+
+    with self.lock:
+      self.runs.append((self.config.main["zfs_fs"], self.config.main["intermediate_basedir"], self.config.main["remote"]))
+
+
+class RecordSnapshot(Command):
+  def run(self):
+    with RecordDataset.lock:
+      RecordDataset.runs.append(("snapshot", self.config.main["zfs_fs"]))
+
+
+class RunTrue(Command):
+  def run(self):
+    self._execute_all([["true"]])
+
+
+class RecordExport(Command):
+  def run(self):
+    RecordDataset.runs.append(("export", self.config.main["zfs_fs"]))
+
+
+class RecordUpload(Command):
+  @classmethod
+  def add_arguments(cls, parser):
+    parser.add_argument("-s", "--snapshot", default=None)
+
+  def run(self):
+    RecordDataset.runs.append(("upload", self.config.main["zfs_fs"]))
+
+  def resume(self):
+    RecordDataset.runs.append(("resume", self.config.main["zfs_fs"]))
+
+
+class PerformTest(Zfs2CloudTestCase):
+  def setUp(self):
+    super().setUp()
+    RecordDataset.runs = []
+
+  def write_config(self, zfs_fs, recursive="no", steps="step01 = record"):
+    config_data = """\
+    [main]
+    encryption_passphrase = 123456
+    zfs_fs                = {}
+    zfs_fs_recursive      = {}
+    intermediate_basedir  = {}
+    remote                = b2:bucket/whatever
+    rclone_conf           = ./rclone.conf
+
+    [backup_sequences]
+    {}
+    """.format(zfs_fs, recursive, self.intermediate_basedir, steps)
+
+    path = os.path.join(self.config_dir, "config.ini")
+    with open(path, "w") as f:
+      f.write(textwrap.dedent(config_data))
+
+    return path
+
+  def perform(self, zfs_fs, recursive="no", steps="step01 = record"):
+    path = self.write_config(zfs_fs, recursive, steps)
+    commands = {
+      "record": RecordDataset, "snapshot": RecordSnapshot, "true": RunTrue,
+      "export-intermediate": RecordExport, "upload-intermediate-to-remote": RecordUpload,
+    }
+    Perform(Config(path, commands), self.default_args(_commands=commands)).run()
+    return RecordDataset.runs
+
+  def test_single_dataset_uses_config_as_is(self):
+    self.assertEqual(sorted(self.perform("data/test")), [("data/test", self.intermediate_basedir, "b2:bucket/whatever")])
+
+  def test_runs_every_dataset_with_its_own_folders(self):
+    self.assertEqual(sorted(self.perform("data/a data/b")), [
+      ("data/a", os.path.join(self.intermediate_basedir, "data-a"), "b2:bucket/whatever/data-a"),
+      ("data/b", os.path.join(self.intermediate_basedir, "data-b"), "b2:bucket/whatever/data-b"),
+    ])
+
+    self.assertTrue(os.path.isdir(os.path.join(self.intermediate_basedir, "data-a")))
+    with open(os.path.join(self.intermediate_basedir, "data-a", "_stats.jsonl")) as f:
+      self.assertIn('"step": "record"', f.read())
+
+  def test_records_the_commands_of_every_step(self):
+    self.perform("data/test", steps="step01 = true")
+
+    with open(os.path.join(self.intermediate_basedir, "_stats.jsonl")) as f:
+      record = json.loads(f.read())
+
+    self.assertEqual(record["step"], "true")
+    self.assertEqual(len(record["commands"]), 1)
+    self.assertEqual((record["commands"][0]["argv"], record["commands"][0]["returncode"]), (["true"], 0))
+
+  def test_reports_failed_datasets_after_running_the_others(self):
+    with self.assertRaises(RuntimeError) as r:
+      self.perform("data/a data/broken data/b")
+
+    self.assertEqual(str(r.exception), "backing up data/broken failed")
+    self.assertEqual(str(r.exception.__cause__), "broken")
+    self.assertEqual(sorted(zfs_fs for zfs_fs, _, _ in RecordDataset.runs), ["data/a", "data/b"])
+
+  @patch("zfs2cloud.execution.run_sync")
+  def test_recurses_into_children(self, run_sync):
+    run_sync.return_value = self.command_result(["zfs", "list"], stdout=b"data\ndata/a\ndata/a/b\n")
+
+    self.assertEqual(sorted(zfs_fs for zfs_fs, _, _ in self.perform("data", recursive="yes")), ["data", "data/a", "data/a/b"])
+    self.assertEqual(run_sync.call_args_list, [self.execute_call("zfs list -H -o name -r -t filesystem,volume data", capture=True)])
+
+  def test_standalone_command_runs_every_dataset(self):
+    path = self.write_config("data/a data/broken data/b")
+    with self.assertRaises(RuntimeError) as r:
+      RecordDataset.standalone_main(self.default_args(config=path, _commands={"record": RecordDataset}))
+
+    self.assertEqual(str(r.exception), "data/broken failed")
+    self.assertEqual(RecordDataset.runs, [
+      ("data/a", os.path.join(self.intermediate_basedir, "data-a"), "b2:bucket/whatever/data-a"),
+      ("data/b", os.path.join(self.intermediate_basedir, "data-b"), "b2:bucket/whatever/data-b"),
+    ])
+
+  @patch("zfs2cloud.execution.run_sync")
+  def test_rejects_children_sharing_a_folder(self, run_sync):
+    run_sync.return_value = self.command_result(["zfs", "list"], stdout=b"data\ndata/a-b\ndata/a/b\n")
+
+    with self.assertRaises(ValueError) as r:
+      self.perform("data", recursive="yes")
+
+    self.assertEqual(str(r.exception), "data/a-b and data/a/b would both be backed up to the folder data-a-b, rename one of them")
+    self.assertEqual(RecordDataset.runs, [])
+
+  def test_snapshots_all_datasets_once_before_their_sequences(self):
+    runs = self.perform("data/a data/b", steps="step01 = snapshot\n    step02 = record")
+
+    self.assertEqual(runs[0], ("snapshot", "data/a data/b"))
+    self.assertEqual(sorted(run[0] for run in runs[1:]), ["data/a", "data/b"])
+
+  def test_resumes_failed_uploads_before_exporting(self):
+    runs = self.perform("data/test", steps="step01 = snapshot\n    step02 = export-intermediate\n    step03 = upload-intermediate-to-remote")
+
+    self.assertEqual(runs, [("snapshot", "data/test"), ("resume", "data/test"), ("export", "data/test"), ("upload", "data/test")])
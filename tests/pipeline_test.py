@@ -0,0 +1,102 @@
+import hashlib
+import io
+import os
+import threading
+import time
+import unittest
+
+from .test_case import Zfs2CloudTestCase
+from zfs2cloud.pipeline import ChunkSpool, SpoolAborted, split_stream, write_chunks
+
+
+class ChunkSpoolTest(unittest.TestCase):
+  def test_reserve_blocks_until_released(self):
+    spool = ChunkSpool(max_chunks=2)
+    spool.reserve(10)
+    spool.put("a", 10, 10)
+    spool.reserve(10)
+    spool.put("b", 10, 10)
+
+    reserved = threading.Event()
+
+    def writer():
+      spool.reserve(10)
+      reserved.set()
+
+    t = threading.Thread(target=writer)
+    t.start()
+    time.sleep(0.05)
+    self.assertFalse(reserved.is_set())
+
+    self.assertEqual(spool.get(), ("a", 10))
+    spool.release(10)
+    t.join(1)
+    self.assertTrue(reserved.is_set())
+
+  def test_byte_limit_uses_actual_chunk_size(self):
+    spool = ChunkSpool(max_bytes=20)
+    spool.reserve(20)
+    spool.put("a", 20, 5)
+    spool.reserve(10)  # 5 + 10 <= 20, must not block
+    spool.put("b", 10, 10)
+
+    self.assertEqual(spool.get(), ("a", 5))
+    self.assertEqual(spool.get(), ("b", 10))
+
+  def test_get_returns_none_when_closed_and_drained(self):
+    spool = ChunkSpool()
+    spool.reserve(1)
+    spool.put("a", 1, 1)
+    spool.close()
+
+    self.assertEqual(spool.get(), ("a", 1))
+    self.assertIsNone(spool.get())
+
+  def test_abort_wakes_blocked_writer(self):
+    spool = ChunkSpool(max_chunks=1)
+    spool.reserve(1)
+    spool.put("a", 1, 1)
+
+    errors = []
+
+    def writer():
+      try:
+        spool.reserve(1)
+      except SpoolAborted as e:
+        errors.append(e)
+
+    t = threading.Thread(target=writer)
+    t.start()
+    spool.abort(RuntimeError("upload failed"))
+    t.join(1)
+
+    self.assertEqual(len(errors), 1)
+    self.assertIn("upload failed", str(errors[0]))
+
+
+class WriteChunksTest(Zfs2CloudTestCase):
+  def test_splits_like_split(self):
+    prefix = os.path.join(self.intermediate_basedir, "data-test@1.zfs.gpg.")
+    data = bytes(range(256)) * 10
+
+    chunks = list(write_chunks(split_stream(io.BytesIO(data), 1000), prefix, 1000))
+
+    self.assertEqual(chunks, [
+      (prefix + "0000", 1000, hashlib.sha256(data[:1000]).hexdigest()),
+      (prefix + "0001", 1000, hashlib.sha256(data[1000:2000]).hexdigest()),
+      (prefix + "0002", 560, hashlib.sha256(data[2000:]).hexdigest()),
+    ])
+
+    joined = b""
+    for path, _, _ in chunks:
+      with open(path, "rb") as f:
+        joined += f.read()
+
+    self.assertEqual(joined, data)
+    self.assertEqual(sorted(os.listdir(self.intermediate_basedir)), [os.path.basename(p) for p, _, _ in chunks])
+
+  def test_no_empty_trailing_chunk(self):
+    prefix = os.path.join(self.intermediate_basedir, "x.")
+    chunks = list(write_chunks(split_stream(io.BytesIO(b"a" * 2000), 1000), prefix, 1000))
+    self.assertEqual([size for _, size, _ in chunks], [1000, 1000])
+    self.assertEqual(list(write_chunks(split_stream(io.BytesIO(b""), 1000), prefix, 1000)), [])
@@ -0,0 +1,216 @@
+import base64
+import http.server
+import json
+import os
+import stat
+import sys
+import textwrap
+import threading
+import urllib.parse
+from unittest.mock import patch
+
+from .test_case import Zfs2CloudTestCase
+from zfs2cloud.command import Command
+from zfs2cloud.config import Config
+from zfs2cloud.rclone import RcError, RcloneRc, connect, split_path
+
+
+class FakeRcHandler(http.server.BaseHTTPRequestHandler):
+  """Answers like rclone rcd would, recording every call in server.calls."""
+
+  def do_POST(self):
+    url = urllib.parse.urlparse(self.path)
+    method = url.path.lstrip("/")
+    body = self.rfile.read(int(self.headers["Content-Length"]))
+    if method == "operations/uploadfile":
+      params = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+      params["data"] = body.split(b"\r\n\r\n", 1)[1].rsplit(b"\r\n--", 1)[0]
+    else:
+      params = json.loads(body)
+
+    self.server.calls.append((method, params, self.headers["Authorization"]))
+
+    status, response = 200, {}
+    if method in ("sync/sync", "sync/copy", "operations/movefile"):
+      response = {"jobid": 7}
+      self.server.polls = 0
+    elif method == "job/status":
+      self.server.polls += 1
+      finished = self.server.polls >= 2
+      response = {"finished": finished, "success": finished and self.server.error is None, "error": self.server.error or ""}
+    elif method == "operations/list":
+      response = {"list": [{"Name": "a.0000", "Size": 10}, {"Name": "a.0001", "Size": 4}]}
+    elif method not in ("rc/noop", "core/stats", "core/bwlimit", "operations/uploadfile"):
+      status, response = 404, {"error": "couldn't find method {}".format(method)}
+
+    data = json.dumps(response).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, *args):
+    pass
+
+
+class RcloneRcTest(Zfs2CloudTestCase):
+  def setUp(self):
+    super().setUp()
+
+    self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeRcHandler)
+    self.server.calls = []
+    self.server.error = None
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.addCleanup(self.server.server_close)
+    self.addCleanup(self.server.shutdown)
+
+    self.config = self.rcd_config("rclone_rc_url = http://127.0.0.1:{}/\nrclone_rc_user = backup\nrclone_rc_pass = secret\n".format(self.server.server_port))
+    self.command = Command(self.config, self.default_args())
+    patcher = patch.object(RcloneRc, "POLL_SECONDS", 0.01)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def rcd_config(self, options):
+    config_data = textwrap.dedent("""\
+    [main]
+    encryption_passphrase = 123456
+    zfs_fs                = data/test
+    intermediate_basedir  = {}
+    remote                = b2:bucket/whatever
+    rclone_conf           = ./rclone.conf
+    rclone_backend        = rcd
+    """).format(self.intermediate_basedir) + options + "\n[backup_sequences]\nstep01 = snapshot\n"
+
+    path = os.path.join(self.config_dir, "config.ini")
+    with open(path, "w") as f:
+      f.write(config_data)
+
+    return Config(path)
+
+  def test_split_path(self):
+    self.assertEqual(split_path("b2:bucket/a/b"), ("b2:bucket/a", "b"))
+    self.assertEqual(split_path("b2:b"), ("b2:", "b"))
+    self.assertEqual(split_path("/tmp/a"), ("/tmp", "a"))
+
+  def test_copy_waits_for_the_job(self):
+    rclone = connect(self.command)
+    self.assertIsInstance(rclone, RcloneRc)
+    rclone.copy("/tmp/folder", "b2:bucket/whatever/folder")
+
+    credentials = "Basic " + base64.b64encode(b"backup:secret").decode("ascii")
+    self.assertEqual(self.server.calls, [
+      ("sync/copy", {"_async": True, "srcFs": "/tmp/folder", "dstFs": "b2:bucket/whatever/folder"}, credentials),
+      ("job/status", {"jobid": 7}, credentials),
+      ("job/status", {"jobid": 7}, credentials),
+    ])
+    self.assertEqual([(result.argv[:2], result.returncode) for result in self.command.executed], [(["rc", "sync/copy"], 0)])
+
+  def test_failed_job_raises(self):
+    self.server.error = "directory not found"
+    with self.assertRaises(RcError) as r:
+      connect(self.command).sync("/tmp/folder", "b2:bucket/whatever/folder")
+
+    self.assertEqual(str(r.exception), "sync/sync failed: directory not found")
+    self.assertEqual(self.command.executed[0].returncode, 1)
+
+  def test_moveto_rcat_and_touch(self):
+    rclone = connect(self.command)
+    rclone.moveto("/tmp/folder/a.0000", "b2:bucket/whatever/folder/a.0000")
+    rclone.rcat("b2:bucket/whatever/folder/manifest.json", b"{}\n")
+    rclone.touch("b2:bucket/whatever/__zfs2cloud_last_updated__")
+
+    calls = [(method, params) for method, params, _ in self.server.calls if method != "job/status"]
+    self.assertEqual(calls, [
+      ("operations/movefile", {"_async": True, "srcFs": "/tmp/folder", "srcRemote": "a.0000", "dstFs": "b2:bucket/whatever/folder", "dstRemote": "a.0000"}),
+      ("operations/uploadfile", {"fs": "b2:bucket/whatever/folder", "remote": "", "data": b"{}\n"}),
+      ("operations/uploadfile", {"fs": "b2:bucket/whatever", "remote": "", "data": b""}),
+    ])
+
+  def test_copy_files_does_not_traverse_the_destination(self):
+    connect(self.command).copy_files("/tmp/folder", "b2:bucket/whatever/folder", "/tmp/files")
+    self.assertEqual(self.server.calls[0][:2], ("sync/copy", {
+      "_async": True, "srcFs": "/tmp/folder", "dstFs": "b2:bucket/whatever/folder",
+      "_filter": {"FilesFrom": ["/tmp/files"]}, "_config": {"NoTraverse": True},
+    }))
+
+  def test_sync_takes_the_filter_rules(self):
+    rclone = connect(self.command)
+    rclone.sync("/tmp/folder", "b2:bucket/whatever/folder", "/tmp/rules")
+    self.assertEqual(self.server.calls[0][:2], ("sync/sync", {
+      "_async": True, "srcFs": "/tmp/folder", "dstFs": "b2:bucket/whatever/folder", "_filter": {"FilterFrom": ["/tmp/rules"]},
+    }))
+
+    with self.assertRaises(ValueError):
+      rclone.sync("/tmp/folder", "b2:bucket/whatever/folder", combined="/tmp/combined")
+
+  def test_list(self):
+    self.assertEqual(connect(self.command).list("b2:bucket/whatever/folder"), {"a.0000": 10, "a.0001": 4})
+    self.assertEqual(self.server.calls[0][:2], ("operations/list", {"fs": "b2:bucket/whatever/folder", "remote": "", "opt": {"filesOnly": True}}))
+
+  def test_jobs_apply_the_bandwidth_limit(self):
+    config = self.rcd_config("rclone_rc_url = http://127.0.0.1:{}/\nrclone_bwlimit = 3M\n".format(self.server.server_port))
+    connect(Command(config, self.default_args())).copy("/tmp/folder", "b2:bucket/whatever/folder")
+
+    self.assertEqual([params for method, params, _ in self.server.calls if method == "core/bwlimit"], [{"rate": "3072K"}])
+
+  @patch("zfs2cloud.execution.run_sync")
+  def test_cli_passes_the_timetable(self, run_sync):
+    config = self.rcd_config("rclone_bwlimit = 00:00,off 07:00,2.5M\n")
+    config.main["rclone_backend"] = "cli"
+    connect(Command(config, self.default_args())).copy("/tmp/folder", "b2:bucket/whatever/folder")
+
+    self.assertEqual(run_sync.call_args[0][0], ["rclone", "copy", "-v", "--stats=60s", "--bwlimit", "00:00,off 07:00,2.5M", "/tmp/folder", "b2:bucket/whatever/folder"])
+
+  @patch("zfs2cloud.execution.run_sync")
+  def test_cli_splits_flags_and_times_out_listings(self, run_sync):
+    config = self.rcd_config("rclone_global_flags = --config-dir '/tmp/a b'\ncommand_timeout = 30\n")
+    config.main["rclone_backend"] = "cli"
+    run_sync.return_value = self.command_result([], stdout=b"[]")
+    rclone = connect(Command(config, self.default_args()))
+    rclone.copy("/tmp/folder", "b2:bucket/whatever/folder")
+    rclone.list("b2:bucket/whatever/folder")
+
+    self.assertEqual([(args[0], kwargs["timeout"]) for args, kwargs in run_sync.call_args_list], [
+      (["rclone", "--config-dir", "/tmp/a b", "copy", "-v", "--stats=60s", "/tmp/folder", "b2:bucket/whatever/folder"], None),
+      (["rclone", "--config-dir", "/tmp/a b", "lsjson", "--files-only", "b2:bucket/whatever/folder"], 30.0),
+    ])
+
+  def test_dry_run_calls_nothing(self):
+    connect(self.command).sync("/tmp/folder", "b2:bucket/whatever/folder", dry_run=True)
+    self.assertEqual(self.server.calls, [])
+
+  def test_starts_one_daemon_for_the_run(self):
+    # A stand-in for rclone rcd that serves the fake API on --rc-addr.
+    fake_rclone = os.path.join(self.config_dir, "rclone")
+    with open(fake_rclone, "w") as f:
+      f.write(textwrap.dedent("""\
+      #!{python}
+      import http.server, os, sys
+      sys.path.insert(0, {root!r})
+      from tests.rclone_test import FakeRcHandler
+
+      host, port = sys.argv[-1].split("=")[1].split(":")
+      with open(os.path.join({config_dir!r}, "rcd.log"), "a") as f:
+        f.write("{{}} {{}} {{}}\\n".format(" ".join(sys.argv[1:]), os.environ["RCLONE_RC_USER"], os.environ["RCLONE_CONFIG"]))
+
+      server = http.server.HTTPServer((host, int(port)), FakeRcHandler)
+      server.calls = []
+      server.serve_forever()
+      """).format(python=sys.executable, root=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), config_dir=self.config_dir))
+
+    os.chmod(fake_rclone, os.stat(fake_rclone).st_mode | stat.S_IXUSR)
+
+    config = self.rcd_config("")
+    config.rclone_path = fake_rclone
+    self.addCleanup(config.rclone_daemon.stop)
+
+    command = Command(config, self.default_args())
+    connect(command).list("b2:bucket/whatever")
+    connect(Command(config.for_dataset("data/other"), self.default_args())).list("b2:bucket/whatever")
+
+    with open(os.path.join(self.config_dir, "rcd.log")) as f:
+      launches = f.read().splitlines()
+
+    self.assertEqual(len(launches), 1)
+    self.assertRegex(launches[0], r"^rcd -v --stats=60s --rc-addr=127\.0\.0\.1:\d+ zfs2cloud {}$".format(self.rclone_path))
@@ -0,0 +1,98 @@
+import hashlib
+import io
+import os
+import time
+import unittest
+from unittest.mock import patch
+
+from .sendstream_test import send_stream
+from .test_case import Zfs2CloudTestCase
+from zfs2cloud import crypto, dedup
+from zfs2cloud.manifest import Manifest
+from zfs2cloud.pipeline import write_chunks
+from zfs2cloud.restore import Restore
+
+
+class RestoreTest(Zfs2CloudTestCase):
+  def setUp(self):
+    super().setUp()
+
+    self.folder = os.path.join(self.intermediate_basedir, "20200515121005-full")
+    os.mkdir(self.folder)
+
+    self.manifest = Manifest("data/test@20200515121005", None, True, "zstd", "gpg")
+    self.data = b""
+    for i in range(3):
+      name = "data-test@20200515121005.zfs.zst.gpg.000{}".format(i)
+      data = os.urandom(100)
+      with open(os.path.join(self.folder, name), "wb") as f:
+        f.write(data)
+
+      self.data += data
+      self.manifest.add_chunk(name, len(data), hashlib.sha256(data).hexdigest())
+
+    self.manifest.write(self.folder)
+
+  def restore(self):
+    fed = []
+    self.feed_calls = 0
+
+    def feed(description, command, pieces):
+      self.feed_calls += 1
+      fed.append((description, b"".join(pieces)))
+
+    with patch("getpass.getpass", return_value="123456"), patch.object(Restore, "_feed", side_effect=feed):
+      Restore(None, self.default_args(zfs_fs="data/restored", workers=0, backup_folders=[self.folder])).run()
+
+    return fed
+
+  def test_restore_verifies_and_feeds_chunks_in_order(self):
+    self.assertEqual(self.restore(), [(
+      "set -o pipefail; pv -s 300 | gpg --decrypt --batch --passphrase '*****' | zstd -q -d -c | zfs recv data/restored",
+      self.data,
+    )])
+
+  def test_restore_fails_on_missing_chunk(self):
+    os.remove(os.path.join(self.folder, "data-test@20200515121005.zfs.zst.gpg.0001"))
+
+    with self.assertRaises(ValueError) as r:
+      self.restore()
+
+    self.assertIn("is missing chunks", str(r.exception))
+
+  def test_restore_fails_on_corrupted_chunk(self):
+    path = os.path.join(self.folder, "data-test@20200515121005.zfs.zst.gpg.0002")
+    with open(path, "r+b") as f:
+      f.write(b"corrupted")
+
+    with self.assertRaises(ValueError) as r:
+      self.restore()
+
+    self.assertEqual(str(r.exception), "data-test@20200515121005.zfs.zst.gpg.0002 does not match the sha256 in the manifest")
+    # zfs recv never started.
+    self.assertEqual(self.feed_calls, 0)
+
+  @unittest.skipIf(crypto.AESGCM is None, "cryptography is not installed")
+  def test_restore_rebuilds_deduplicated_backup_from_packs(self):
+    blocks = [os.urandom(4096) for _ in range(4)]
+    with dedup.BlockIndex(os.path.join(self.intermediate_basedir, "_dedup_index")) as index:
+      earlier = os.path.join(self.intermediate_basedir, "20200510121005-full")
+      os.mkdir(earlier)
+      store = dedup.BlockStore(index, "123456", earlier, os.path.join(earlier, "data-test@20200510121005.pack."), 1 << 20, 0)
+      recipe = store.recipe(io.BytesIO(send_stream(blocks)))
+      while recipe.read(1 << 20):
+        pass
+
+      index.mark_uploaded("20200510121005-full", time.time())
+
+      for fn in os.listdir(self.folder):
+        os.remove(os.path.join(self.folder, fn))
+
+      data = send_stream(blocks[1:])
+      store = dedup.BlockStore(index, "123456", self.folder, os.path.join(self.folder, "data-test@20200515121005.pack."), 1 << 20, 0)
+      with crypto.ChunkCipher("123456", workers=1) as cipher:
+        prefix = os.path.join(self.folder, "data-test@20200515121005.zfs.dedup.aead.")
+        list(write_chunks(cipher.encrypt(store.recipe(io.BytesIO(data)), 1 << 20), prefix, 1 << 20))
+
+    self.assertEqual(store.packs, [])
+    self.assertEqual(self.restore(), [("set -o pipefail; cat | zfs recv data/restored", data)])
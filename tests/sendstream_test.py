@@ -0,0 +1,74 @@
+import io
+import os
+import struct
+import unittest
+
+from zfs2cloud import sendstream
+
+
+def record(record_type, order="<", payloadlen=0, fields=()):
+  """Builds a dmu_replay_record_t, fields are (offset, struct format, value)."""
+  header = bytearray(sendstream.RECORD_SIZE)
+  struct.pack_into(order + "II", header, 0, record_type, payloadlen)
+  for offset, fmt, value in fields:
+    struct.pack_into(order + fmt, header, offset, value)
+
+  return bytes(header)
+
+
+def begin(order="<"):
+  return record(sendstream.BEGIN, order, fields=[(8, "Q", sendstream.BACKUP_MAGIC)])
+
+
+def write(payload, order="<", compressed=False, offset=0):
+  if compressed:
+    fields = [(24, "Q", offset), (32, "Q", 128 * 1024), (50, "B", 15), (96, "Q", len(payload))]
+  else:
+    fields = [(24, "Q", offset), (32, "Q", len(payload))]
+
+  return record(sendstream.WRITE, order, fields=fields) + payload
+
+
+def send_stream(blocks, order="<"):
+  data = begin(order)
+  data += record(sendstream.OBJECT, order, fields=[(28, "I", 5)]) + b"bonus\0\0\0"
+  for i, block in enumerate(blocks):
+    data += write(block, order, compressed=i % 2 == 1, offset=i * len(block))
+
+  data += record(sendstream.FREE, order)
+  data += record(sendstream.END, order)
+  return data
+
+
+class SendStreamTest(unittest.TestCase):
+  def test_records(self):
+    blocks = [os.urandom(4096), os.urandom(1000)]
+    data = send_stream(blocks)
+
+    records = list(sendstream.records(io.BytesIO(data)))
+
+    self.assertEqual([t for t, _, _ in records], [
+      sendstream.BEGIN, sendstream.OBJECT, sendstream.WRITE, sendstream.WRITE, sendstream.FREE, sendstream.END,
+    ])
+    self.assertEqual([p for t, _, p in records if t == sendstream.WRITE], blocks)
+    self.assertEqual(records[1][2], b"bonus\0\0\0")
+    self.assertEqual(b"".join(h + p for _, h, p in records), data)
+
+  def test_big_endian_records(self):
+    blocks = [os.urandom(512)]
+    records = list(sendstream.records(io.BytesIO(send_stream(blocks, order=">"))))
+    self.assertEqual([p for t, _, p in records if t == sendstream.WRITE], blocks)
+
+  def test_unknown_data_is_passed_through(self):
+    for data in [os.urandom(1000), begin() + record(42) + os.urandom(5000), write(os.urandom(100)) + os.urandom(100)]:
+      records = list(sendstream.records(io.BytesIO(data)))
+      self.assertEqual(b"".join(h + p for _, h, p in records), data)
+
+    records = list(sendstream.records(io.BytesIO(begin() + record(42) + b"rest")))
+    self.assertEqual([t for t, _, _ in records], [sendstream.BEGIN, None, None])
+
+  def test_truncated_payload_is_passed_through(self):
+    data = begin() + write(os.urandom(4096))[:-10]
+    records = list(sendstream.records(io.BytesIO(data)))
+    self.assertEqual(records[-1][0], None)
+    self.assertEqual(b"".join(h + p for _, h, p in records), data)
@@ -0,0 +1,45 @@
+import os
+
+from .test_case import Zfs2CloudTestCase
+from zfs2cloud import shards
+
+
+class ShardsTest(Zfs2CloudTestCase):
+  def write(self, path, size):
+    path = os.path.join(self.intermediate_basedir, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+      f.write(b"x" * size)
+
+  def test_scan(self):
+    self.write("a.txt", 3)
+    self.write("photos/2019/1.jpg", 10)
+    self.write("photos/2019/2.jpg", 20)
+    self.write("photos/index", 5)
+    os.makedirs(os.path.join(self.intermediate_basedir, "empty"))
+    os.symlink("a.txt", os.path.join(self.intermediate_basedir, "link"))
+
+    self.assertEqual(shards.scan(self.intermediate_basedir, 2), {
+      "": (3, 1),
+      "empty": (0, 0),
+      "photos": (5, 1),
+      "photos/2019": (30, 2),
+    })
+
+  def test_plan_splits_large_subtrees(self):
+    directories = {
+      "": (0, 1),
+      "mail": (0, 0),
+      "mail/a": (400, 40),
+      "mail/b": (400, 40),
+      "photos": (1000, 10),
+      "src": (200, 9),
+    }
+
+    self.assertEqual(shards.plan(directories, 3), [["photos"], ["mail/a", "src"], ["mail/b"]])
+    self.assertEqual(shards.plan(directories, 1), [["mail", "photos", "src"]])
+
+  def test_filter_rules(self):
+    planned = [["a"], ["b", "c[1]"], ["d"]]
+    self.assertEqual(shards.filter_rules(planned, 0), ["- /b/**", "- /c\\[1\\]/**", "- /d/**", "+ **"])
+    self.assertEqual(shards.filter_rules(planned, 1), ["+ /b/**", "+ /c\\[1\\]/**", "- **"])
@@ -1,5 +1,8 @@
 import datetime
-from unittest.mock import patch, call
+import json
+import os
+import shlex
+from unittest.mock import patch
 
 
 from .test_case import Zfs2CloudTestCase
@@ -29,38 +32,32 @@ class SnapshotTest(Zfs2CloudTestCase):
     """.format(self.intermediate_basedir, self.oldest_snapshot_days, self.oldest_snapshot_days - 2)
 
   @patch("zfs2cloud.snapshot.datetime")
-  @patch("subprocess.run")
-  def test_snapshot(self, subprocess_run, datetime_mock):
+  @patch("zfs2cloud.execution.run_sync")
+  def test_snapshot(self, run_sync, datetime_mock):
     self.datetime_mock_now(datetime_mock, datetime.datetime(2020, 5, 15, 12, 10, 20))
 
     with self.config(self.config_data) as c:
       s = Snapshot(c, self.default_args(dry_run=False))
       s.run()
 
-    subprocess_run.assert_called_once_with(
-      "zfs snapshot data/test@20200515121020",
-      stdout=None,
-      check=True,
-      shell=True,
-      env=None
-    )
+    self.assertEqual(run_sync.call_args_list, [self.execute_call("zfs snapshot data/test@20200515121020")])
 
-  @patch("subprocess.run")
-  def test_snapshot_dryrun(self, subprocess_run):
+  @patch("zfs2cloud.execution.run_sync")
+  def test_snapshot_dryrun(self, run_sync):
     with self.config(self.config_data) as c:
       s = Snapshot(c, self.default_args(dry_run=True))
       s.run()
 
-    subprocess_run.assert_not_called()
+    run_sync.assert_not_called()
 
   @patch("zfs2cloud.snapshot.datetime")
   @patch.object(PruneSnapshots, "_discover_snapshots")
-  @patch("subprocess.run")
-  def test_prune_snapshots(self, subprocess_run, discover_snapshots, datetime_mock):
+  @patch("zfs2cloud.execution.run_sync")
+  def test_prune_snapshots(self, run_sync, discover_snapshots, datetime_mock):
     mocked_now = datetime.datetime(2020, 5, 15, 12, 10, 20)
     self.datetime_mock_now(datetime_mock, mocked_now)
     mocked_snapshots = []
-    expected_subprocess_calls = []
+    expired = []
 
     for i in range(self.oldest_snapshot_days + 30):
       creation_time = mocked_now - datetime.timedelta(days=i, minutes=2)
@@ -68,29 +65,184 @@ class SnapshotTest(Zfs2CloudTestCase):
       mocked_snapshots.append((name, creation_time))
 
       if i >= self.oldest_snapshot_days:  # We need >= because the creation time is n days + 2 seconds ago.
-        expected_subprocess_calls.append(call(
-          "zfs destroy {}".format(name), stdout=None, check=True, shell=True, env=None
-        ))
+        expired.insert(0, creation_time.strftime("%Y%m%d%H%M%S"))
 
     discover_snapshots.return_value = mocked_snapshots
+    self.mock_reclaim(run_sync)
+
+    # All expired snapshots are destroyed at once, oldest first.
+    estimate_call = self.execute_call("zfs destroy -nvp data/test@{}".format(",".join(expired)), capture=True)
+    destroy_call = self.execute_call("zfs destroy data/test@{}".format(",".join(expired)))
 
     with self.config(self.config_data) as c:
       s = PruneSnapshots(c, self.default_args(dry_run=True, yes=False))
       s.run()
 
-      subprocess_run.assert_not_called()
+      run_sync.assert_not_called()
+
+      s = PruneSnapshots(c, self.default_args(dry_run=True, yes=True))
+      s.run()
+
+      run_sync.assert_not_called()
 
+      # Without --yes, only the space that would be reclaimed is reported.
       s = PruneSnapshots(c, self.default_args(dry_run=False, yes=False))
       s.run()
 
-      subprocess_run.assert_not_called()
+      self.assertEqual(run_sync.call_args_list, [estimate_call])
+      run_sync.reset_mock()
 
-      s = PruneSnapshots(c, self.default_args(dry_run=True, yes=True))
+      s = PruneSnapshots(c, self.default_args(dry_run=False, yes=True))
       s.run()
 
-      subprocess_run.assert_not_called()
+      self.assertEqual(run_sync.call_args_list, [estimate_call, destroy_call])
+
+  def mock_reclaim(self, run_sync):
+    def run(argv, **kwargs):
+      stdout = b"destroy\tdata/test@x\nreclaim\t4096\n" if "-nvp" in argv else None
+      return self.command_result(argv, stdout=stdout)
+
+    run_sync.side_effect = run
 
+  @patch.object(PruneSnapshots, "BATCH_SIZE", 2)
+  @patch("zfs2cloud.snapshot.datetime")
+  @patch.object(PruneSnapshots, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_prune_snapshots_in_batches(self, run_sync, discover_snapshots, datetime_mock):
+    mocked_now = datetime.datetime(2020, 5, 15, 12, 10, 20)
+    self.datetime_mock_now(datetime_mock, mocked_now)
+    old = mocked_now - datetime.timedelta(days=self.oldest_snapshot_days + 1)
+    discover_snapshots.return_value = [("data/test@{}".format(i), old) for i in "cba"]
+    self.mock_reclaim(run_sync)
+
+    with self.config(self.config_data) as c:
+      PruneSnapshots(c, self.default_args(dry_run=False, yes=True)).run()
+
+    self.assertEqual([shlex.join(args[0]) for args, _ in run_sync.call_args_list], [
+      "zfs destroy -nvp data/test@a,b",
+      "zfs destroy data/test@a,b",
+      "zfs destroy -nvp data/test@c",
+      "zfs destroy data/test@c",
+    ])
+
+  @patch("zfs2cloud.snapshot.datetime")
+  @patch.object(PruneSnapshots, "_discover_bookmarks")
+  @patch.object(PruneSnapshots, "_discover_snapshots")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_prune_snapshots_with_bookmarks(self, run_sync, discover_snapshots, discover_bookmarks, datetime_mock):
+    mocked_now = datetime.datetime(2020, 5, 15, 12, 10, 20)
+    self.datetime_mock_now(datetime_mock, mocked_now)
+    old = mocked_now - datetime.timedelta(days=self.oldest_snapshot_days + 1)
+    older = mocked_now - datetime.timedelta(days=self.oldest_snapshot_days + 2)
+
+    discover_snapshots.return_value = [
+      ("data/test@20200515121000", mocked_now),
+      ("data/test@old", old),
+      ("data/test@older", older),
+    ]
+    discover_bookmarks.return_value = [
+      ("data/test#older", older),
+      ("data/test#oldest", older),
+    ]
+
+    # The next exports are based on @older, which has a bookmark, and on @old,
+    # whose bookmark is missing.
+    self.set_last_full_backup("data/test@older", older)
+    with open(os.path.join(self.intermediate_basedir, "_last_backups"), "w") as f:
+      json.dump({"incremental": ["data/test@old", old.strftime("%Y-%m-%d %H:%M:%S")]}, f)
+
+    self.mock_reclaim(run_sync)
+    config_data = self.config_data.replace("    [backup_sequences]", "    use_bookmarks         = yes\n\n    [backup_sequences]")
+    with self.config(config_data) as c:
       s = PruneSnapshots(c, self.default_args(dry_run=False, yes=True))
       s.run()
 
-      self.assertEqual(subprocess_run.mock_calls, expected_subprocess_calls)
+    self.assertEqual(run_sync.call_args_list, [
+      self.execute_call("zfs destroy data/test#oldest"),
+      self.execute_call("zfs destroy -nvp data/test@older", capture=True),
+      self.execute_call("zfs destroy data/test@older"),
+    ])
+
+  def hooks_config(self, zfs_fs="data/a data/b", recursive="no"):
+    for hook in ["stop-app", "stop-db", "start-app", "start-db"]:
+      with open(os.path.join(self.config_dir, hook), "w"):
+        pass
+
+    return self.config_data.replace("    zfs_fs                = data/test\n", (
+      "    zfs_fs                = {}\n"
+      "    zfs_fs_recursive      = {}\n"
+      "    presnapshot_hooks     = ./stop-app ./stop-db\n"
+      "    postsnapshot_hooks    = ./start-app ./start-db\n"
+    ).format(zfs_fs, recursive))
+
+  def hooks_exiting(self, returncodes):
+    def run_all(commands, **kwargs):
+      return [self.command_result(argv, returncodes.get(os.path.basename(argv[0]), 0)) for argv in commands]
+
+    return run_all
+
+  def hooks_run(self, run_all):
+    return [os.path.basename(argv[0]) for args, _ in run_all.call_args_list for argv in args[0]]
+
+  @patch("zfs2cloud.snapshot.datetime")
+  @patch("zfs2cloud.execution.run_all")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_snapshot_takes_all_datasets_at_once_between_hooks(self, run_sync, run_all, datetime_mock):
+    self.datetime_mock_now(datetime_mock, datetime.datetime(2020, 5, 15, 12, 10, 20))
+    run_all.side_effect = self.hooks_exiting({})
+
+    with self.config(self.hooks_config()) as c:
+      Snapshot(c, self.default_args(dry_run=False)).run()
+
+    self.assertEqual(run_sync.call_args_list, [self.execute_call("zfs snapshot data/a@20200515121020 data/b@20200515121020")])
+    self.assertEqual(self.hooks_run(run_all), ["stop-app", "stop-db", "start-app", "start-db"])
+    self.assertEqual(run_all.call_args_list[0][1]["env"]["ZFS2CLOUD_SNAPSHOTS"], "data/a@20200515121020 data/b@20200515121020")
+
+    with open(os.path.join(self.intermediate_basedir, "_stats.jsonl")) as f:
+      record = json.loads(f.read())
+
+    self.assertEqual(record["step"], "snapshot-downtime")
+    self.assertEqual(record["snapshots"], ["data/a@20200515121020", "data/b@20200515121020"])
+    self.assertIsInstance(record["downtime_ms"], int)
+
+  @patch("zfs2cloud.snapshot.datetime")
+  @patch("zfs2cloud.execution.run_all")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_snapshot_recursively(self, run_sync, run_all, datetime_mock):
+    self.datetime_mock_now(datetime_mock, datetime.datetime(2020, 5, 15, 12, 10, 20))
+    run_all.side_effect = self.hooks_exiting({})
+
+    with self.config(self.hooks_config("data", "yes")) as c:
+      Snapshot(c, self.default_args(dry_run=False)).run()
+
+    self.assertEqual(run_sync.call_args_list, [self.execute_call("zfs snapshot -r data@20200515121020")])
+
+  @patch("zfs2cloud.execution.run_all")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_snapshot_runs_postsnapshot_hooks_if_presnapshot_hook_fails(self, run_sync, run_all):
+    run_all.side_effect = self.hooks_exiting({"stop-db": 1})
+
+    with self.config(self.hooks_config()) as c:
+      with self.assertRaises(RuntimeError) as r:
+        Snapshot(c, self.default_args(dry_run=False)).run()
+
+    self.assertEqual(str(r.exception), "presnapshot hooks failed: {} (1)".format(os.path.join(self.config_dir, "stop-db")))
+    run_sync.assert_not_called()
+    self.assertEqual(self.hooks_run(run_all), ["stop-app", "stop-db", "start-app", "start-db"])
+
+  @patch("zfs2cloud.execution.run_all")
+  @patch("zfs2cloud.execution.run_sync")
+  def test_snapshot_kills_hooks_after_hook_timeout(self, run_sync, run_all):
+    def run(commands, **kwargs):
+      timed_out = [os.path.basename(argv[0]) == "stop-app" for argv in commands]
+      return [self.command_result(argv, -9 if t else 0, timed_out=t) for argv, t in zip(commands, timed_out)]
+
+    run_all.side_effect = run
+
+    with self.config(self.hooks_config().replace("    [backup_sequences]", "    hook_timeout          = 30\n\n    [backup_sequences]")) as c:
+      with self.assertRaises(RuntimeError) as r:
+        Snapshot(c, self.default_args(dry_run=False)).run()
+
+    self.assertEqual(str(r.exception), "presnapshot hooks failed: {} (timed out)".format(os.path.join(self.config_dir, "stop-app")))
+    self.assertEqual(run_all.call_args_list[0][1]["timeout"], 30.0)
+    run_sync.assert_not_called()
@@ -0,0 +1,55 @@
+import unittest
+
+from zfs2cloud.stages import StagePipeline
+
+
+class StagePipelineTest(unittest.TestCase):
+  relay = False
+
+  def run_pipeline(self, stages):
+    pipeline = StagePipeline(stages, relay=self.relay).start()
+    output = pipeline.stdout.read()
+    pipeline.wait()
+    return pipeline, output
+
+  def test_moves_data_through_every_stage(self):
+    pipeline, output = self.run_pipeline([
+      ("head", "head -c 100000 /dev/zero"),
+      ("zstd", "zstd -q -c"),
+      ("unzstd", "zstd -q -d -c"),
+    ])
+
+    self.assertEqual(pipeline.returncode, 0)
+    self.assertEqual(output, b"\0" * 100000)
+
+    head, compress, decompress = pipeline.stats
+    self.assertEqual((head.bytes_in, head.bytes_out), (None, 100000))
+    self.assertEqual(compress.bytes_in, 100000)
+    self.assertLess(compress.bytes_out, 100000)
+    self.assertEqual((decompress.bytes_in, decompress.bytes_out), (compress.bytes_out, 100000))
+    for stats in pipeline.stats:
+      self.assertIsNotNone(stats.cpu_seconds)
+      self.assertGreater(stats.wall_seconds, 0)
+
+  def test_returns_the_last_failure_like_pipefail(self):
+    pipeline, output = self.run_pipeline([
+      ("fails", "echo hello; exit 3"),
+      ("cat", "cat"),
+    ])
+
+    self.assertEqual(pipeline.returncode, 3)
+    self.assertEqual(output, b"hello\n")
+
+  def test_measures_time_blocked_on_the_next_stage(self):
+    pipeline, output = self.run_pipeline([
+      ("head", "head -c 10000000 /dev/zero"),
+      ("slow", "sleep 1; cat"),
+    ])
+
+    self.assertEqual(len(output), 10000000)
+    self.assertGreater(pipeline.stats[0].blocked_seconds, 0.5)
+    self.assertLess(pipeline.stats[1].blocked_seconds, 0.5)
+
+
+class RelayedStagePipelineTest(StagePipelineTest):
+  relay = True
@@ -1,7 +1,9 @@
 from argparse import Namespace
 from contextlib import contextmanager
 from datetime import datetime
+from unittest.mock import call
 import os
+import shlex
 import shutil
 import json
 import tempfile
@@ -9,6 +11,7 @@ import textwrap
 import unittest
 
 from zfs2cloud.config import Config
+from zfs2cloud.execution import CommandResult
 
 
 class Zfs2CloudTestCase(unittest.TestCase):
@@ -52,3 +55,17 @@ class Zfs2CloudTestCase(unittest.TestCase):
     creation_date = creation_date.strftime("%Y-%m-%d %H:%M:%S")
     with open(os.path.join(self.intermediate_basedir, "_last_full_backup"), "w") as f:
       json.dump([snapshot_name, creation_date], f)
+
+  def command_result(self, argv, returncode=0, stdout=None, timed_out=False):
+    result = CommandResult(argv)
+    result.returncode = returncode
+    result.stdout = stdout
+    result.timed_out = timed_out
+    return result
+
+  def execute_call(self, cmd, capture=False, env=None, input=None, timeout=None):
+    """The execution.run_sync call with which Command._execute runs the command line cmd."""
+    return call(shlex.split(cmd), input=input, capture=capture, env=env, timeout=timeout)
+
+  def rclone_env(self):
+    return dict(os.environ, RCLONE_CONFIG=self.rclone_path)
@@ -8,7 +8,7 @@ from .snapshot import Snapshot, PruneSnapshots
 from .intermediate import ExportIntermediate, PruneIntermediate, UploadIntermediateToRemote
 from .perform import Perform
 from .restore import Restore
-from .file_mode import MountSnapshot, UploadSnapshotFilesToRemote, UmountSnapshot
+from .file_mode import MountSnapshot, UploadSnapshotFilesToRemote, UmountSnapshot, VerifySnapshotFiles, RestoreFile
 
 commands = {
   "show-config": ShowConfig,
@@ -23,8 +23,10 @@ commands = {
   "mount-snapshot": MountSnapshot,
   "upload-snapshot-files-to-remote": UploadSnapshotFilesToRemote,
   "umount-snapshot": UmountSnapshot,
+  "verify-snapshot-files": VerifySnapshotFiles,
   "perform": Perform,
   "restore": Restore,
+  "restore-file": RestoreFile,
 }
 
 
@@ -0,0 +1,138 @@
+"""
+Reads the bandwidth limits of rclone_bwlimit and, with the rcd backend, keeps
+the limit of the running rcd in line with them, backing off while a latency
+probe shows the network is busy.
+"""
+from datetime import datetime
+import logging
+import re
+import socket
+import threading
+import time
+
+
+UNITS = {"B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4, "P": 1024 ** 5}
+
+
+def parse_rate(value):
+  """Parses an rclone bandwidth like 2.5M (in bytes per second, KiB without a suffix). off is None."""
+  if value == "off":
+    return None
+
+  match = re.fullmatch(r"(\d+(?:\.\d+)?)([BKMGTP]?)", value, re.IGNORECASE)
+  if match is None:
+    raise ValueError("invalid bandwidth: {}".format(value))
+
+  return int(float(match.group(1)) * UNITS[(match.group(2) or "K").upper()])
+
+
+def format_rate(rate):
+  return "off" if rate is None else "{}K".format(max(1, rate // 1024))
+
+
+def parse_timetable(value):
+  """
+  Parses rclone_bwlimit, either a single bandwidth or a timetable like
+  "00:00,off 07:00,2.5M" in rclone's --bwlimit syntax. Returns [(minute of
+  the day, rate)] sorted by time; a single bandwidth starts at minute 0.
+  """
+  entries = value.split()
+  if len(entries) == 1 and "," not in entries[0]:
+    return [(0, parse_rate(entries[0]))]
+
+  timetable = []
+  for entry in entries:
+    match = re.fullmatch(r"(\d\d):(\d\d),(\S+)", entry)
+    if match is None or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+      raise ValueError("invalid bandwidth timetable entry: {} (expected HH:MM,bandwidth)".format(entry))
+
+    timetable.append((int(match.group(1)) * 60 + int(match.group(2)), parse_rate(match.group(3))))
+
+  return sorted(timetable)
+
+
+def scheduled_rate(timetable, now):
+  """The rate of the timetable at the datetime now; the last entry carries over midnight."""
+  minute = now.hour * 60 + now.minute
+  rate = timetable[-1][1]
+  for start, entry_rate in timetable:
+    if start <= minute:
+      rate = entry_rate
+
+  return rate
+
+
+def probe_latency(address, timeout=2.0):
+  """Returns the seconds a TCP connection to host:port takes, or None if it fails."""
+  host, _, port = address.rpartition(":")
+  started = time.monotonic()
+  try:
+    with socket.create_connection((host, int(port)), timeout=timeout):
+      return time.monotonic() - started
+  except OSError:
+    return None
+
+
+class BandwidthGovernor(object):
+  """
+  Sets the bandwidth limit of an rclone rcd to what the timetable says, at
+  most every interval seconds while transfers run. With a probe, the limit is
+  halved (down to min_rate) whenever connecting to the probe address takes
+  longer than max_latency, and doubled again once it is back under half of
+  that, until the timetable is in charge again.
+  """
+
+  def __init__(self, timetable, probe=None, max_latency=0.05, min_rate=1024 ** 2, interval=10):
+    self.logger = logging.getLogger(self.__class__.__name__)
+    self.timetable = timetable
+    self.probe = probe
+    self.max_latency = max_latency
+    self.min_rate = min_rate
+    self.interval = interval
+
+    # The lower limit while backing off, and the rate it started from.
+    self.cap = None
+    self.ceiling = None
+
+    self._lock = threading.Lock()
+    self._checked = None
+    self._applied = False
+    self._rate = None
+
+  def tick(self, client, now=None):
+    """Called while transfers run."""
+    with self._lock:
+      if self._checked is not None and time.monotonic() - self._checked < self.interval:
+        return
+
+      self._checked = time.monotonic()
+      scheduled = scheduled_rate(self.timetable, now or datetime.now()) if self.timetable else None
+      if self.probe:
+        self._adjust(client, scheduled)
+
+      rate = scheduled if self.cap is None else min(self.cap, scheduled or self.cap)
+      if not self._applied or rate != self._rate:
+        self.logger.info("limiting uploads to {}".format(format_rate(rate)))
+        client.call("core/bwlimit", rate=format_rate(rate))
+        self._applied = True
+        self._rate = rate
+
+  def _adjust(self, client, scheduled):
+    latency = probe_latency(self.probe)
+    if latency is None or latency > self.max_latency:
+      # Without a limit, back off from the speed the transfers reach now.
+      current = self.cap or scheduled or int(client.call("core/stats").get("speed", 0))
+      if current:
+        if self.cap is None:
+          self.ceiling = current
+
+        self.cap = max(self.min_rate, current // 2)
+        self.logger.info("{} took {}, backing off to {}".format(
+          self.probe, "too long" if latency is None else "{:.0f}ms".format(latency * 1000), format_rate(self.cap),
+        ))
+    elif self.cap is not None and latency < self.max_latency / 2:
+      self.cap *= 2
+      if self.cap >= (scheduled or self.ceiling):
+        self.cap = None
+        self.ceiling = None
+
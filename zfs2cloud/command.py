@@ -3,49 +3,85 @@ from datetime import datetime
 import json
 import logging
 import os
+import shlex
 import subprocess
+import time
 
+from . import compression, crypto, dedup, execution
 from .config import Config
+from .inventory import SnapshotInventory
 
 
 class Command(object):
+  # When zfs_fs names several datasets or is recursive, the command is run on
+  # its own for each of them. Commands that handle all of them at once turn
+  # this off.
+  per_dataset = True
+
   @classmethod
   def standalone_main(cls, args):
     config = Config(args.config, args._commands)
-    cls(config, args).run()
+    if config.is_single_dataset() or not cls.per_dataset:
+      cls(config, args).run()
+      return
+
+    # Every dataset gets its chance, the failures are reported at the end.
+    errors = []
+    for zfs_fs in cls(config, args)._discover_datasets():
+      command = cls(config.for_dataset(zfs_fs), args)
+      try:
+        command.run()
+      except Exception as e:
+        command.logger.error("{} failed: {}".format(zfs_fs, e))
+        errors.append((zfs_fs, e))
+
+    if errors:
+      raise RuntimeError("{} failed".format(", ".join(zfs_fs for zfs_fs, _ in errors))) from errors[0][1]
 
   @classmethod
   def add_arguments(cls, parser):
     pass
 
-  def __init__(self, config, args):
+  def __init__(self, config, args, inventory=None):
     self.logger = logging.getLogger(self.__class__.__name__)
     self.config = config
     self.args = args
 
-  def run(self):
-    raise NotImplementedError(self.__class__.__name__)
+    # Perform shares one inventory between its steps.
+    self._inventory = inventory
+    # CommandResults of the external commands run so far.
+    self.executed = []
 
-  def _discover_snapshots(self):
-    snapshots = []
-    data = self._execute("zfs list -H -t snapshot -o name,creation -S creation -d1 {}".format(self.config.main["zfs_fs"]), capture=True, log=False).stdout.strip()
-    if len(data) == 0:  # No snapshots
-      return []
+  @property
+  def inventory(self):
+    if self._inventory is None:
+      self._inventory = SnapshotInventory(lambda *args: self._zfs(*args, capture=True, log=False), self.config.main["zfs_fs"])
 
-    data = data.split("\n")
+    return self._inventory
 
-    for line in data:
-      line = line.split("\t")
-      if len(line) != 2:
-        raise RuntimeError("zfs command should have returned two columns?")
+  def run(self):
+    raise NotImplementedError(self.__class__.__name__)
 
-      name = line[0]
-      creation = line[1]
+  def _discover_snapshots(self):
+    return self.inventory.snapshots()
+
+  def _discover_bookmarks(self):
+    return self.inventory.bookmarks()
+
+  def _discover_datasets(self):
+    """The datasets in zfs_fs, and their children with zfs_fs_recursive."""
+    datasets = []
+    for zfs_fs in self.config.datasets:
+      if self.config.main.getboolean("zfs_fs_recursive"):
+        output = self._zfs("list", "-H", "-o", "name", "-r", "-t", "filesystem,volume", zfs_fs, capture=True, log=False).stdout
+        names = output.split()
+      else:
+        names = [zfs_fs]
 
-      creation = datetime.strptime(creation, "%a %b %d %H:%M %Y")
-      snapshots.append((name, creation))
+      datasets.extend(name for name in names if name not in datasets)
 
-    return snapshots
+    self.config.check_folder_names(datasets)
+    return datasets
 
   def _get_last_full_backup_from_cache_file(self):
     if os.path.exists(self.config.last_full_cache_file):
@@ -57,25 +93,130 @@ class Command(object):
     else:
       return (None, None)
 
+  def _get_last_backups_from_cache_file(self):
+    """
+    Returns {level: (snapshot_name, creation)} for the incremental levels
+    exported since the last full backup.
+    """
+    if not os.path.exists(self.config.last_backups_cache_file):
+      return {}
+
+    with open(self.config.last_backups_cache_file) as f:
+      data = json.load(f)
+
+    return {level: (name, datetime.strptime(creation, "%Y-%m-%d %H:%M:%S")) for level, (name, creation) in data.items()}
+
+  @staticmethod
+  def _bookmark_name(snapshot):
+    return snapshot.replace("@", "#", 1)
+
+  def _create_bookmark(self, snapshot):
+    bookmark = self._bookmark_name(snapshot)
+    if bookmark in set(name for name, _ in self._discover_bookmarks()):
+      self.logger.debug("{} already exists".format(bookmark))
+      return
+
+    self._zfs("bookmark", snapshot, bookmark, dry_run=self.args.dry_run)
+    if not self.args.dry_run:
+      # A bookmark has the creation time of its snapshot.
+      creation = dict(self._discover_snapshots()).get(snapshot, datetime.now())
+      self.inventory.add(bookmark, creation)
+
+  def _backup_bases(self):
+    """The snapshots recorded as bases for the next exports."""
+    bases = set(name for name, _ in self._get_last_backups_from_cache_file().values())
+    last_full_backup_name, _ = self._get_last_full_backup_from_cache_file()
+    if last_full_backup_name is not None:
+      bases.add(last_full_backup_name)
+
+    return bases
+
   def _intermediate_folder_file_name(self, snapshot_name, full):
     folder_name = snapshot_name.split("@")[1]
     if full:
       folder_name += "-full"
 
-    return folder_name, snapshot_name.replace("/", "-") + ".zfs.gpg."
+    extension = compression.EXTENSIONS[self.config.main["compression"]]
+    if self.config.main.getboolean("dedup"):
+      extension += "." + dedup.EXTENSION
 
-  def _execute(self, cmd, env=None, capture=False, raises=True, encoding="utf-8", log=True, dry_run=False):
+    extension += "." + crypto.EXTENSIONS[self.config.main["encryption"]]
+    return folder_name, snapshot_name.replace("/", "-") + ".zfs{}.".format(extension)
+
+  def _execute(self, argv, env=None, capture=False, raises=True, encoding="utf-8", log=True, input=None, timeout=None, dry_run=False):
+    """
+    Runs the argv list for at most timeout seconds and returns its
+    CommandResult, with decoded stdout if captured.
+    """
     if log:
-      self.logger.info("+ {}".format(cmd))
+      self.logger.info("+ {}".format(shlex.join(argv)))
 
     if not dry_run:
-      stdout = subprocess.PIPE if capture else None
-      status = subprocess.run(cmd, stdout=stdout, check=raises, shell=True, env=env)
+      result = execution.run_sync(argv, input=input, capture=capture, env=env, timeout=timeout)
+      self._record(result)
+
+      # encoding=None keeps the output as bytes.
+      if capture and encoding is not None and result.stdout is not None:
+        result.stdout = result.stdout.decode(encoding)
 
-      if capture:
-        status.stdout = status.stdout.decode(encoding)
+      if raises:
+        result.check()
 
-      return status
+      return result
+
+  def _execute_shell(self, cmd, env=None, dry_run=False):
+    """Runs a command line of the config, such as a script step, with the shell."""
+    self.logger.info("+ {}".format(cmd))
+
+    if not dry_run:
+      result = execution.CommandResult(cmd)
+      started = time.monotonic()
+      try:
+        result.returncode = subprocess.run(cmd, check=True, shell=True, env=env).returncode
+      except subprocess.CalledProcessError as e:
+        result.returncode = e.returncode
+        raise
+      finally:
+        result.wall_seconds = time.monotonic() - started
+        self._record(result)
+
+      return result
+
+  def _zfs(self, *args, **kwargs):
+    """Runs zfs with args, for at most command_timeout seconds."""
+    return self._execute([self.config.zfs_path] + list(args), timeout=self.config.command_timeout, **kwargs)
+
+  def _execute_all(self, commands, capture=False, stderr=None, env=None, timeout=None, check=True, encoding="utf-8", log=True, dry_run=False):
+    """
+    Runs the argv lists in commands at the same time, each for at most timeout
+    seconds, and returns their CommandResults (with decoded stdout if
+    captured) once all of them are done.
+    """
+    if log:
+      for argv in commands:
+        self.logger.info("+ {}".format(shlex.join(argv)))
+
+    if dry_run:
+      return []
+
+    results = execution.run_all(commands, capture=capture, stderr=stderr, env=env, timeout=timeout, check=False)
+    for result in results:
+      self._record(result)
+      if capture and result.stdout is not None:
+        result.stdout = result.stdout.decode(encoding)
+
+    if check:
+      for result in results:
+        result.check()
+
+    return results
+
+  def _record(self, result):
+    self.executed.append(result)
+    if self.logger.isEnabledFor(logging.DEBUG):
+      self.logger.debug("{} exited with {} after {:.3f}s{}".format(
+        result.argv, result.returncode, result.wall_seconds, " (timed out)" if result.timed_out else "",
+      ))
 
   @contextmanager
   def chdir(self, path):
@@ -103,9 +244,13 @@ class ShowConfig(Command):
     last_full_backup = self._get_last_full_backup_from_cache_file()
     self.logger.info("Last full backup: {} at {}".format(*last_full_backup))
 
+    for level, last_backup in sorted(self._get_last_backups_from_cache_file().items()):
+      self.logger.info("Last {} backup: {} at {}".format(level, *last_backup))
+
 
 class Lock(Command):
   """Attempt to create a lock file and thus disallow other calls to perform."""
+  per_dataset = False
 
   def run(self):
     self.logger.debug("creating lock file")
@@ -121,6 +266,7 @@ class Lock(Command):
 
 class Unlock(Command):
   """Remove the lock file and thus allow other calls to perform."""
+  per_dataset = False
 
   def run(self):
     self.logger.debug("deleting lock file")
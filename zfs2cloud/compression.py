@@ -0,0 +1,115 @@
+import re
+import subprocess
+
+
+NONE = "none"
+ZSTD = "zstd"
+LZ4 = "lz4"
+
+EXTENSIONS = {
+  NONE: "",
+  ZSTD: ".zst",
+  LZ4: ".lz4",
+}
+
+LEVELS = {
+  ZSTD: (1, 22, 3),
+  LZ4: (1, 12, 1),
+}
+
+# The first lz4 whose -T compresses on several cores.
+LZ4_MIN_VERSION = (1, 10)
+
+
+def lz4_version():
+  """Returns the version of the lz4 cli as a tuple of ints, or None if it cannot be run."""
+  try:
+    output = subprocess.run(["lz4", "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True).stdout
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+  match = re.search(rb"v(\d+)\.(\d+)\.(\d+)", output)
+  return tuple(int(part) for part in match.groups()) if match else None
+
+
+def validate(algorithm, level):
+  if algorithm not in EXTENSIONS:
+    raise ValueError("compression = {} is not valid ({})".format(algorithm, set(EXTENSIONS.keys())))
+
+  if algorithm == LZ4:
+    version = lz4_version()
+    if version is None or version < LZ4_MIN_VERSION:
+      raise ValueError("compression = lz4 requires lz4 {} or later to compress on all cores (found {}), use zstd otherwise".format(
+        ".".join(str(part) for part in LZ4_MIN_VERSION), "none" if version is None else ".".join(str(part) for part in version),
+      ))
+
+  if algorithm == NONE or level == "":
+    return
+
+  try:
+    level = int(level)
+  except ValueError as e:
+    raise ValueError("compression_level must be an integer ({})".format(str(e)))
+
+  low, high, _ = LEVELS[algorithm]
+  if not low <= level <= high:
+    raise ValueError("compression_level for {} must be between {} and {}".format(algorithm, low, high))
+
+
+def compress_command(algorithm, level=""):
+  """Returns the pipeline stage that compresses stdin to stdout, or None."""
+  if algorithm == NONE:
+    return None
+
+  low, high, default = LEVELS[algorithm]
+  level = int(level) if level != "" else default
+
+  if algorithm == ZSTD:
+    # -T0 compresses blocks on all cores while keeping the output in order.
+    return "zstd -q -c -T0 {}-{}".format("--ultra " if level > 19 else "", level)
+
+  # Like zstd, lz4 -T0 compresses blocks on all cores in order.
+  return "lz4 -q -c -T0 -{}".format(level)
+
+
+def decompress_command(algorithm):
+  if algorithm == NONE:
+    return None
+
+  if algorithm == ZSTD:
+    return "zstd -q -d -c"
+
+  return "lz4 -q -d -c"
+
+
+def file_extensions(fn):
+  """
+  Returns the extensions between .zfs and the chunk number of an intermediate
+  file name, e.g. ["zst", "gpg"] for fs@snap.zfs.zst.gpg.0000, or None.
+  """
+  if ".zfs." not in fn:
+    return None
+
+  extensions = fn[fn.rindex(".zfs.") + 5:].split(".")
+  if len(extensions) < 2 or not extensions[-1].isdigit():
+    return None
+
+  return extensions[:-1]
+
+
+def detect(filenames):
+  """Detects the compression from intermediate file names like fs@snap.zfs.zst.gpg.0000."""
+  found = set()
+  for fn in filenames:
+    extensions = file_extensions(fn)
+    if extensions is None:
+      continue
+
+    for algorithm, ext in EXTENSIONS.items():
+      if "".join("." + e for e in extensions[:-1]) == ext:
+        found.add(algorithm)
+
+  if len(found) != 1:
+    raise ValueError("cannot detect the compression of the backup files: {}".format(sorted(found) or "no backup files"))
+
+  return found.pop()
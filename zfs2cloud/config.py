@@ -1,12 +1,43 @@
 from configparser import ConfigParser
 import os
 import shlex
+import threading
+
+from . import bwlimit, compression, crypto, file_index, rclone
+
+
+SIZE_SUFFIXES = {
+  "": 1,
+  "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4,
+  "KB": 1000, "MB": 1000 ** 2, "GB": 1000 ** 3, "TB": 1000 ** 4,
+}
+
+
+def parse_size(value):
+  """Parses sizes the way split --bytes does (1G = 1024^3, 1GB = 1000^3)."""
+  value = value.strip()
+  number = value.rstrip("KMGTB")
+  suffix = value[len(number):]
+  if not number.isdigit() or suffix not in SIZE_SUFFIXES:
+    raise ValueError("invalid size: {}".format(value))
+
+  return int(number) * SIZE_SUFFIXES[suffix]
 
 
 class Config(object):
   SINCE_LAST_FULL = "since_last_full"
   SINCE_LAST_INCREMENTAL = "since_last_incremental"
   NEVER_INCREMENTAL = "never_incremental"
+  TIERED = "tiered"
+
+  EXPORT_SPLIT = "split"
+  EXPORT_SPOOL = "spool"
+  EXPORT_STREAM = "stream"
+
+
+  SNAPSHOT_AUTO = "auto"
+  SNAPSHOT_SNAPDIR = "snapdir"
+  SNAPSHOT_MOUNT = "mount"
 
   def __init__(self, config_path, commands=None):
     self._commands = commands
@@ -16,12 +47,52 @@ class Config(object):
       "mode": "intermediate",
       "incremental_strategy": self.SINCE_LAST_FULL,
       "split_size": "1G",
+      "compression": compression.NONE,
+      "compression_level": "",
+      "encryption": crypto.GPG,
+      "encryption_workers": 0,
+      "dedup": "no",
+      "dedup_max_age_days": 30,
+      "export_mode": self.EXPORT_SPLIT,
+      "spool_max_bytes": "",
+      "spool_max_chunks": 4,
+      "relay_stages": "no",
+      "upload_concurrency": 2,
+      "upload_retries": 3,
+      "upload_retry_delay": 10,
+      "snapshot_access": self.SNAPSHOT_AUTO,
+      "file_index": "no",
+      "file_hash": "sha1",
+      "pack_small_files": "",
+      "pack_size": "64M",
+      "upload_shards": 1,
+      "hash_workers": 4,
       "rclone_conf": os.environ.get("RCLONE_CONFIG", os.path.join(os.path.expanduser("~"), ".rclone.conf")),
       "rclone_bwlimit": "",
       "rclone_global_flags": "",
       "rclone_args": "-v --stats=60s",
+      "rclone_backend": rclone.CLI,
+      "bwlimit_probe": "",
+      "bwlimit_probe_max_ms": 50,
+      "bwlimit_min": "1M",
+      "rclone_rc_url": "",
+      "rclone_rc_user": "",
+      "rclone_rc_pass": "",
       "oldest_snapshot_days": 120,
       "full_every_x_days": 30,
+      "differential_every_x_days": 7,
+      "full_size_ratio": "",
+      "full_postpone_size_ratio": "",
+      "full_postpone_max_days": 0,
+      "use_bookmarks": "no",
+      "zfs_fs_recursive": "no",
+      "max_concurrent_datasets": 4,
+      "max_concurrent_sends": 2,
+      "max_concurrent_uploads": 2,
+      "presnapshot_hooks": "",
+      "postsnapshot_hooks": "",
+      "hook_timeout": "",
+      "command_timeout": "",
       "on_failure": "",
     }
 
@@ -45,15 +116,79 @@ class Config(object):
     if self.main["rclone_conf"] and self.main["rclone_conf"].startswith("./"):
       self.main["rclone_conf"] = self.get_abspath_from_config_file_folder(self.main["rclone_conf"][2:])
 
+    # Scripts run in parallel right before and after the snapshot is taken.
+    self.presnapshot_hooks = []
+    self.postsnapshot_hooks = []
+    for hooks, k in [(self.presnapshot_hooks, "presnapshot_hooks"), (self.postsnapshot_hooks, "postsnapshot_hooks")]:
+      for hook in self.main[k].split():
+        if hook.startswith("./"):
+          hook = self.get_abspath_from_config_file_folder(hook[2:])
+
+        hooks.append(hook)
+
     # Generate internal variables
     self.autofill_variables()
 
     # Validate
     self.validate()
 
+    # Shared by the configs of every dataset, see for_dataset.
+    self.send_slots = threading.BoundedSemaphore(self.main.getint("max_concurrent_sends"))
+    self.upload_slots = threading.BoundedSemaphore(self.main.getint("max_concurrent_uploads"))
+    self.rclone_daemon = rclone.RcloneDaemon(self) if self.main["rclone_backend"] == rclone.RCD else None
+
   def __getattr__(self, key):
     return self.c[key]
 
+  @property
+  def datasets(self):
+    """The datasets listed in zfs_fs, which may be several separated by spaces."""
+    return self.main["zfs_fs"].split()
+
+  def is_single_dataset(self):
+    return len(self.datasets) == 1 and not self.main.getboolean("zfs_fs_recursive")
+
+  @property
+  def command_timeout(self):
+    """The seconds zfs, mount and rclone commands other than transfers may take, or None."""
+    return self.main.getfloat("command_timeout") if self.main["command_timeout"] else None
+
+  def for_dataset(self, zfs_fs):
+    """
+    Returns a copy of this config for one of several datasets backed up
+    together. Each gets its own folder in intermediate_basedir (holding its
+    lock and caches) and on the remote, named after the dataset.
+    """
+    folder_name = self.folder_name(zfs_fs)
+
+    config = Config.__new__(Config)
+    config.__dict__.update(self.__dict__)
+    config.c = ConfigParser(allow_no_value=True)
+    config.c.read_dict(self.c)
+    config.main["zfs_fs"] = zfs_fs
+    config.main["zfs_fs_recursive"] = "no"
+    config.main["intermediate_basedir"] = os.path.join(self.main["intermediate_basedir"], folder_name)
+    config.main["remote"] = "{}/{}".format(self.main["remote"], folder_name)
+
+    os.makedirs(config.main["intermediate_basedir"], exist_ok=True)
+    config.autofill_variables()
+    return config
+
+  @staticmethod
+  def folder_name(zfs_fs):
+    return zfs_fs.replace("/", "-")
+
+  def check_folder_names(self, datasets):
+    """
+    Raises if two of datasets would share a folder, as a/b-c and a-b/c
+    would.
+    """
+    seen = {}
+    for zfs_fs in datasets:
+      other = seen.setdefault(self.folder_name(zfs_fs), zfs_fs)
+      if other != zfs_fs:
+        raise ValueError("{} and {} would both be backed up to the folder {}, rename one of them".format(other, zfs_fs, self.folder_name(zfs_fs)))
+
   def get_abspath_from_config_file_folder(self, filename):
     return os.path.join(os.path.dirname(os.path.abspath(self.config_path)), filename)
 
@@ -63,6 +198,12 @@ class Config(object):
 
     self.lock_path = os.path.join(self.main["intermediate_basedir"], "_lock")
     self.last_full_cache_file = os.path.join(self.main["intermediate_basedir"], "_last_full_backup")
+    self.last_backups_cache_file = os.path.join(self.main["intermediate_basedir"], "_last_backups")
+    self.dedup_index_file = os.path.join(self.main["intermediate_basedir"], "_dedup_index")
+    self.stats_file = os.path.join(self.main["intermediate_basedir"], "_stats.jsonl")
+    self.upload_journal_file = os.path.join(self.main["intermediate_basedir"], "_upload_journal")
+    self.last_file_upload_cache_file = os.path.join(self.main["intermediate_basedir"], "_last_file_upload")
+    self.file_index_file = os.path.join(self.main["intermediate_basedir"], "_file_index")
 
   def validate(self):
     for k in ["zfs_fs", "intermediate_basedir", "remote"]:
@@ -80,10 +221,21 @@ class Config(object):
     if self.main["on_failure"] and not os.path.isfile(self.main["on_failure"]):
       raise ValueError("on_failure: {} is not a valid file".format(self.main["on_failure"]))
 
+    for k in ["presnapshot_hooks", "postsnapshot_hooks"]:
+      for hook in getattr(self, k):
+        if not os.path.isfile(hook):
+          raise ValueError("{}: {} is not a valid file".format(k, hook))
+
     if not os.path.isfile(self.main["rclone_conf"]):
       raise ValueError("rclone_conf: {} is not a valid file".format(self.main["rclone_conf"]))
 
-    if self.main.getint("oldest_snapshot_days") <= self.main.getint("full_every_x_days"):
+    try:
+      use_bookmarks = self.main.getboolean("use_bookmarks")
+    except ValueError as e:
+      raise ValueError("use_bookmarks must be a boolean ({})".format(str(e)))
+
+    # Incrementals sent from bookmarks do not need the base snapshot anymore.
+    if not use_bookmarks and self.main.getint("oldest_snapshot_days") <= self.main.getint("full_every_x_days"):
       raise ValueError("oldest_snapshot_days must be greater than full_every_x_days so that incremental backups based on the last full backup can take place")
 
     for step in self.backup_sequences:
@@ -97,14 +249,129 @@ class Config(object):
           if command not in commands:
             raise ValueError("{} is not a valid step ({})".format(step, commands))
 
-    for k in ["full_every_x_days", "oldest_snapshot_days"]:
+    for k in ["full_every_x_days", "oldest_snapshot_days", "differential_every_x_days"]:
       try:
         self.main.getint(k)
       except ValueError as e:
         raise ValueError("{} must be an integer ({})".format(k, str(e)))
 
-    if self.main["incremental_strategy"] != self.SINCE_LAST_FULL:
-      raise NotImplementedError("incremental_strategy = {} not implemented".format(self.main["incremental_strategy"]))
+    for k in ["spool_max_chunks", "upload_concurrency", "encryption_workers", "dedup_max_age_days", "full_postpone_max_days", "max_concurrent_datasets", "max_concurrent_sends", "max_concurrent_uploads", "upload_retries", "upload_retry_delay", "hash_workers", "upload_shards"]:
+      try:
+        self.main.getint(k)
+      except ValueError as e:
+        raise ValueError("{} must be an integer ({})".format(k, str(e)))
+
+    for k in ["split_size", "spool_max_bytes", "pack_small_files", "pack_size"]:
+      if self.main[k]:
+        parse_size(self.main[k])
+
+    compression.validate(self.main["compression"], self.main["compression_level"])
+
+    if self.main["encryption"] not in crypto.EXTENSIONS:
+      raise ValueError("encryption = {} is not valid ({})".format(self.main["encryption"], set(crypto.EXTENSIONS.keys())))
+
+    if self.main["encryption"] == crypto.NATIVE:
+      crypto.require()
+
+    if self.main["rclone_bwlimit"]:
+      bwlimit.parse_timetable(self.main["rclone_bwlimit"])
+
+    bwlimit.parse_rate(self.main["bwlimit_min"])
+
+    try:
+      self.main.getint("bwlimit_probe_max_ms")
+    except ValueError as e:
+      raise ValueError("bwlimit_probe_max_ms must be an integer ({})".format(str(e)))
+
+    if self.main["bwlimit_probe"]:
+      if self.main["rclone_backend"] != rclone.RCD:
+        raise ValueError("bwlimit_probe requires rclone_backend = rcd")
+
+      host, _, port = self.main["bwlimit_probe"].rpartition(":")
+      if not host or not port.isdigit():
+        raise ValueError("bwlimit_probe must be host:port")
+
+    if self.main["rclone_backend"] not in {rclone.CLI, rclone.RCD}:
+      raise ValueError("rclone_backend = {} is not valid".format(self.main["rclone_backend"]))
+
+    if self.main["export_mode"] not in {self.EXPORT_SPLIT, self.EXPORT_SPOOL, self.EXPORT_STREAM}:
+      raise ValueError("export_mode = {} is not valid".format(self.main["export_mode"]))
+
+    if self.main["snapshot_access"] not in {self.SNAPSHOT_AUTO, self.SNAPSHOT_SNAPDIR, self.SNAPSHOT_MOUNT}:
+      raise ValueError("snapshot_access = {} is not valid".format(self.main["snapshot_access"]))
+
+    for k in ["file_index", "relay_stages"]:
+      try:
+        self.main.getboolean(k)
+      except ValueError as e:
+        raise ValueError("{} must be a boolean ({})".format(k, str(e)))
+
+    # The rc API has no --combined to report on each shard with.
+    if self.main.getint("upload_shards") > 1 and self.main["rclone_backend"] != rclone.CLI:
+      raise ValueError("upload_shards requires rclone_backend = cli")
+
+    if self.main["pack_small_files"] and not self.main.getboolean("file_index"):
+      raise ValueError("pack_small_files requires file_index = yes")
+
+    if self.main["file_hash"] not in file_index.HASHES:
+      raise ValueError("file_hash = {} is not valid ({})".format(self.main["file_hash"], set(file_index.HASHES)))
+
+    try:
+      dedup = self.main.getboolean("dedup")
+    except ValueError as e:
+      raise ValueError("dedup must be a boolean ({})".format(str(e)))
+
+    if dedup:
+      if self.main["encryption"] != crypto.NATIVE:
+        raise ValueError("dedup requires encryption = native")
+
+      if self.main["compression"] != compression.NONE:
+        raise ValueError("dedup requires compression = none, as blocks cannot be found in a compressed stream")
+
+      if self.main["export_mode"] != self.EXPORT_SPLIT:
+        raise ValueError("dedup requires export_mode = split")
+
+    for k in ["full_size_ratio", "full_postpone_size_ratio", "hook_timeout", "command_timeout"]:
+      if self.main[k]:
+        try:
+          value = self.main.getfloat(k)
+        except ValueError as e:
+          raise ValueError("{} must be a number ({})".format(k, str(e)))
+
+        if value <= 0:
+          raise ValueError("{} must be greater than 0".format(k))
+
+    if self.main["full_postpone_size_ratio"]:
+      if self.main.getint("full_postpone_max_days") <= 0:
+        raise ValueError("full_postpone_size_ratio requires full_postpone_max_days")
+
+      if not use_bookmarks and self.main.getint("full_every_x_days") + self.main.getint("full_postpone_max_days") >= self.main.getint("oldest_snapshot_days"):
+        raise ValueError("full_every_x_days + full_postpone_max_days must be less than oldest_snapshot_days so that a postponed full backup is not pruned")
+
+    for k in ["upload_concurrency", "max_concurrent_datasets", "max_concurrent_sends", "max_concurrent_uploads"]:
+      if self.main.getint(k) < 1:
+        raise ValueError("{} must be at least 1".format(k))
+
+    try:
+      self.main.getboolean("zfs_fs_recursive")
+    except ValueError as e:
+      raise ValueError("zfs_fs_recursive must be a boolean ({})".format(str(e)))
+
+    if not self.datasets:
+      raise KeyError("zfs_fs must be specified in [main]")
+
+    self.check_folder_names(self.datasets)
+
+    if self.main["spool_max_bytes"] and parse_size(self.main["spool_max_bytes"]) < parse_size(self.main["split_size"]):
+      raise ValueError("spool_max_bytes must be at least split_size")
+
+    strategies = {self.SINCE_LAST_FULL, self.SINCE_LAST_INCREMENTAL, self.NEVER_INCREMENTAL, self.TIERED}
+    if self.main["incremental_strategy"] not in strategies:
+      raise ValueError("incremental_strategy = {} is not valid ({})".format(self.main["incremental_strategy"], strategies))
+
+    if self.main["incremental_strategy"] == self.TIERED:
+      if not 0 < self.main.getint("differential_every_x_days") < self.main.getint("full_every_x_days"):
+        raise ValueError("differential_every_x_days must be between 0 and full_every_x_days")
 
   def show(self, logger):
     other_info = {
@@ -112,6 +379,12 @@ class Config(object):
       "rclone_path": self.rclone_path,
       "lock_path": self.lock_path,
       "last_full_cache_file": self.last_full_cache_file,
+      "last_backups_cache_file": self.last_backups_cache_file,
+      "dedup_index_file": self.dedup_index_file,
+      "stats_file": self.stats_file,
+      "upload_journal_file": self.upload_journal_file,
+      "last_file_upload_cache_file": self.last_file_upload_cache_file,
+      "file_index_file": self.file_index_file,
       "locked": os.path.exists(self.lock_path),
     }
 
@@ -132,7 +405,7 @@ class Config(object):
   def _log_section(self, logger, section_name, section, maxl):
     logger.info("[{}]".format(section_name))
     for k, v in section.items():
-      if k == "encryption_passphrase":
+      if k in ("encryption_passphrase", "rclone_rc_pass"):
         v = "*" * len(v)
 
       logger.info("{: <{width}} = {}".format(k, v, width=maxl))
@@ -0,0 +1,265 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import multiprocessing
+import os
+import struct
+
+from . import compression
+from .pipeline import read_full
+
+try:
+  from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:  # Only needed for encryption = native
+  AESGCM = None
+
+
+GPG = "gpg"
+NATIVE = "native"
+
+EXTENSIONS = {
+  GPG: "gpg",
+  NATIVE: "aead",
+}
+
+MAGIC = b"Z2CAEAD1"
+# magic, kdf salt, stream id, chunk index, nonce prefix
+HEADER = struct.Struct("<8s16s16sI8s")
+# ciphertext length, flags
+RECORD = struct.Struct("<IB")
+# segment index, flags; appended to the header to form the associated data
+SEGMENT_AAD = struct.Struct("<IB")
+
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+END_OF_CHUNK = 1
+END_OF_STREAM = 2
+
+
+class IntegrityError(ValueError):
+  pass
+
+
+def require():
+  if AESGCM is None:
+    raise RuntimeError("encryption = native requires the cryptography package (pip install zfs2cloud[native])")
+
+
+def derive_key(passphrase, salt):
+  return hashlib.scrypt(passphrase.encode("utf-8"), salt=salt, n=2 ** 15, r=8, p=1, maxmem=2 ** 26, dklen=32)
+
+
+def detect(filenames):
+  """Detects the encryption from intermediate file names like fs@snap.zfs.aead.0000."""
+  found = set()
+  for fn in filenames:
+    extensions = compression.file_extensions(fn)
+    if extensions is None:
+      continue
+
+    for encryption, ext in EXTENSIONS.items():
+      if extensions[-1] == ext:
+        found.add(encryption)
+
+  if len(found) != 1:
+    raise ValueError("cannot detect the encryption of the backup files: {}".format(sorted(found) or "no backup files"))
+
+  return found.pop()
+
+
+_worker_aead = None
+
+
+def _init_worker(key):
+  global _worker_aead
+  _worker_aead = AESGCM(key)
+
+
+def _encrypt(nonce, data, aad):
+  return _worker_aead.encrypt(nonce, data, aad)
+
+
+def _decrypt(nonce, data, aad):
+  return _worker_aead.decrypt(nonce, data, aad)
+
+
+class ChunkCipher(object):
+  """
+  Encrypts a stream into chunks that can each be decrypted on their own.
+
+  Every chunk starts with a header holding the scrypt salt, a random stream id,
+  the chunk index and a random nonce prefix. It is followed by records of
+  AES-256-GCM sealed segments. The header, the segment index and the flags are
+  authenticated with every segment, so reordered, truncated, tampered or mixed
+  up chunks fail to decrypt. Segments are sealed by a pool of worker processes.
+  """
+
+  def __init__(self, passphrase, salt=None, stream_id=None, workers=0):
+    require()
+    self.salt = salt or os.urandom(16)
+    self.stream_id = stream_id or os.urandom(16)
+    self.key = derive_key(passphrase, self.salt)
+    self.workers = workers or os.cpu_count() or 1
+    # chunk index -> sha256 and size of the plaintext, filled in as chunks are read
+    self.plaintext_sha256 = {}
+    self.plaintext_size = {}
+    self._pool = None
+
+  @classmethod
+  def for_chunk(cls, passphrase, path, workers=0):
+    with open(path, "rb") as f:
+      _, salt, stream_id, _, _ = cls._parse_header(path, f.read(HEADER.size))
+
+    return cls(passphrase, salt=salt, stream_id=stream_id, workers=workers)
+
+  def __enter__(self):
+    # spawn rather than fork, as the export also runs uploader threads.
+    self._pool = ProcessPoolExecutor(
+      self.workers,
+      mp_context=multiprocessing.get_context("spawn"),
+      initializer=_init_worker,
+      initargs=(self.key,),
+    )
+    return self
+
+  def __exit__(self, *exc):
+    self._pool.shutdown(cancel_futures=True)
+    self._pool = None
+
+  def encrypt(self, stream, split_size, first_chunk=0):
+    """
+    Yields (chunk_index, data) pieces in order. Each chunk holds split_size bytes
+    of the stream. first_chunk is used to continue an interrupted export.
+    """
+    window = deque()
+    header = None
+    for chunk_index, segment_index, data, flags in self._segments(stream, split_size, first_chunk):
+      if segment_index == 0:
+        header = HEADER.pack(MAGIC, self.salt, self.stream_id, chunk_index, os.urandom(8))
+        window.append((chunk_index, header))
+
+      nonce = header[-8:] + struct.pack(">I", segment_index)
+      aad = header + SEGMENT_AAD.pack(segment_index, flags)
+      window.append((chunk_index, (flags, self._pool.submit(_encrypt, nonce, data, aad))))
+
+      while len(window) > self.workers * 2:
+        yield from self._encrypted_pieces(window.popleft())
+
+    while window:
+      yield from self._encrypted_pieces(window.popleft())
+
+  def decrypt(self, paths):
+    """
+    Yields the plaintext of the chunk files in order. Raises IntegrityError if a
+    chunk is missing, out of order, from another stream, or modified.
+    """
+    if len(paths) == 0:
+      raise IntegrityError("no chunks to decrypt")
+
+    window = deque()
+    end_of_stream = False
+    for expected_index, path in enumerate(paths):
+      if end_of_stream:
+        raise IntegrityError("{} comes after the end of the stream".format(path))
+
+      with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+        _, salt, stream_id, chunk_index, nonce_prefix = self._parse_header(path, header)
+        if salt != self.salt or stream_id != self.stream_id:
+          raise IntegrityError("{} belongs to a different backup".format(path))
+
+        if chunk_index != expected_index:
+          raise IntegrityError("{} is chunk {} but expected chunk {}: chunks are missing or out of order".format(path, chunk_index, expected_index))
+
+        segment_index = 0
+        flags = 0
+        while not flags & END_OF_CHUNK:
+          record = f.read(RECORD.size)
+          if len(record) < RECORD.size:
+            raise IntegrityError("{} is truncated".format(path))
+
+          length, flags = RECORD.unpack(record)
+          data = read_full(f, length)
+          if len(data) < length:
+            raise IntegrityError("{} is truncated".format(path))
+
+          nonce = nonce_prefix + struct.pack(">I", segment_index)
+          aad = header + SEGMENT_AAD.pack(segment_index, flags)
+          window.append((path, segment_index, self._pool.submit(_decrypt, nonce, data, aad)))
+          segment_index += 1
+
+          while len(window) > self.workers * 2:
+            yield self._decrypted(*window.popleft())
+
+        if f.read(1):
+          raise IntegrityError("{} has trailing data".format(path))
+
+        end_of_stream = bool(flags & END_OF_STREAM)
+
+    while window:
+      yield self._decrypted(*window.popleft())
+
+    if not end_of_stream:
+      raise IntegrityError("missing chunks after {}".format(paths[-1]))
+
+  @staticmethod
+  def _parse_header(path, header):
+    if len(header) < HEADER.size or not header.startswith(MAGIC):
+      raise IntegrityError("{} is not a natively encrypted chunk".format(path))
+
+    return HEADER.unpack(header)
+
+  def _segments(self, stream, split_size, first_chunk):
+    chunk_index = first_chunk
+    segment_index = 0
+    size = 0
+    sha256 = hashlib.sha256()
+    data = read_full(stream, min(SEGMENT_SIZE, split_size))
+    while True:
+      size += len(data)
+      sha256.update(data)
+      end_of_chunk = size >= split_size
+      next_data = read_full(stream, min(SEGMENT_SIZE, split_size if end_of_chunk else split_size - size))
+
+      if not next_data:
+        flags = END_OF_CHUNK | END_OF_STREAM
+      elif end_of_chunk:
+        flags = END_OF_CHUNK
+      else:
+        flags = 0
+
+      if flags & END_OF_CHUNK:
+        self.plaintext_sha256[chunk_index] = sha256.hexdigest()
+        self.plaintext_size[chunk_index] = size
+        sha256 = hashlib.sha256()
+
+      yield chunk_index, segment_index, data, flags
+
+      if not next_data:
+        return
+
+      if end_of_chunk:
+        chunk_index += 1
+        segment_index = 0
+        size = 0
+      else:
+        segment_index += 1
+
+      data = next_data
+
+  def _encrypted_pieces(self, entry):
+    chunk_index, item = entry
+    if isinstance(item, bytes):
+      yield chunk_index, item
+      return
+
+    flags, future = item
+    data = future.result()
+    yield chunk_index, RECORD.pack(len(data), flags)
+    yield chunk_index, data
+
+  def _decrypted(self, path, segment_index, future):
+    try:
+      return future.result()
+    except Exception as e:
+      raise IntegrityError("{} failed authentication at segment {}".format(path, segment_index)) from e
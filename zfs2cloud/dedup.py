@@ -0,0 +1,359 @@
+import hashlib
+import hmac
+import os
+import sqlite3
+import struct
+
+from . import compression, crypto, sendstream
+from .pipeline import READ_SIZE, chunk_name
+
+
+EXTENSION = "dedup"
+
+PACK_MAGIC = b"Z2CPACK1"
+# magic, kdf salt
+PACK_HEADER = struct.Struct("<8s16s")
+NONCE_SIZE = 12
+
+# A recipe is a sequence of operations that rebuild the send stream.
+LITERAL = b"L"  # length, followed by the bytes themselves
+PACK = b"P"  # length, followed by the pack path relative to intermediate_basedir
+REF = b"R"  # the block at an offset of a pack
+END = b"E"  # the sha256 of the whole stream
+
+LITERAL_ENTRY = struct.Struct("<I")
+PACK_ENTRY = struct.Struct("<H")
+# pack number, offset, length, block id
+REF_ENTRY = struct.Struct("<IQI32s")
+
+
+def is_recipe(filenames):
+  """Checks for intermediate file names like fs@snap.zfs.dedup.aead.0000."""
+  for fn in filenames:
+    extensions = compression.file_extensions(fn)
+    if extensions is not None and extensions[:-1] == [EXTENSION]:
+      return True
+
+  return False
+
+
+def _keys(passphrase, salt):
+  key = crypto.derive_key(passphrase, salt)
+  return crypto.AESGCM(key), hmac.new(key, b"zfs2cloud block id", hashlib.sha256).digest()
+
+
+class _Reader(object):
+  """Reads from an iterable of bytes like from a file."""
+
+  def __init__(self, pieces):
+    self._pieces = iter(pieces)
+    self._buffer = bytearray()
+
+  def read(self, n):
+    while len(self._buffer) < n:
+      piece = next(self._pieces, None)
+      if piece is None:
+        break
+
+      self._buffer += piece
+
+    data = bytes(self._buffer[:n])
+    del self._buffer[:n]
+    return data
+
+
+class BlockIndex(object):
+  """
+  Records where the blocks of deduplicated exports are stored and when the
+  folder holding them was uploaded. A block is only reused once it is on the
+  remote, and only for as long as the remote is expected to keep it.
+  """
+
+  def __init__(self, path):
+    self.db = sqlite3.connect(path)
+    self.db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+    self.db.execute(
+      "CREATE TABLE IF NOT EXISTS blocks ("
+      "id BLOB PRIMARY KEY, folder TEXT NOT NULL, pack TEXT NOT NULL, "
+      "offset INTEGER NOT NULL, length INTEGER NOT NULL, uploaded_at INTEGER)"
+    )
+    self.db.execute("CREATE INDEX IF NOT EXISTS blocks_folder ON blocks (folder)")
+    self.db.commit()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self):
+    self.db.close()
+
+  def commit(self):
+    self.db.commit()
+
+  def salt(self):
+    """The scrypt salt of every pack, created with the index."""
+    row = self.db.execute("SELECT value FROM settings WHERE key = 'salt'").fetchone()
+    if row is None:
+      salt = os.urandom(16)
+      self.db.execute("INSERT INTO settings (key, value) VALUES ('salt', ?)", (salt,))
+      self.db.commit()
+      return salt
+
+    return bytes(row[0])
+
+  def find(self, block_id, folder, uploaded_since):
+    """
+    Returns (folder, pack, offset, length) of a block stored in folder, or of
+    one uploaded at or after the uploaded_since timestamp. Otherwise None.
+    """
+    return self.db.execute(
+      "SELECT folder, pack, offset, length FROM blocks WHERE id = ? AND (folder = ? OR uploaded_at >= ?)",
+      (block_id, folder, uploaded_since),
+    ).fetchone()
+
+  def add(self, block_id, folder, pack, offset, length):
+    self.db.execute(
+      "INSERT OR REPLACE INTO blocks (id, folder, pack, offset, length, uploaded_at) VALUES (?, ?, ?, ?, ?, NULL)",
+      (block_id, folder, pack, offset, length),
+    )
+
+  def forget_folder(self, folder):
+    self.db.execute("DELETE FROM blocks WHERE folder = ?", (folder,))
+    self.db.commit()
+
+  def mark_uploaded(self, folder, timestamp):
+    count = self.db.execute("UPDATE blocks SET uploaded_at = ? WHERE folder = ?", (int(timestamp), folder)).rowcount
+    self.db.commit()
+    return count
+
+
+class BlockStore(object):
+  """
+  Turns a zfs send stream into a recipe. The payload of every WRITE record is
+  a block: blocks the index already knows are referred to, the others are
+  encrypted into packs of about pack_size bytes in folder. Everything else,
+  mostly record headers, is kept in the recipe itself.
+
+  Blocks uploaded before the uploaded_since timestamp are stored again rather
+  than referred to, as the remote may have deleted them by now.
+  """
+
+  def __init__(self, index, passphrase, folder, pack_prefix, pack_size, uploaded_since):
+    self.index = index
+    self.uploaded_since = uploaded_since
+    self.folder = folder
+    self.folder_name = os.path.basename(folder)
+    self.pack_prefix = pack_prefix
+    self.pack_size = pack_size
+
+    self.salt = index.salt()
+    self._aead, self._id_key = _keys(passphrase, self.salt)
+
+    # (name, size, sha256) of the packs written so far
+    self.packs = []
+    self.stored_bytes = 0
+    self.reused_bytes = 0
+
+    self._pack = None
+    self._pack_name = None
+    self._pack_bytes = 0
+    self._pack_sha256 = None
+    self._pack_numbers = {}
+
+    # Packs of an earlier attempt at this export are gone.
+    self.index.forget_folder(self.folder_name)
+
+  def recipe(self, stream):
+    """Returns a file like object reading the recipe of stream."""
+    return _Reader(self._recipe(stream))
+
+  def close(self):
+    self._close_pack()
+    self.index.commit()
+
+  def _recipe(self, stream):
+    sha256 = hashlib.sha256()
+    literal = []
+    literal_size = 0
+    for record_type, header, payload in sendstream.records(stream):
+      sha256.update(header)
+      sha256.update(payload)
+      literal.append(header)
+      literal_size += len(header)
+
+      if record_type == sendstream.WRITE and payload:
+        yield self._literal(literal)
+        literal = []
+        literal_size = 0
+        yield from self._block(payload)
+      elif payload:
+        literal.append(payload)
+        literal_size += len(payload)
+
+      if literal_size >= READ_SIZE:
+        yield self._literal(literal)
+        literal = []
+        literal_size = 0
+
+    if literal:
+      yield self._literal(literal)
+
+    self.close()
+    yield END + sha256.digest()
+
+  def _literal(self, pieces):
+    data = b"".join(pieces)
+    return LITERAL + LITERAL_ENTRY.pack(len(data)) + data
+
+  def _block(self, payload):
+    block_id = hmac.new(self._id_key, payload, hashlib.sha256).digest()
+    location = self.index.find(block_id, self.folder_name, self.uploaded_since)
+    if location is None:
+      location = self._store(block_id, payload)
+      self.stored_bytes += len(payload)
+    else:
+      self.reused_bytes += len(payload)
+
+    folder, pack, offset, length = location
+    path = "{}/{}".format(folder, pack)
+    if path not in self._pack_numbers:
+      self._pack_numbers[path] = len(self._pack_numbers)
+      encoded = path.encode("utf-8")
+      yield PACK + PACK_ENTRY.pack(len(encoded)) + encoded
+
+    yield REF + REF_ENTRY.pack(self._pack_numbers[path], offset, length, block_id)
+
+  def _store(self, block_id, payload):
+    if self._pack is not None and self._pack_bytes >= self.pack_size:
+      self._close_pack()
+
+    if self._pack is None:
+      self._open_pack()
+
+    nonce = os.urandom(NONCE_SIZE)
+    data = nonce + self._aead.encrypt(nonce, payload, block_id)
+    offset = self._pack_bytes
+    self._write(data)
+
+    self.index.add(block_id, self.folder_name, self._pack_name, offset, len(data))
+    return self.folder_name, self._pack_name, offset, len(data)
+
+  def _open_pack(self):
+    self._pack_name = os.path.basename(chunk_name(self.pack_prefix, len(self.packs)))
+    self._pack = open(os.path.join(self.folder, self._pack_name + ".partial"), "wb")
+    self._pack_bytes = 0
+    self._pack_sha256 = hashlib.sha256()
+    self._write(PACK_HEADER.pack(PACK_MAGIC, self.salt))
+
+  def _write(self, data):
+    self._pack.write(data)
+    self._pack_sha256.update(data)
+    self._pack_bytes += len(data)
+
+  def _close_pack(self):
+    if self._pack is None:
+      return
+
+    self._pack.flush()
+    os.fsync(self._pack.fileno())
+    self._pack.close()
+    self._pack = None
+
+    path = os.path.join(self.folder, self._pack_name)
+    os.rename(path + ".partial", path)
+    self.packs.append((self._pack_name, self._pack_bytes, self._pack_sha256.hexdigest()))
+    self.index.commit()
+
+
+class _Packs(object):
+  """Reads blocks from the packs of a deduplicated backup and its predecessors."""
+
+  def __init__(self, basedir, passphrase):
+    self.basedir = basedir
+    self.passphrase = passphrase
+    self._files = {}
+    self._aeads = {}
+
+  def read(self, path, offset, length, block_id):
+    f, aead = self._open(path)
+    f.seek(offset)
+    data = f.read(length)
+    if len(data) < length:
+      raise crypto.IntegrityError("{} is truncated".format(path))
+
+    try:
+      return aead.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], block_id)
+    except Exception as e:
+      raise crypto.IntegrityError("{} failed authentication at offset {}".format(path, offset)) from e
+
+  def close(self):
+    for f, _ in self._files.values():
+      f.close()
+
+  def _open(self, path):
+    if path not in self._files:
+      full_path = os.path.join(self.basedir, path)
+      if not os.path.exists(full_path):
+        raise ValueError("{} is needed by this backup but does not exist, download its folder next to the others".format(full_path))
+
+      f = open(full_path, "rb")
+      header = f.read(PACK_HEADER.size)
+      if len(header) < PACK_HEADER.size or not header.startswith(PACK_MAGIC):
+        f.close()
+        raise crypto.IntegrityError("{} is not a pack".format(path))
+
+      _, salt = PACK_HEADER.unpack(header)
+      if salt not in self._aeads:
+        self._aeads[salt], _ = _keys(self.passphrase, salt)
+
+      self._files[path] = (f, self._aeads[salt])
+
+    return self._files[path]
+
+
+def _unpack(reader, entry):
+  data = reader.read(entry.size)
+  if len(data) < entry.size:
+    raise crypto.IntegrityError("the recipe is truncated")
+
+  return entry.unpack(data)
+
+
+def rebuild(recipe, basedir, passphrase):
+  """
+  Yields the zfs send stream described by recipe, an iterable of bytes. Packs
+  are looked up relative to basedir, the folder holding the backup folders.
+  """
+  reader = _Reader(recipe)
+  packs = _Packs(basedir, passphrase)
+  paths = []
+  sha256 = hashlib.sha256()
+  try:
+    while True:
+      op = reader.read(1)
+      if op == LITERAL:
+        length, = _unpack(reader, LITERAL_ENTRY)
+        data = reader.read(length)
+        if len(data) < length:
+          raise crypto.IntegrityError("the recipe is truncated")
+      elif op == PACK:
+        length, = _unpack(reader, PACK_ENTRY)
+        paths.append(reader.read(length).decode("utf-8"))
+        continue
+      elif op == REF:
+        number, offset, length, block_id = _unpack(reader, REF_ENTRY)
+        data = packs.read(paths[number], offset, length, block_id)
+      elif op == END:
+        if reader.read(32) != sha256.digest():
+          raise crypto.IntegrityError("the rebuilt stream does not match the recipe")
+
+        return
+      else:
+        raise crypto.IntegrityError("the recipe is truncated or corrupted")
+
+      sha256.update(data)
+      yield data
+  finally:
+    packs.close()
@@ -0,0 +1,96 @@
+"""
+Runs external commands given as argv lists with asyncio, so that several of
+them can run at once, each with an optional timeout. Every command is timed.
+"""
+import asyncio
+import subprocess
+import time
+
+
+class CommandResult(object):
+  def __init__(self, argv):
+    self.argv = argv
+    self.returncode = None
+    self.stdout = None
+    self.wall_seconds = 0.0
+    self.timeout = None
+    self.timed_out = False
+
+  def check(self):
+    """Raises like subprocess.run(check=True) would if the command failed."""
+    if self.timed_out:
+      raise subprocess.TimeoutExpired(self.argv, self.timeout, output=self.stdout)
+
+    if self.returncode != 0:
+      raise subprocess.CalledProcessError(self.returncode, self.argv, output=self.stdout)
+
+  def to_dict(self):
+    return {
+      "argv": self.argv,
+      "returncode": self.returncode,
+      "wall_seconds": round(self.wall_seconds, 3),
+      "timed_out": self.timed_out,
+    }
+
+
+async def run(argv, input=None, capture=False, stderr=None, env=None, timeout=None):
+  """
+  Runs argv and returns its CommandResult, killing it if it takes longer than
+  timeout seconds or if the caller is cancelled. Pass subprocess.STDOUT as
+  stderr to capture both.
+  """
+  result = CommandResult(argv)
+  result.timeout = timeout
+  started = time.monotonic()
+  proc = await asyncio.create_subprocess_exec(
+    *argv,
+    stdin=subprocess.PIPE if input is not None else None,
+    stdout=subprocess.PIPE if capture else None,
+    stderr=stderr,
+    env=env,
+  )
+
+  try:
+    stdout, _ = await asyncio.wait_for(proc.communicate(input), timeout)
+  except asyncio.TimeoutError:
+    result.timed_out = True
+    await _kill(proc)
+  except asyncio.CancelledError:
+    await _kill(proc)
+    raise
+  else:
+    result.stdout = stdout
+
+  result.returncode = proc.returncode
+  result.wall_seconds = time.monotonic() - started
+  return result
+
+
+def run_sync(argv, input=None, capture=False, stderr=None, env=None, timeout=None):
+  """Runs argv like run, for callers that are not in an event loop."""
+  return asyncio.run(run(argv, input=input, capture=capture, stderr=stderr, env=env, timeout=timeout))
+
+
+async def _kill(proc):
+  if proc.returncode is None:
+    proc.kill()
+
+  await proc.wait()
+
+
+def run_all(commands, capture=False, stderr=None, env=None, timeout=None, check=True):
+  """
+  Runs the argv lists at the same time and waits for all of them, so that a
+  failing command never leaves the others running. Returns their
+  CommandResults in order. With check, the first failure is raised once all
+  of them are done.
+  """
+  async def gather():
+    return await asyncio.gather(*(run(argv, capture=capture, stderr=stderr, env=env, timeout=timeout) for argv in commands))
+
+  results = asyncio.run(gather()) if commands else []
+  if check:
+    for result in results:
+      result.check()
+
+  return results
@@ -0,0 +1,179 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import sqlite3
+import stat
+
+from .pipeline import READ_SIZE
+
+
+HASHES = ("md5", "sha1", "sha256")
+
+
+def hash_file(path, hash_type):
+  h = hashlib.new(hash_type)
+  with open(path, "rb") as f:
+    while True:
+      data = f.read(READ_SIZE)
+      if not data:
+        break
+
+      h.update(data)
+
+  return h.hexdigest()
+
+
+class FileIndex(object):
+  """
+  Records the inode, size, mtime and hash of every file of the dataset, as
+  paths relative to it, the hash each file had when it was last uploaded, and
+  for small files uploaded in a pack, where in the pack they are.
+  Snapshots keep the inode numbers of the dataset, so a file whose metadata
+  did not change since the index last saw it, in whichever snapshot, is not
+  read again.
+  """
+
+  def __init__(self, path, hash_type):
+    self.hash_type = hash_type
+    self.db = sqlite3.connect(path)
+    self.db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    self.db.execute(
+      "CREATE TABLE IF NOT EXISTS files ("
+      "path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime_ns INTEGER, hash TEXT, uploaded TEXT, "
+      "pack TEXT, pack_offset INTEGER, pack_size INTEGER)"
+    )
+    # Indexes from before packing was added
+    columns = [row[1] for row in self.db.execute("PRAGMA table_info(files)")]
+    for column, column_type in [("pack", "TEXT"), ("pack_offset", "INTEGER"), ("pack_size", "INTEGER")]:
+      if column not in columns:
+        self.db.execute("ALTER TABLE files ADD COLUMN {} {}".format(column, column_type))
+
+    # The hashes of another hash type are worthless, and so is what they say
+    # about the remote.
+    row = self.db.execute("SELECT value FROM settings WHERE key = 'hash_type'").fetchone()
+    if row is None or row[0] != hash_type:
+      self.db.execute("DELETE FROM files")
+      self.db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('hash_type', ?)", (hash_type,))
+
+    self.db.commit()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self):
+    self.db.close()
+
+  def update(self, root, paths=None, workers=4):
+    """
+    Brings the index in line with the files in root, rehashing the ones whose
+    metadata changed with workers threads. Only the given paths are looked at,
+    unless paths is None. Returns the number of files hashed.
+    """
+    if paths is None:
+      found = self._walk(root)
+      gone = [path for path, in self.db.execute("SELECT path FROM files WHERE hash IS NOT NULL") if path not in found]
+    else:
+      found = {}
+      gone = []
+      for path in paths:
+        st = self._lstat(os.path.join(root, path))
+        if st is None:
+          gone.append(path)
+        else:
+          found[path] = st
+
+    stale = []
+    for path, st in found.items():
+      row = self.db.execute("SELECT inode, size, mtime_ns, hash FROM files WHERE path = ?", (path,)).fetchone()
+      if row is None or row[3] is None or tuple(row[:3]) != (st.st_ino, st.st_size, st.st_mtime_ns):
+        stale.append((path, st))
+
+    # hashlib lets go of the GIL while hashing, so the threads read and hash
+    # in parallel.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      hashes = executor.map(lambda path: hash_file(os.path.join(root, path), self.hash_type), [path for path, _ in stale])
+      for (path, st), h in zip(stale, hashes):
+        self.db.execute(
+          "INSERT INTO files (path, inode, size, mtime_ns, hash) VALUES (?, ?, ?, ?, ?) "
+          "ON CONFLICT (path) DO UPDATE SET inode = excluded.inode, size = excluded.size, mtime_ns = excluded.mtime_ns, hash = excluded.hash",
+          (path, st.st_ino, st.st_size, st.st_mtime_ns, h),
+        )
+
+    # Files that were never uploaded can go, the others wait until they are
+    # deleted from the remote.
+    for path in gone:
+      self.db.execute("DELETE FROM files WHERE path = ? AND uploaded IS NULL", (path,))
+      self.db.execute("UPDATE files SET inode = NULL, size = NULL, mtime_ns = NULL, hash = NULL WHERE path = ?", (path,))
+
+    self.db.commit()
+    return len(stale)
+
+  def has_uploads(self):
+    return self.db.execute("SELECT 1 FROM files WHERE uploaded IS NOT NULL LIMIT 1").fetchone() is not None
+
+  def files(self):
+    return [path for path, in self.db.execute("SELECT path FROM files WHERE hash IS NOT NULL ORDER BY path")]
+
+  def pending(self):
+    """The files whose current content is not on the remote."""
+    return [path for path, _, _, _ in self.pending_entries()]
+
+  def pending_entries(self):
+    """Returns [(path, size, uploaded, pack)] of the files whose current content is not on the remote."""
+    return self.db.execute(
+      "SELECT path, size, uploaded, pack FROM files WHERE hash IS NOT NULL AND (uploaded IS NULL OR uploaded != hash) ORDER BY path"
+    ).fetchall()
+
+  def removed(self, packed=None):
+    """The files that are gone but still on the remote, only those in a pack or only the others if packed is given."""
+    condition = {None: "", True: " AND pack IS NOT NULL", False: " AND pack IS NULL"}[packed]
+    return [path for path, in self.db.execute("SELECT path FROM files WHERE hash IS NULL{} ORDER BY path".format(condition))]
+
+  def uploaded(self):
+    """Returns {path: hash} of what should be on the remote as files of their own."""
+    return dict(self.db.execute("SELECT path, uploaded FROM files WHERE uploaded IS NOT NULL AND pack IS NULL"))
+
+  def packs(self):
+    """Returns {path: (pack, offset, size)} of the files uploaded in packs."""
+    return {path: (pack, offset, size) for path, pack, offset, size in self.db.execute(
+      "SELECT path, pack, pack_offset, pack_size FROM files WHERE pack IS NOT NULL"
+    )}
+
+  def mark_uploaded(self, paths):
+    self.db.executemany("UPDATE files SET uploaded = hash, pack = NULL, pack_offset = NULL, pack_size = NULL WHERE path = ?", [(path,) for path in paths])
+    self.db.commit()
+
+  def mark_packed(self, entries):
+    """Records the files uploaded in packs, given as {path: (pack, offset, size)}."""
+    self.db.executemany(
+      "UPDATE files SET uploaded = hash, pack = ?, pack_offset = ?, pack_size = ? WHERE path = ?",
+      [(pack, offset, size, path) for path, (pack, offset, size) in entries.items()],
+    )
+    self.db.commit()
+
+  def mark_deleted(self, paths):
+    self.db.executemany("DELETE FROM files WHERE path = ? AND hash IS NULL", [(path,) for path in paths])
+    self.db.commit()
+
+  def _walk(self, root):
+    found = {}
+    for dirpath, _, filenames in os.walk(root):
+      for filename in filenames:
+        path = os.path.join(dirpath, filename)
+        st = self._lstat(path)
+        if st is not None:
+          found[os.path.relpath(path, root)] = st
+
+    return found
+
+  def _lstat(self, path):
+    """Only regular files end up on the remote, rclone skips the rest."""
+    try:
+      st = os.lstat(path)
+    except FileNotFoundError:
+      return None
+
+    return st if stat.S_ISREG(st.st_mode) else None
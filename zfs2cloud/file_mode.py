@@ -1,52 +1,109 @@
 from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
 import os
+import re
+import shutil
+import subprocess
+import tarfile
 
+from . import shards
 from .command import Command
+from .config import parse_size
+from .file_index import FileIndex
+from .rclone import Rclone, connect as connect_rclone
 
-class MountSnapshot(Command):
+
+class SnapshotFilesCommand(Command):
+  """
+  Finds the files of the newest snapshot, in <mountpoint>/.zfs/snapshot/<name>
+  when snapshot_access allows it and the dataset is mounted, otherwise where
+  mount-snapshot mounts it within intermediate_basedir.
+  """
+
+  _mountpoint_value = None
+
+  def _newest_snapshot(self, command_name):
+    snapshots = self._discover_snapshots()
+    if len(snapshots) == 0:
+      raise RuntimeError("cannot {} when there are no existing snapshots".format(command_name))
+
+    return snapshots[0][0], snapshots
+
+  def _mount_path(self, snapshot):
+    folder_name, _ = self._intermediate_folder_file_name(snapshot, True)
+    return os.path.join(self.config.main["intermediate_basedir"], folder_name)
+
+  def _snapdir_path(self, snapshot):
+    """Returns the path of snapshot in the .zfs directory of the dataset, or None if it cannot be read there."""
+    access = self.config.main["snapshot_access"]
+    if access == self.config.SNAPSHOT_MOUNT:
+      return None
+
+    mountpoint = self._mountpoint()
+    path = None
+    # Legacy and unset mountpoints have no .zfs directory to look into.
+    if os.path.isabs(mountpoint):
+      path = os.path.join(mountpoint, ".zfs", "snapshot", snapshot.split("@")[1])
+      if not os.path.isdir(path):
+        path = None
+
+    if path is None and access == self.config.SNAPSHOT_SNAPDIR:
+      raise RuntimeError("{} cannot be read in the .zfs directory of its dataset (mountpoint: {})".format(snapshot, mountpoint))
+
+    return path
+
+  def _snapshot_files_path(self, snapshot):
+    return self._snapdir_path(snapshot) or self._mount_path(snapshot)
+
+  def _mountpoint(self):
+    if self._mountpoint_value is None:
+      self._mountpoint_value = self._zfs("get", "-H", "-o", "value", "mountpoint", self.config.main["zfs_fs"], capture=True).stdout.strip()
+
+    return self._mountpoint_value
+
+
+class MountSnapshot(SnapshotFilesCommand):
   @classmethod
   def add_arguments(cls, parser: ArgumentParser):
     pass
 
   def run(self):
-    snapshots = self._discover_snapshots()
-    if len(snapshots) == 0:
-      raise RuntimeError("cannot mount-snapshot when there are no existing snapshots")
+    snapshot_to_mount, _ = self._newest_snapshot("mount-snapshot")
+    snapdir_path = self._snapdir_path(snapshot_to_mount)
+    if snapdir_path is not None:
+      self.logger.info("{} is read from {}, nothing to mount".format(snapshot_to_mount, snapdir_path))
+      return
 
-    snapshot_to_mount = snapshots[0][0]
-    snapshot_mount_path, _ = self._intermediate_folder_file_name(snapshot_to_mount, True)
-    snapshot_mount_path = os.path.join(self.config.main["intermediate_basedir"], snapshot_mount_path)
+    snapshot_mount_path = self._mount_path(snapshot_to_mount)
 
     os.umask(0o77)
-    cmd = "mkdir -p {}".format(snapshot_mount_path)
-    self._execute(cmd)
+    self._execute(["mkdir", "-p", snapshot_mount_path])
+    self._execute(["mount", "-t", "zfs", snapshot_to_mount, snapshot_mount_path], timeout=self.config.command_timeout)
 
-    cmd = "mount -t zfs {} {}".format(snapshot_to_mount, snapshot_mount_path)
-    self._execute(cmd)
 
-
-class UmountSnapshot(Command):
+class UmountSnapshot(SnapshotFilesCommand):
   @classmethod
   def add_arguments(cls, parser: ArgumentParser):
     pass
 
   def run(self):
-    snapshots = self._discover_snapshots()
-    if len(snapshots) == 0:
-      raise RuntimeError("cannot umount-snapshot when there are no existing snapshots")
+    snapshot_to_mount, _ = self._newest_snapshot("umount-snapshot")
+    snapshot_mount_path = self._mount_path(snapshot_to_mount)
 
-    snapshot_to_mount = snapshots[0][0]
-    snapshot_mount_path, _ = self._intermediate_folder_file_name(snapshot_to_mount, True)
-    snapshot_mount_path = os.path.join(self.config.main["intermediate_basedir"], snapshot_mount_path)
+    # A mount left behind while the snapshot was read through .zfs is still
+    # cleaned up.
+    snapdir_path = self._snapdir_path(snapshot_to_mount)
+    if snapdir_path is not None and not os.path.ismount(snapshot_mount_path):
+      self.logger.info("{} is read from {}, nothing to umount".format(snapshot_to_mount, snapdir_path))
+      return
 
-    cmd = "umount {}".format(snapshot_mount_path)
-    self._execute(cmd)
+    self._execute(["umount", snapshot_mount_path], timeout=self.config.command_timeout)
+    self._execute(["rmdir", snapshot_mount_path])
 
-    cmd = "rmdir {}".format(snapshot_mount_path)
-    self._execute(cmd)
 
-
-class UploadSnapshotFilesToRemote(Command):
+class UploadSnapshotFilesToRemote(SnapshotFilesCommand):
   @classmethod
   def add_arguments(cls, parser: ArgumentParser):
     pass
@@ -55,36 +112,367 @@ class UploadSnapshotFilesToRemote(Command):
     # TODO: refactor this with UploadIntermediateToRemote. They are almost
     # identical except the intermediate uploads the intermediate files into
     # subdirectories, where as this doesn't.
-    snapshots = self._discover_snapshots()
-    if len(snapshots) == 0:
-      raise RuntimeError("cannot umount-snapshot when there are no existing snapshots")
+    snapshot, snapshots = self._newest_snapshot("upload-snapshot-files-to-remote")
+    snapshot_mount_path = self._snapshot_files_path(snapshot)
 
-    snapshot = snapshots[0][0]
-    snapshot_mount_path, _ = self._intermediate_folder_file_name(snapshot, True)
-    snapshot_mount_path = os.path.join(self.config.main["intermediate_basedir"], snapshot_mount_path)
+    rclone = connect_rclone(self)
+    last_upload = self._get_last_file_upload_from_cache_file()
+    changes = None
+    if last_upload == snapshot:
+      self.logger.info("{} was uploaded already".format(snapshot))
+      changes = ([], [])
+    elif last_upload is not None and last_upload in [name for name, _ in snapshots]:
+      changes = self._changed_files(last_upload, snapshot)
+      if changes is None:
+        self.logger.info("a directory was renamed since {}, syncing everything".format(last_upload))
+    elif last_upload is not None:
+      self.logger.info("{} was uploaded last but is gone, syncing everything".format(last_upload))
 
-    command = [
-      self.config.rclone_path,
-    ]
+    if self.config.main.getboolean("file_index"):
+      self._upload_indexed(rclone, snapshot, snapshot_mount_path, changes)
+    elif changes is None:
+      self._sync_all(rclone, snapshot_mount_path)
+    else:
+      self._upload_changes(rclone, snapshot_mount_path, *changes)
 
-    rclone_global_flags = self.config.main.get("rclone_global_flags")
-    if rclone_global_flags:
-      command.append(rclone_global_flags)
+    if not self.args.dry_run:
+      with open(self.config.last_file_upload_cache_file, "w") as f:
+        json.dump([snapshot, datetime.now().strftime("%Y-%m-%d %H:%M:%S")], f)
 
-    command.append("sync")
+    # This will basically mark the remote with a timestamp, like a heartbeat
+    rclone.touch("{}/__zfs2cloud_last_updated__".format(self.config.main["remote"]), dry_run=self.args.dry_run)
 
-    rclone_args = self.config.main.get("rclone_args")
-    if rclone_args:
-      command.append(rclone_args)
+  def _get_last_file_upload_from_cache_file(self):
+    if not os.path.exists(self.config.last_file_upload_cache_file):
+      return None
 
-    command.append("{}/".format(snapshot_mount_path)) # So the content is copied
-    command.append(self.config.main["remote"])
-    command = " ".join(command)
+    with open(self.config.last_file_upload_cache_file) as f:
+      return json.load(f)[0]
 
-    env = {}
-    env["RCLONE_CONFIG"] = self.config.main["rclone_conf"]
-    self._execute(command, env=env, dry_run=self.args.dry_run)
+  def _changed_files(self, base_snapshot, snapshot):
+    """
+    Returns (uploads, deletes), the paths relative to the dataset of the
+    files added or modified between the snapshots and of those removed, as
+    told by zfs diff. zfs diff lists a renamed directory but not the files in
+    it, so that returns None and the remote has to be synced instead.
+    """
+    mountpoint = self._mountpoint()
+    output = self._zfs("diff", "-FH", base_snapshot, snapshot, capture=True, encoding="latin-1").stdout
 
-    # This will basically mark the remote with a timestamp, like a heartbeat
-    command = "rclone touch {}/__zfs2cloud_last_updated__".format(self.config.main["remote"])
-    self._execute(command, env=env, dry_run=self.args.dry_run)
+    def relative(path):
+      path = _unescape_zfs_diff(path)
+      if path != mountpoint and not path.startswith(mountpoint.rstrip("/") + "/"):
+        raise RuntimeError("zfs diff listed {} outside of the mountpoint {}".format(path, mountpoint))
+
+      return path[len(mountpoint):].lstrip("/")
+
+    uploads = set()
+    deletes = set()
+    for line in output.splitlines():
+      fields = line.split("\t")
+      if len(fields) not in (3, 4) or fields[0] not in ZFS_DIFF_CHANGES:
+        raise RuntimeError("cannot parse the output of zfs diff: {}".format(line))
+
+      change, file_type = fields[0], fields[1]
+      if change == "R" and file_type == "/":
+        return None
+
+      # Only regular files end up on the remote, rclone skips the rest.
+      if file_type != "F":
+        continue
+
+      if change == "R":
+        deletes.add(relative(fields[2]))
+        uploads.add(relative(fields[3]))
+      elif change == "-":
+        deletes.add(relative(fields[2]))
+      else:
+        uploads.add(relative(fields[2]))
+
+    # A file removed and added again is simply uploaded.
+    return sorted(uploads), sorted(deletes - uploads)
+
+  def _upload_indexed(self, rclone, snapshot, snapshot_mount_path, changes):
+    """
+    Uploads what the file index says is not on the remote. zfs diff narrows
+    down the files to look at, once the index knows all the others.
+    """
+    with FileIndex(self.config.file_index_file, self.config.main["file_hash"]) as index:
+      paths = None
+      if changes is not None and index.has_uploads():
+        paths = changes[0] + changes[1]
+
+      hashed = index.update(snapshot_mount_path, paths, workers=self.config.main.getint("hash_workers"))
+      self.logger.info("hashed {} files".format(hashed))
+
+      if self.config.main["pack_small_files"]:
+        self._upload_packed(rclone, snapshot, snapshot_mount_path, index, parse_size(self.config.main["pack_small_files"]))
+        return
+
+      if not index.has_uploads():
+        self._sync_all(rclone, snapshot_mount_path)
+        if not self.args.dry_run:
+          index.mark_uploaded(index.files())
+
+        return
+
+      uploads, deletes = index.pending(), index.removed()
+      self._upload_changes(rclone, snapshot_mount_path, uploads, deletes)
+      if not self.args.dry_run:
+        index.mark_uploaded(uploads)
+        index.mark_deleted(deletes)
+
+  def _upload_changes(self, rclone, snapshot_mount_path, uploads, deletes):
+    self.logger.info("uploading {} changed files and deleting {}".format(len(uploads), len(deletes)))
+    files_from = os.path.join(self.config.main["intermediate_basedir"], "_files_from")
+    for paths, transfer in [
+      (uploads, lambda: rclone.copy_files("{}/".format(snapshot_mount_path), self.config.main["remote"], files_from, dry_run=self.args.dry_run)),
+      (deletes, lambda: rclone.delete_files(self.config.main["remote"], files_from, dry_run=self.args.dry_run)),
+    ]:
+      if not paths:
+        continue
+
+      with open(files_from, "w") as f:
+        f.write("".join(path + "\n" for path in paths))
+
+      try:
+        transfer()
+      finally:
+        os.remove(files_from)
+
+  def _sync_all(self, rclone, snapshot_mount_path):
+    shard_count = self.config.main.getint("upload_shards")
+    if shard_count <= 1:
+      rclone.sync("{}/".format(snapshot_mount_path), self.config.main["remote"], dry_run=self.args.dry_run) # So the content is copied
+      return
+
+    self._sync_shards(rclone, snapshot_mount_path, shard_count)
+
+  def _sync_shards(self, rclone, snapshot_mount_path, shard_count):
+    """
+    Syncs the snapshot with one rclone per shard at the same time, and merges
+    what they report on each file into _upload_report in intermediate_basedir.
+    """
+    directories = shards.scan(snapshot_mount_path, shard_count)
+    planned = shards.plan(directories, shard_count)
+    # Shards other than the first that got nothing to upload would only list.
+    jobs = [i for i, subtrees in enumerate(planned) if i == 0 or subtrees]
+    self.logger.info("uploading {} files in {} shards".format(sum(files for _, files in directories.values()), len(jobs)))
+
+    shard_dir = os.path.join(self.config.main["intermediate_basedir"], "_shards")
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    os.mkdir(shard_dir)
+
+    def upload(i):
+      filter_from = os.path.join(shard_dir, "{}.filter".format(i))
+      with open(filter_from, "w") as f:
+        f.write("".join(rule + "\n" for rule in shards.filter_rules(planned, i)))
+
+      combined = os.path.join(shard_dir, "{}.combined".format(i))
+      try:
+        rclone.sync("{}/".format(snapshot_mount_path), self.config.main["remote"], filter_from, combined, dry_run=self.args.dry_run)
+      except subprocess.CalledProcessError as e:
+        self.logger.error("shard {} failed: {}".format(i, e))
+        return False
+
+      return True
+
+    try:
+      with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        succeeded = list(executor.map(upload, jobs))
+
+      report = []
+      for i in jobs:
+        combined = os.path.join(shard_dir, "{}.combined".format(i))
+        if os.path.exists(combined):
+          with open(combined, encoding="utf-8", errors="surrogateescape") as f:
+            report.extend(line for line in f.read().splitlines() if line)
+    finally:
+      shutil.rmtree(shard_dir)
+
+    # --combined marks every file with one of these.
+    counts = {symbol: 0 for symbol in "=+*-!"}
+    for line in report:
+      counts[line[0]] = counts.get(line[0], 0) + 1
+
+    self.logger.info("{} transferred, {} skipped, {} deleted, {} failed".format(
+      counts["+"] + counts["*"], counts["="], counts["-"], counts["!"],
+    ))
+
+    if not self.args.dry_run:
+      with open(os.path.join(self.config.main["intermediate_basedir"], "_upload_report"), "w", encoding="utf-8", errors="surrogateescape") as f:
+        f.write("".join(line + "\n" for line in sorted(report, key=lambda line: line[2:])))
+
+    failed = [i for i, ok in zip(jobs, succeeded) if not ok]
+    if failed:
+      raise RuntimeError("shards {} of the upload failed".format(", ".join(str(i) for i in failed)))
+
+  def _upload_packed(self, rclone, snapshot, snapshot_mount_path, index, threshold):
+    """
+    Uploads the pending files of at most threshold bytes in tar packs of
+    about pack_size bytes, and the others as they are. The pack index says
+    where in which pack every packed file is, so they can be restored one by
+    one. Packs are never rewritten, the files they hold that were changed or
+    removed since are simply left out of the pack index.
+    """
+    remote = self.config.main["remote"]
+    entries = index.pending_entries()
+    small = [path for path, size, _, _ in entries if size <= threshold]
+    large = [path for path, size, _, _ in entries if size > threshold]
+    removed = index.removed(packed=False)
+    removed_packed = index.removed(packed=True)
+    # Files that move into a pack leave their own object behind.
+    deletes = sorted(removed + [path for path, size, uploaded, pack in entries if size <= threshold and uploaded is not None and pack is None])
+
+    self.logger.info("packing {} small files".format(len(small)))
+    if self.args.dry_run:
+      return
+
+    pack_dir = os.path.join(self.config.main["intermediate_basedir"], "_packs")
+    shutil.rmtree(pack_dir, ignore_errors=True)
+    os.mkdir(pack_dir)
+    try:
+      packed = self._write_packs(snapshot_mount_path, small, pack_dir, snapshot.split("@")[1])
+      self._upload_changes(rclone, snapshot_mount_path, large, [])
+      if packed:
+        rclone.copy(pack_dir, "{}/{}".format(remote, PACKS_FOLDER))
+    finally:
+      shutil.rmtree(pack_dir)
+
+    locations = index.packs()
+    dropped = [path for path in large + removed_packed if path in locations]
+    if packed or dropped:
+      for path in dropped:
+        del locations[path]
+
+      locations.update(packed)
+      data = "".join(
+        json.dumps({"path": path, "pack": pack, "offset": offset, "size": size}) + "\n"
+        for path, (pack, offset, size) in sorted(locations.items())
+      )
+      rclone.rcat("{}/{}/{}".format(remote, PACKS_FOLDER, PACK_INDEX), data.encode("utf-8"))
+
+    self._upload_changes(rclone, snapshot_mount_path, [], deletes)
+
+    index.mark_uploaded(large)
+    index.mark_packed(packed)
+    index.mark_deleted(removed + removed_packed)
+
+  def _write_packs(self, root, paths, pack_dir, prefix):
+    """Writes paths into tar packs in pack_dir and returns {path: (pack, offset, size)}."""
+    pack_size = parse_size(self.config.main["pack_size"])
+    names = []
+    tar = None
+    try:
+      for path in paths:
+        size = os.lstat(os.path.join(root, path)).st_size
+        if tar is None or tar.offset + size > pack_size:
+          if tar is not None:
+            tar.close()
+
+          names.append("{}-{:04d}.tar".format(prefix, len(names)))
+          tar = tarfile.open(os.path.join(pack_dir, names[-1]), "w", format=tarfile.PAX_FORMAT)
+
+        tar.add(os.path.join(root, path), arcname=path, recursive=False)
+    finally:
+      if tar is not None:
+        tar.close()
+
+    # The members only know where their data starts once read back.
+    locations = {}
+    for name in names:
+      with tarfile.open(os.path.join(pack_dir, name)) as tar:
+        for member in tar:
+          locations[member.name] = (name, member.offset_data, member.size)
+
+    return locations
+
+
+class VerifySnapshotFiles(Command):
+  """Checks the hashes of the files on the remote against the file index."""
+  @classmethod
+  def add_arguments(cls, parser: ArgumentParser):
+    pass
+
+  def run(self):
+    if not self.config.main.getboolean("file_index"):
+      raise RuntimeError("verify-snapshot-files requires file_index = yes")
+
+    hash_type = self.config.main["file_hash"]
+    with FileIndex(self.config.file_index_file, hash_type) as index:
+      expected = index.uploaded()
+      packs = {"{}/{}".format(PACKS_FOLDER, pack) for pack, _, _ in index.packs().values()}
+
+    remote = connect_rclone(self).hashes(self.config.main["remote"], hash_type)
+    missing = sorted(path for path in list(expected) + list(packs) if path not in remote)
+    differing = sorted(path for path, h in expected.items() if remote.get(path) and remote[path] != h)
+    unhashed = [path for path in expected if path in remote and not remote[path]]
+
+    self.logger.info("verified {} files: {} missing, {} differ".format(len(expected), len(missing), len(differing)))
+    if unhashed:
+      self.logger.warning("the remote has no {} hash of {} files, they were only checked to exist".format(hash_type, len(unhashed)))
+
+    if missing or differing:
+      raise RuntimeError("{} files are missing from the remote and {} differ: {}".format(
+        len(missing), len(differing), ", ".join((missing + differing)[:10]),
+      ))
+
+
+class RestoreFile(Command):
+  """Restores a single file of a file mode backup from the remote."""
+  # The path only makes sense within one dataset.
+  per_dataset = False
+
+  @classmethod
+  def add_arguments(cls, parser: ArgumentParser):
+    parser.add_argument("path", help="the path of the file, relative to the dataset")
+    parser.add_argument("--output", help="where to write the file (default: its name, in the current directory)")
+
+  def run(self):
+    if not self.config.is_single_dataset():
+      raise ValueError("restore-file needs zfs_fs to be a single dataset, not {}".format(self.config.main["zfs_fs"]))
+
+    remote = self.config.main["remote"]
+    output = self.args.output or os.path.basename(self.args.path)
+    # rclone cat is only available on the command line.
+    rclone = Rclone(self)
+
+    location = None
+    if self.config.main["pack_small_files"]:
+      index = rclone.cat("{}/{}/{}".format(remote, PACKS_FOLDER, PACK_INDEX))
+      for line in index.decode("utf-8").splitlines():
+        entry = json.loads(line)
+        if entry["path"] == self.args.path:
+          location = entry
+          break
+
+    if location is None:
+      rclone.copyto("{}/{}".format(remote, self.args.path), output, dry_run=self.args.dry_run)
+      return
+
+    # Only the bytes of the file are read from the pack.
+    pack = "{}/{}/{}".format(remote, PACKS_FOLDER, location["pack"])
+    data = rclone.cat(pack, location["offset"], location["size"])
+    if len(data) != location["size"]:
+      raise RuntimeError("{} is {} bytes in {} but only {} could be read".format(self.args.path, location["size"], location["pack"], len(data)))
+
+    if not self.args.dry_run:
+      with open(output, "wb") as f:
+        f.write(data)
+
+
+# Small files are uploaded in tar packs in this folder of the remote, next to
+# the index of what they hold, a JSON object per line sorted by path.
+PACKS_FOLDER = "__zfs2cloud_packs__"
+PACK_INDEX = "index.jsonl"
+
+
+# zfs diff prints a line per changed file: the change, the file type (with
+# -F) and the path, or for renames the old and the new path.
+ZFS_DIFF_CHANGES = {"+", "-", "M", "R"}
+
+
+def _unescape_zfs_diff(path):
+  """zfs diff prints bytes other than printable ascii as a backslash and four octal digits."""
+  data = re.sub(r"\\([0-7]{4})", lambda m: chr(int(m.group(1), 8)), path)
+  return data.encode("latin-1").decode("utf-8", "surrogateescape")
@@ -1,27 +1,56 @@
+from contextlib import contextmanager
 from datetime import datetime
+import hashlib
 import json
 import os
+import resource
 import shutil
+import subprocess
+import threading
+import time
 
+from . import compression, crypto, dedup
 from .command import Command
+from .config import parse_size
+from .journal import UploadJournal
+from .manifest import CHECKPOINT_NAME, MANIFEST_NAME, Checkpoint, Manifest
+from .pipeline import ChunkSpool, ResumeMismatch, SpoolAborted, read_chunks, skip_chunks, split_stream, write_chunks
+from .rclone import RcError, connect as connect_rclone
+from .stages import StagePipeline, StageStats, log_stats, record_stats
 
 
 class ExportIntermediate(Command):
   """Exports the ZFS snapshot into encrypted and splitted files."""
 
+  # Levels of the backups in the chain, as recorded in last_backups_cache_file.
+  FULL = "full"
+  DIFFERENTIAL = "differential"
+  INCREMENTAL = "incremental"
+
   @classmethod
   def add_arguments(cls, parser):
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-f", "--full", action="store_true", default=False, help="forces a full backup")
     group.add_argument("-i", "--incremental", action="store_true", default=False, help="forces an incremental backup")
 
+  def __init__(self, config, args):
+    super().__init__(config, args)
+    self._checkpoint = None
+    self._plaintext_sha256 = {}
+    self._plaintext_size = {}
+    self._block_store = None
+    self.stage_stats = []
+
   def run(self):
     snapshots = self._discover_snapshots()
     if len(snapshots) == 0:
       raise RuntimeError("cannot export-intermediate when there are no existing snapshots")
 
     last_full_backup = self._get_last_full_backup_from_cache_file()
-    full, reason = self._should_be_full_export(snapshots, last_full_backup)
+    last_backups = self._get_last_backups_from_cache_file()
+    base_backup, base_level, level = self._incremental_base(last_full_backup, last_backups)
+    send_base = self._send_base(base_backup[0], snapshots)
+    full, reason = self._should_be_full_export(snapshots, last_full_backup, send_base)
 
     self.logger.info("performing {}".format(reason))
 
@@ -30,49 +59,434 @@ class ExportIntermediate(Command):
 
     os.umask(0o77)
     if not full:
-      found = False
-      for snapshot_name, _ in snapshots:
-        if last_full_backup[0] == snapshot_name:
-          found = True
-
-      if not found:
-        raise RuntimeError("last full snapshot deleted? looked for {} but couldn't find it.".format(last_full_backup[0]))
-
-      if self.config.main["incremental_strategy"] != self.config.SINCE_LAST_FULL:
-        raise NotImplementedError
+      if send_base is None:
+        raise RuntimeError("last {} snapshot deleted? looked for {} but couldn't find it.".format(base_level, base_backup[0]))
 
-      base_zfs_name = last_full_backup[0]
-      opts = "-i {}".format(base_zfs_name)
+      base_zfs_name = base_backup[0]
+      opts = "-i {}".format(send_base)
+      self.logger.info("exporting a {} backup based on the {} backup {}".format(level, base_level, send_base))
     else:
+      base_zfs_name = None
       opts = ""
 
     snapshot_intermediate_folder_name = os.path.join(self.config.main["intermediate_basedir"], snapshot_intermediate_folder_name)
     snapshot_intermediate_file_prefix = os.path.join(snapshot_intermediate_folder_name, snapshot_intermediate_file_prefix)
 
-    self._execute("{} -p {}".format("mkdir", snapshot_intermediate_folder_name), dry_run=self.args.dry_run)
+    if self.config.main["export_mode"] != self.config.EXPORT_STREAM:
+      # The chunks are written by python, so the folder is created here as well.
+      self.logger.info("creating {}".format(snapshot_intermediate_folder_name))
+      if not self.args.dry_run:
+        os.makedirs(snapshot_intermediate_folder_name, exist_ok=True)
 
-    command = "{zfs} send {opts} {current_zfs_name} | gpg1 -c --compress-algo none --cipher-algo AES256 --batch --passphrase {key} | split - --bytes {split_size} --suffix-length=4 --numeric-suffixes {fileprefix}".format(
+    stages = [("zfs send", "{zfs} send {opts} {current_zfs_name}".format(
       zfs=self.config.zfs_path,
       opts=opts,
       current_zfs_name=snapshot_to_export,
-      key=self.config.main["encryption_passphrase"],
-      split_size=self.config.main["split_size"],
-      fileprefix=snapshot_intermediate_file_prefix
-    )
+    ))]
+
+    compress_command = compression.compress_command(self.config.main["compression"], self.config.main["compression_level"])
+    if compress_command:
+      stages.append((self.config.main["compression"], compress_command))
+
+    if self.config.main["encryption"] == crypto.GPG:
+      stages.append(("gpg1", "gpg1 -c --compress-algo none --cipher-algo AES256 --batch --passphrase {key}".format(
+        key=self.config.main["encryption_passphrase"],
+      )))
+
+    manifest = Manifest(snapshot_to_export, base_zfs_name, full, self.config.main["compression"], self.config.main["encryption"])
+
+    if self.config.main["export_mode"] != self.config.EXPORT_STREAM and not self.args.dry_run:
+      self._checkpoint = self._prepare_checkpoint(snapshot_intermediate_folder_name, manifest)
+
+    index = None
+    if self.config.main.getboolean("dedup") and not self.args.dry_run:
+      index = dedup.BlockIndex(self.config.dedup_index_file)
+      self._block_store = dedup.BlockStore(
+        index,
+        self.config.main["encryption_passphrase"],
+        snapshot_intermediate_folder_name,
+        os.path.join(snapshot_intermediate_folder_name, snapshot_to_export.replace("/", "-") + ".pack."),
+        parse_size(self.config.main["split_size"]),
+        time.time() - self.config.main.getint("dedup_max_age_days") * 86400,
+      )
+
+    try:
+      with self._export_slots():
+        try:
+          chunks = self._export(stages, snapshot_intermediate_folder_name, snapshot_intermediate_file_prefix)
+        except ResumeMismatch as e:
+          self.logger.warning("cannot resume the interrupted export, starting over: {}".format(e))
+          self._checkpoint = self._prepare_checkpoint(snapshot_intermediate_folder_name, manifest, resume=False)
+          chunks = self._export(stages, snapshot_intermediate_folder_name, snapshot_intermediate_file_prefix)
+    finally:
+      if index is not None:
+        index.close()
+
+    if not self.args.dry_run:
+      if self._checkpoint is not None:
+        manifest = self._checkpoint.manifest
+      else:
+        for name, size, sha256 in chunks:
+          manifest.add_chunk(os.path.basename(name), size, sha256)
 
-    self.logger.info("+ {}".format(command.replace(self.config.main["encryption_passphrase"], "*****")))
-    self._execute(command, log=False, dry_run=self.args.dry_run)
+      if self._block_store is not None:
+        manifest.packs = self._block_store.packs
+        self.logger.info("stored {} bytes of new blocks in {} packs, reused {} bytes".format(
+          self._block_store.stored_bytes, len(self._block_store.packs), self._block_store.reused_bytes,
+        ))
 
+      self._write_manifest(manifest, snapshot_intermediate_folder_name)
+      Checkpoint.remove(snapshot_intermediate_folder_name)
+
+      log_stats(self.logger, self.stage_stats)
+      record_stats(
+        self.config.stats_file, "export-intermediate",
+        snapshot=snapshot_to_export, full=full, stages=[s.to_dict() for s in self.stage_stats],
+      )
+
+    if self.config.main.getboolean("use_bookmarks"):
+      # Any export may become the base of the next one.
+      self._create_bookmark(snapshot_to_export)
+
+    exported = [snapshot_to_export, snapshots[0][1].strftime("%Y-%m-%d %H:%M:%S")]
     if full:
-      data = json.dumps([snapshot_to_export, snapshots[0][1].strftime("%Y-%m-%d %H:%M:%S")])
+      data = json.dumps(exported)
       self.logger.info("updating {} to {}".format(self.config.last_full_cache_file, data))
       if not self.args.dry_run:
         with open(self.config.last_full_cache_file, "w") as f:
           f.write(data)
 
+      # Everything exported before is based on an older full backup.
+      last_backups = {}
+    else:
+      last_backups = {k: [name, creation.strftime("%Y-%m-%d %H:%M:%S")] for k, (name, creation) in last_backups.items()}
+      last_backups[self.INCREMENTAL] = exported
+      if level == self.DIFFERENTIAL:
+        last_backups[self.DIFFERENTIAL] = exported
+
+    data = json.dumps(last_backups, sort_keys=True)
+    self.logger.info("updating {} to {}".format(self.config.last_backups_cache_file, data))
+    if not self.args.dry_run:
+      with open(self.config.last_backups_cache_file, "w") as f:
+        f.write(data)
+
     return full
 
-  def _should_be_full_export(self, snapshots, last_full_backup):
+  @contextmanager
+  def _export_slots(self):
+    """
+    Waits for a zfs send slot shared by all datasets of a perform run, and for
+    an upload slot too if the export uploads as it goes.
+    """
+    with self.config.send_slots:
+      if self.config.main["export_mode"] == self.config.EXPORT_SPLIT:
+        yield
+      else:
+        with self.config.upload_slots:
+          yield
+
+  def _export(self, stages, folder, file_prefix):
+    if self.config.main["export_mode"] == self.config.EXPORT_SPOOL:
+      return self._export_spooled(stages, folder, file_prefix)
+    elif self.config.main["export_mode"] == self.config.EXPORT_STREAM:
+      return self._export_streamed(stages, folder, file_prefix)
+    else:
+      return self._export_local(stages, file_prefix)
+
+  def _prepare_checkpoint(self, folder, manifest, resume=True):
+    """
+    Picks up the checkpoint of an interrupted export of the same snapshot if it
+    can be continued, and removes the other files an earlier export of the
+    snapshot left behind in the folder. Anything else is left alone.
+    """
+    split_size = parse_size(self.config.main["split_size"])
+    previous = Checkpoint.load(folder)
+    if previous is None and os.path.exists(os.path.join(folder, MANIFEST_NAME)):
+      self.logger.warning("{} already holds a completed export of {}, which is replaced".format(folder, manifest.snapshot))
+
+    checkpoint = previous if resume else None
+    resumable = (
+      checkpoint is not None and
+      self.config.main["encryption"] == crypto.NATIVE and
+      not self.config.main.getboolean("dedup") and
+      checkpoint.split_size == split_size and
+      checkpoint.manifest.describes_same_export(manifest) and
+      len(checkpoint.manifest.chunks) > 0
+    )
+
+    if resumable:
+      checkpoint.rewind()
+      self.logger.info("resuming the interrupted export after {} chunks".format(len(checkpoint.manifest.chunks)))
+    else:
+      checkpoint = Checkpoint(Manifest.from_dict(manifest.to_dict()), split_size)
+
+    # Chunks, packs and their .partial files are all named after the snapshot.
+    prefix = manifest.snapshot.replace("/", "-") + "."
+    exported = {MANIFEST_NAME, MANIFEST_NAME + ".partial", CHECKPOINT_NAME + ".partial"}
+    keep = {name for name, _, _ in checkpoint.manifest.chunks}
+    for fn in sorted(os.listdir(folder)):
+      path = os.path.join(folder, fn)
+      if fn in keep or not os.path.isfile(path):
+        continue
+
+      if fn.startswith(prefix) or fn in exported:
+        self.logger.info("removing {} left behind by an earlier export".format(path))
+        os.remove(path)
+      else:
+        self.logger.debug("ignoring {}".format(path))
+
+    checkpoint.write(folder)
+    return checkpoint
+
+  def _export_spooled(self, stages, folder, file_prefix):
+    """
+    Splits the encrypted stream into chunks in python and moves each chunk to
+    the remote as soon as it is sealed. The spool limits bound how much of the
+    export can sit in intermediate_basedir at once.
+    """
+    remote_folder = "{}/{}".format(self.config.main["remote"], os.path.basename(folder))
+    spool = ChunkSpool(
+      max_bytes=parse_size(self.config.main["spool_max_bytes"] or "0"),
+      max_chunks=self.config.main.getint("spool_max_chunks"),
+    )
+
+    def chunks(pieces):
+      return write_chunks(pieces, file_prefix, parse_size(self.config.main["split_size"]), spool)
+
+    def upload(rclone, path):
+      rclone.moveto(path, "{}/{}".format(remote_folder, os.path.basename(path)))
+
+    return self._export_chunks(stages, "spooled to {}".format(remote_folder), chunks, spool, upload)
+
+  def _export_streamed(self, stages, folder, file_prefix):
+    """
+    Cuts the encrypted stream into split_size pieces in memory and pipes each
+    one into rclone rcat, so nothing is written to intermediate_basedir. At most
+    upload_concurrency pieces are uploading while the next one is read.
+    """
+    remote_folder = "{}/{}".format(self.config.main["remote"], os.path.basename(folder))
+    spool = ChunkSpool(max_chunks=self.config.main.getint("upload_concurrency") + 1)
+
+    def chunks(pieces):
+      return read_chunks(pieces, os.path.basename(file_prefix), parse_size(self.config.main["split_size"]), spool)
+
+    def upload(rclone, item):
+      name, data = item
+      rclone.rcat("{}/{}".format(remote_folder, name), data)
+
+    return self._export_chunks(stages, "streamed to {}".format(remote_folder), chunks, spool, upload)
+
+  def _export_local(self, stages, file_prefix):
+    def chunks(pieces):
+      return write_chunks(pieces, file_prefix, parse_size(self.config.main["split_size"]))
+
+    return self._export_chunks(stages, "split into {}NNNN".format(file_prefix), chunks)
+
+  def _export_chunks(self, stages, description, chunks, spool=None, upload=None):
+    """
+    Runs the (name, command) stages as a pipeline and cuts its output into
+    chunks. Returns [(name, size, sha256)], and leaves what every stage did in
+    stage_stats.
+    """
+    command = " | ".join(command for _, command in stages)
+    self.logger.info("+ {} ({})".format(self._redact(command), description))
+    if self.args.dry_run:
+      return []
+
+    # Everything zfs2cloud does itself (cutting, encrypting, writing and
+    # uploading the chunks) is measured as the last stage.
+    stats = StageStats("zfs2cloud")
+    started = time.monotonic()
+    cpu_started = time.process_time()
+    children_started = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    pipeline = StagePipeline(stages, relay=self.config.main.getboolean("relay_stages")).start()
+    try:
+      with self._chunk_pieces(pipeline.stdout) as pieces:
+        if upload is None:
+          sealed = list(self._seal_chunks(chunks(pieces)))
+        else:
+          sealed = self._pump_chunks(chunks(pieces), spool, upload)
+    except BaseException:
+      pipeline.kill()
+      raise
+    finally:
+      pipeline.wait()
+
+    if pipeline.returncode != 0:
+      raise subprocess.CalledProcessError(pipeline.returncode, self._redact(command))
+
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    children_cpu = children.ru_utime + children.ru_stime - children_started.ru_utime - children_started.ru_stime
+    stats.bytes_in = pipeline.stats[-1].bytes_out
+    stats.bytes_out = sum(size for _, size, _ in sealed)
+    stats.wall_seconds = time.monotonic() - started
+    # The encryption workers and uploads are child processes too.
+    stats.cpu_seconds = max(0.0, time.process_time() - cpu_started + children_cpu - sum(s.cpu_seconds for s in pipeline.stats))
+    stats.blocked_seconds = spool.blocked_seconds if spool is not None else 0.0
+    self.stage_stats = pipeline.stats + [stats]
+
+    return sealed
+
+  def _seal_chunks(self, chunks):
+    for name, size, sha256 in chunks:
+      self.logger.debug("sealed {} ({} bytes, sha256 {})".format(name, size, sha256))
+      if self._checkpoint is not None:
+        index = len(self._checkpoint.manifest.chunks)
+        self._checkpoint.add_chunk(
+          os.path.basename(name), size, sha256,
+          self._plaintext_sha256.get(index), self._plaintext_size.get(index),
+        )
+        self._checkpoint.write(os.path.dirname(name))
+
+      yield name, size, sha256
+
+  def _write_manifest(self, manifest, folder):
+    if self.config.main["export_mode"] == self.config.EXPORT_STREAM:
+      remote_folder = "{}/{}".format(self.config.main["remote"], os.path.basename(folder))
+      connect_rclone(self).rcat("{}/{}".format(remote_folder, MANIFEST_NAME), manifest.dumps().encode("utf-8"))
+    else:
+      self.logger.info("writing {} with {} chunks".format(os.path.join(folder, MANIFEST_NAME), len(manifest.chunks)))
+      manifest.write(folder)
+
+  @contextmanager
+  def _chunk_pieces(self, stream):
+    """Cuts the stream into (chunk_index, data) pieces, encrypting them if encryption = native."""
+    split_size = parse_size(self.config.main["split_size"])
+    if self._block_store is not None:
+      # The recipe is what gets encrypted and split, the new blocks are
+      # written into packs on the side.
+      stream = self._block_store.recipe(stream)
+
+    if self.config.main["encryption"] == crypto.NATIVE:
+      checkpoint = self._checkpoint or Checkpoint(None, split_size)
+      cipher = crypto.ChunkCipher(
+        self.config.main["encryption_passphrase"],
+        salt=checkpoint.salt,
+        stream_id=checkpoint.stream_id,
+        workers=self.config.main.getint("encryption_workers"),
+      )
+
+      checkpoint.salt = cipher.salt
+      checkpoint.stream_id = cipher.stream_id
+      self._plaintext_sha256 = cipher.plaintext_sha256
+      self._plaintext_size = cipher.plaintext_size
+
+      # Chunks sealed by an interrupted export are read again, but not
+      # encrypted or written.
+      if checkpoint.plaintext_sha256:
+        skipped = skip_chunks(stream, split_size, checkpoint.plaintext_sha256)
+        if skipped != checkpoint.stream_offset:
+          raise ResumeMismatch("the checkpoint is at byte {} of the stream, but its chunks hold {}".format(checkpoint.stream_offset, skipped))
+
+        self.logger.info("re-read {} bytes of the stream exported before the interruption".format(skipped))
+
+      with cipher:
+        yield cipher.encrypt(stream, split_size, first_chunk=len(checkpoint.plaintext_sha256))
+    else:
+      yield split_stream(stream, split_size)
+
+  def _pump_chunks(self, chunks, spool, upload):
+    """Uploads chunks from the spool with upload_concurrency threads while chunks fills it."""
+    uploaders = []
+    for i in range(self.config.main.getint("upload_concurrency")):
+      uploader = threading.Thread(target=self._upload_chunks, args=(spool, upload), name="uploader-{}".format(i))
+      uploader.start()
+      uploaders.append(uploader)
+
+    try:
+      sealed = list(self._seal_chunks(chunks))
+    except SpoolAborted:
+      # An uploader failed, which is raised below.
+      sealed = None
+    except BaseException as e:
+      spool.abort(e)
+      raise
+    finally:
+      spool.close()
+      for uploader in uploaders:
+        uploader.join()
+
+    if spool.error is not None:
+      raise RuntimeError("failed to upload chunks") from spool.error
+
+    return sealed
+
+  def _upload_chunks(self, spool, upload):
+    rclone = connect_rclone(self)
+    try:
+      while True:
+        item = spool.get()
+        if item is None:
+          return
+
+        item, size = item
+        try:
+          upload(rclone, item)
+        except BaseException as e:
+          # Aborts before the space is released, so the writer stops here
+          # instead of handing out another chunk.
+          spool.abort(e)
+          return
+        finally:
+          spool.release(size)
+    except SpoolAborted:
+      pass
+
+  def _redact(self, command):
+    return command.replace(self.config.main["encryption_passphrase"], "*****")
+
+  def _incremental_base(self, last_full_backup, last_backups):
+    """
+    Returns (base_backup, base_level, level): the (name, creation) of the
+    backup an incremental export would be based on, its level, and the level
+    of the export itself according to incremental_strategy.
+    """
+    strategy = self.config.main["incremental_strategy"]
+    if last_full_backup[0] is None:
+      return last_full_backup, self.FULL, self.INCREMENTAL
+
+    if strategy == self.config.SINCE_LAST_INCREMENTAL and self.INCREMENTAL in last_backups:
+      return last_backups[self.INCREMENTAL], self.INCREMENTAL, self.INCREMENTAL
+
+    if strategy == self.config.TIERED:
+      # Incrementals are based on the latest differential, or on the full
+      # backup until the first differential is due.
+      base_backup, base_level = last_full_backup, self.FULL
+      if self.DIFFERENTIAL in last_backups:
+        base_backup, base_level = last_backups[self.DIFFERENTIAL], self.DIFFERENTIAL
+
+      if (datetime.now() - base_backup[1]).total_seconds() > self.config.main.getint("differential_every_x_days") * 86400:
+        return last_full_backup, self.FULL, self.DIFFERENTIAL
+
+      return base_backup, base_level, self.INCREMENTAL
+
+    return last_full_backup, self.FULL, self.INCREMENTAL
+
+  def _send_base(self, base_snapshot, snapshots):
+    """
+    Returns what to pass to zfs send -i for an export based on base_snapshot:
+    the snapshot itself, or its bookmark with use_bookmarks, which is created
+    from the snapshot if needed. None if neither exists.
+    """
+    if base_snapshot is None:
+      return None
+
+    exists = base_snapshot in set(name for name, _ in snapshots)
+    if not self.config.main.getboolean("use_bookmarks"):
+      return base_snapshot if exists else None
+
+    bookmark = self._bookmark_name(base_snapshot)
+    if bookmark in set(name for name, _ in self._discover_bookmarks()):
+      return bookmark
+
+    if not exists:
+      return None
+
+    self._create_bookmark(base_snapshot)
+    return bookmark
+
+  def _should_be_full_export(self, snapshots, last_full_backup, send_base):
     last_full_backup_name, last_full_backup_creation_time = last_full_backup
     full = False
     reason = "incremental export by default"
@@ -91,13 +505,78 @@ class ExportIntermediate(Command):
     elif last_full_backup_name is None:
       full = True
       reason = "full export due to no known full export"
+    elif not self.args.incremental and self.config.main["incremental_strategy"] == self.config.NEVER_INCREMENTAL:
+      full = True
+      reason = "full export due to incremental_strategy = {}".format(self.config.NEVER_INCREMENTAL)
     elif not self.args.incremental and (datetime.now() - last_full_backup_creation_time).total_seconds() > self.config.main.getint("full_every_x_days") * 86400:
       delta = (datetime.now() - last_full_backup_creation_time).total_seconds() / 86400
       full = True
       reason = "full export since last full backup is {:.1f} days old and larger than threshold days of {}".format(delta, self.config.main.getint("full_every_x_days"))
 
+    # Overrides are final, and without a usable base there is nothing to compare.
+    if self.args.full or self.args.incremental or len(snapshots) == 1:
+      return full, reason
+
+    if self.config.main["incremental_strategy"] == self.config.NEVER_INCREMENTAL:
+      return full, reason
+
+    if send_base is None:
+      return full, reason
+
+    return self._apply_size_policy(snapshots[0][0], last_full_backup, send_base, full, reason)
+
+  def _apply_size_policy(self, snapshot, last_full_backup, send_base, full, reason):
+    """
+    Revisits the age based decision with the estimated sizes of both streams:
+    a full is exported early once the incremental is at least full_size_ratio
+    of its size, and postponed by up to full_postpone_max_days while the
+    incremental is below full_postpone_size_ratio of it.
+    """
+    full_size_ratio = self.config.main["full_size_ratio"]
+    postpone_size_ratio = self.config.main["full_postpone_size_ratio"]
+    if (full and not postpone_size_ratio) or (not full and not full_size_ratio):
+      return full, reason
+
+    incremental_size, full_size = self._estimate_send_sizes(snapshot, [send_base, None])
+    if full_size == 0:
+      return full, reason
+
+    ratio = incremental_size / full_size
+    self.logger.info("estimated an incremental of {} bytes and a full of {} bytes ({:.0%})".format(incremental_size, full_size, ratio))
+
+    if not full and ratio >= float(full_size_ratio):
+      return True, "full export since the incremental would be {:.0%} of a full, over full_size_ratio = {}".format(ratio, full_size_ratio)
+
+    age = (datetime.now() - last_full_backup[1]).total_seconds() / 86400
+    max_age = self.config.main.getint("full_every_x_days") + self.config.main.getint("full_postpone_max_days")
+    if full and ratio < float(postpone_size_ratio) and age <= max_age:
+      return False, "incremental export postponing the full backup as the incremental would only be {:.0%} of a full, under full_postpone_size_ratio = {}".format(ratio, postpone_size_ratio)
+
     return full, reason
 
+  def _estimate_send_sizes(self, snapshot, base_snapshots):
+    """
+    Returns the sizes in bytes zfs send estimates for the streams of snapshot
+    based on each of base_snapshots (None for a full stream), estimated at the
+    same time.
+    """
+    commands = []
+    for base_snapshot in base_snapshots:
+      opts = ["-i", base_snapshot] if base_snapshot else []
+      commands.append([self.config.zfs_path, "send", "-nvP"] + opts + [snapshot])
+
+    sizes = []
+    for result in self._execute_all(commands, capture=True, stderr=subprocess.STDOUT):
+      for line in reversed(result.stdout.strip().split("\n")):
+        fields = line.split("\t")
+        if fields[0] == "size" and len(fields) == 2:
+          sizes.append(int(fields[1]))
+          break
+      else:
+        raise RuntimeError("cannot find the estimated size in the output of zfs send -nvP: {}".format(result.stdout))
+
+    return sizes
+
 
 class PruneIntermediate(Command):
   """
@@ -131,6 +610,7 @@ class PruneIntermediate(Command):
       folder_name, _ = self._intermediate_folder_file_name(snapshot_name, True)
       possible_folder_names.add(folder_name)
 
+    journal = UploadJournal(self.config.upload_journal_file)
     for fn in os.listdir(self.config.main["intermediate_basedir"]):
       path = os.path.join(self.config.main["intermediate_basedir"], fn)
       if not os.path.isdir(path):
@@ -138,9 +618,14 @@ class PruneIntermediate(Command):
         continue
 
       if fn in possible_folder_names:
+        if not journal.is_complete(fn):
+          self.logger.warning("not pruning {} as its upload has not finished".format(path))
+          continue
+
         self.logger.info("pruning {}".format(path))
         if not dry_run:
           shutil.rmtree(path)
+          journal.forget(fn)
       else:
         self.logger.debug("ignoring {}".format(path))
 
@@ -153,6 +638,10 @@ class UploadIntermediateToRemote(Command):
     parser.add_argument("-s", "--snapshot", default=None, help="the snapshot to upload (specifically the value of this option should be the zfs name). Default: the latest snapshot")
 
   def run(self):
+    if self.config.main["export_mode"] == self.config.EXPORT_STREAM:
+      self.logger.info("nothing to upload as export-intermediate streams directly to the remote")
+      return
+
     snapshots = self._discover_snapshots()
     if len(snapshots) == 0:
       raise RuntimeError("cannot upload-intermediate-to-remote when there are no existing snapshots")
@@ -187,27 +676,122 @@ class UploadIntermediateToRemote(Command):
     if len(actual_folders) != 1:
       raise RuntimeError("cannot find the snapshot intermediate or have too many candidates: {}".format(actual_folders))
 
-    path_to_upload = os.path.join(self.config.main["intermediate_basedir"], actual_folders[0])
+    self._upload_folder(actual_folders[0])
+
+  def resume(self):
+    """Finishes the uploads that failed in earlier runs."""
+    if self.config.main["export_mode"] == self.config.EXPORT_STREAM:
+      return
+
+    journal = UploadJournal(self.config.upload_journal_file)
+    for folder_name in journal.incomplete():
+      if not os.path.isdir(os.path.join(self.config.main["intermediate_basedir"], folder_name)):
+        self.logger.warning("cannot finish uploading {} as it is gone".format(folder_name))
+        if not self.args.dry_run:
+          journal.forget(folder_name)
+
+        continue
+
+      self.logger.info("finishing the upload of {} that failed earlier".format(folder_name))
+      self._upload_folder(folder_name)
+
+  def _upload_folder(self, folder_name):
+    path_to_upload = os.path.join(self.config.main["intermediate_basedir"], folder_name)
     self.logger.info("uploading {} to {}".format(path_to_upload, self.config.main["remote"]))
 
-    command = [
-      self.config.rclone_path,
-    ]
+    rclone = connect_rclone(self)
+    remote_folder = "{upload_to}/{backup_folder_name}".format(upload_to=self.config.main["remote"], backup_folder_name=folder_name)
+    manifest = Manifest.load(path_to_upload)
+    if manifest is None:
+      self.logger.info("{} has no manifest, uploading the whole folder".format(path_to_upload))
+
+    journal = UploadJournal(self.config.upload_journal_file)
+    if not self.args.dry_run:
+      journal.start(folder_name)
+
+    with self.config.upload_slots:
+      if manifest is not None:
+        self._upload_listed(rclone, manifest, path_to_upload, remote_folder, journal)
+      elif self.config.main["export_mode"] == self.config.EXPORT_SPOOL:
+        # Chunks are moved to the remote as they are exported, so only leftovers
+        # from a failed export remain here. A sync would delete the others.
+        self._retrying(path_to_upload, lambda: rclone.copy(path_to_upload, remote_folder, dry_run=self.args.dry_run))
+      else:
+        self._retrying(path_to_upload, lambda: rclone.sync(path_to_upload, remote_folder, dry_run=self.args.dry_run))
+
+    if not self.args.dry_run:
+      journal.finish(folder_name)
+
+    if self.config.main.getboolean("dedup") and not self.args.dry_run:
+      # Only now can later exports refer to the blocks in this folder.
+      with dedup.BlockIndex(self.config.dedup_index_file) as index:
+        count = index.mark_uploaded(folder_name, time.time())
+
+      self.logger.info("{} blocks of {} can now be reused".format(count, folder_name))
+
+  def _retrying(self, description, upload):
+    """Calls upload until it succeeds, at most upload_retries more times, waiting longer after each failure."""
+    delay = self.config.main.getint("upload_retry_delay")
+    retries = self.config.main.getint("upload_retries")
+    for attempt in range(retries + 1):
+      try:
+        return upload()
+      except (subprocess.CalledProcessError, RcError, OSError) as e:
+        if attempt == retries:
+          raise
+
+        self.logger.warning("uploading {} failed ({}), retrying in {}s".format(description, e, delay))
+        time.sleep(delay)
+        delay *= 2
+
+  def _upload_listed(self, rclone, manifest, path, remote_folder, journal):
+    """
+    Uploads the files listed in the manifest without listing the remote folder
+    first. Chunks never change once written, so only those not yet confirmed
+    to be on the remote with the same sha256 are copied, in one batch. A
+    single listing afterwards confirms them, and those that did not make it
+    are retried one by one.
+    """
+    folder_name = os.path.basename(path)
+    with open(os.path.join(path, MANIFEST_NAME), "rb") as f:
+      data = f.read()
+
+    expected = {name: (size, sha256) for name, size, sha256 in manifest.chunks + manifest.packs}
+    expected[MANIFEST_NAME] = (len(data), hashlib.sha256(data).hexdigest())
+
+    confirmed = journal.confirmed(folder_name)
+    unconfirmed = sorted(name for name, (_, sha256) in expected.items() if confirmed.get(name) != sha256)
+    self.logger.info("{} of the {} files of {} are not confirmed on the remote".format(len(unconfirmed), len(expected), folder_name))
+    if not unconfirmed:
+      return
 
-    rclone_global_flags = self.config.main.get("rclone_global_flags")
-    if rclone_global_flags:
-      command.append(rclone_global_flags)
+    # Chunks moved by a spooled export are not here anymore; the listing
+    # tells whether they made it.
+    missing = [name for name in unconfirmed if os.path.exists(os.path.join(path, name))]
+    if missing:
+      files_from = os.path.join(self.config.main["intermediate_basedir"], "_files_from")
+      with open(files_from, "w") as f:
+        f.write("".join(name + "\n" for name in missing))
+
+      try:
+        rclone.copy_files(path, remote_folder, files_from, dry_run=self.args.dry_run)
+      except (subprocess.CalledProcessError, RcError) as e:
+        self.logger.warning("copying {} failed ({}), retrying what did not make it one by one".format(path, e))
+      finally:
+        os.remove(files_from)
+
+    if self.args.dry_run:
+      return
 
-    command.append("sync")
+    remote = rclone.list(remote_folder)
+    journal.confirm(folder_name, {name: expected[name][1] for name in unconfirmed if remote.get(name) == expected[name][0]})
 
-    rclone_args = self.config.main.get("rclone_args")
-    if rclone_args:
-      command.append(rclone_args)
+    for name in unconfirmed:
+      if remote.get(name) == expected[name][0]:
+        continue
 
-    command.append(path_to_upload)
-    command.append("{upload_to}/{backup_folder_name}".format(upload_to=self.config.main["remote"], backup_folder_name=actual_folders[0]))
-    command = " ".join(command)
+      if not os.path.exists(os.path.join(path, name)):
+        raise RuntimeError("{} is missing from {} and is not here to upload again".format(name, remote_folder))
 
-    env = {}
-    env["RCLONE_CONFIG"] = self.config.main["rclone_conf"]
-    self._execute(command, env=env, dry_run=self.args.dry_run)
+      self._retrying(name, lambda: rclone.copyto(os.path.join(path, name), "{}/{}".format(remote_folder, name)))
+      journal.confirm(folder_name, {name: expected[name][1]})
@@ -0,0 +1,60 @@
+from datetime import datetime
+
+
+class SnapshotInventory(object):
+  """
+  The snapshots and bookmarks of zfs_fs, listed once with a single zfs list
+  and shared by the steps of a perform run. Steps that create or destroy
+  snapshots or bookmarks update it in place.
+  """
+
+  def __init__(self, zfs, zfs_fs):
+    # zfs(*args) runs zfs and returns its CommandResult with a decoded stdout.
+    self._zfs = zfs
+    self.zfs_fs = zfs_fs
+    self._entries = None
+
+  def snapshots(self):
+    """Returns [(name, creation)] of the snapshots, newest first."""
+    return [(name, creation) for name, creation in self._list() if "@" in name]
+
+  def bookmarks(self):
+    """Returns [(name, creation)] of the bookmarks, newest first."""
+    return [(name, creation) for name, creation in self._list() if "#" in name]
+
+  def add(self, name, creation):
+    if self._entries is None:
+      return
+
+    self._entries = [(n, c) for n, c in self._entries if n != name]
+    self._entries.append((name, creation))
+    self._sort()
+
+  def remove(self, name):
+    if self._entries is not None:
+      self._entries = [(n, c) for n, c in self._entries if n != name]
+
+  def invalidate(self):
+    """Forgets everything, for when something else may have changed the snapshots."""
+    self._entries = None
+
+  def _list(self):
+    if self._entries is None:
+      # -p prints the creation time as seconds since the epoch.
+      data = self._zfs("list", "-Hp", "-t", "snapshot,bookmark", "-o", "name,creation", "-S", "creation", "-d1", self.zfs_fs).stdout.strip()
+      self._entries = []
+      for line in data.split("\n") if data else []:
+        line = line.split("\t")
+        if len(line) != 2:
+          raise RuntimeError("zfs command should have returned two columns?")
+
+        self._entries.append((line[0], datetime.fromtimestamp(int(line[1]))))
+
+      self._sort()
+
+    return self._entries
+
+  def _sort(self):
+    # Newest first. The sort is stable, so entries created within the same
+    # second keep the order zfs listed them in.
+    self._entries.sort(key=lambda entry: entry[1], reverse=True)
@@ -0,0 +1,56 @@
+import json
+import os
+
+
+class UploadJournal(object):
+  """
+  Records, for every intermediate folder, whether its upload has finished and
+  which of its files are known to be on the remote. It outlives failed runs,
+  so the next one can finish the upload, and it keeps prune-intermediates from
+  deleting folders that are not fully uploaded yet.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    if os.path.exists(path):
+      with open(path) as f:
+        self._folders = json.load(f)
+    else:
+      self._folders = {}
+
+  def start(self, folder):
+    entry = self._folders.setdefault(folder, {"complete": False, "files": {}})
+    entry["complete"] = False
+    self._save()
+
+  def confirmed(self, folder):
+    """Returns {name: sha256} of the files of folder known to be on the remote."""
+    return dict(self._folders.get(folder, {}).get("files", {}))
+
+  def confirm(self, folder, files):
+    entry = self._folders.setdefault(folder, {"complete": False, "files": {}})
+    entry["files"].update(files)
+    self._save()
+
+  def finish(self, folder):
+    self._folders.setdefault(folder, {"files": {}})["complete"] = True
+    self._save()
+
+  def forget(self, folder):
+    if self._folders.pop(folder, None) is not None:
+      self._save()
+
+  def is_complete(self, folder):
+    """Folders the journal does not know were never uploaded by it."""
+    return self._folders.get(folder, {}).get("complete", True)
+
+  def incomplete(self):
+    return sorted(folder for folder, entry in self._folders.items() if not entry["complete"])
+
+  def _save(self):
+    with open(self.path + ".partial", "w") as f:
+      json.dump(self._folders, f)
+      f.flush()
+      os.fsync(f.fileno())
+
+    os.rename(self.path + ".partial", self.path)
@@ -0,0 +1,181 @@
+import json
+import os
+
+
+MANIFEST_NAME = "manifest.json"
+CHECKPOINT_NAME = "checkpoint.json"
+
+
+def _write_atomically(path, data):
+  with open(path + ".partial", "w") as f:
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+
+  os.rename(path + ".partial", path)
+
+
+class Manifest(object):
+  """
+  Describes the chunks of an exported snapshot. It is written into the
+  intermediate folder next to the chunks and uploaded with them.
+  """
+
+  VERSION = 1
+
+  def __init__(self, snapshot, base_snapshot, full, compression, encryption, chunks=None, packs=None):
+    self.snapshot = snapshot
+    self.base_snapshot = base_snapshot
+    self.full = full
+    self.compression = compression
+    self.encryption = encryption
+    self.chunks = chunks or []
+    # The packs of new blocks written by a deduplicated export.
+    self.packs = packs or []
+
+  @classmethod
+  def loads(cls, data):
+    return cls.from_dict(json.loads(data))
+
+  @classmethod
+  def from_dict(cls, data):
+    if data.get("version") != cls.VERSION:
+      raise ValueError("unsupported manifest version {}".format(data.get("version")))
+
+    return cls(
+      data["snapshot"],
+      data["base_snapshot"],
+      data["full"],
+      data["compression"],
+      data["encryption"],
+      [(c["name"], c["size"], c["sha256"]) for c in data["chunks"]],
+      [(p["name"], p["size"], p["sha256"]) for p in data.get("packs", [])],
+    )
+
+  @classmethod
+  def load(cls, folder):
+    """Returns the manifest in folder, or None for backups made without one."""
+    path = os.path.join(folder, MANIFEST_NAME)
+    if not os.path.exists(path):
+      return None
+
+    with open(path) as f:
+      return cls.loads(f.read())
+
+  def to_dict(self):
+    return {
+      "version": self.VERSION,
+      "snapshot": self.snapshot,
+      "base_snapshot": self.base_snapshot,
+      "full": self.full,
+      "compression": self.compression,
+      "encryption": self.encryption,
+      "chunks": [{"name": name, "size": size, "sha256": sha256} for name, size, sha256 in self.chunks],
+      "packs": [{"name": name, "size": size, "sha256": sha256} for name, size, sha256 in self.packs],
+    }
+
+  def dumps(self):
+    return json.dumps(self.to_dict(), indent=2)
+
+  def write(self, folder):
+    _write_atomically(os.path.join(folder, MANIFEST_NAME), self.dumps())
+
+  def describes_same_export(self, other):
+    return (self.snapshot, self.base_snapshot, self.full, self.compression, self.encryption) == \
+      (other.snapshot, other.base_snapshot, other.full, other.compression, other.encryption)
+
+  def add_chunk(self, name, size, sha256):
+    self.chunks.append((name, size, sha256))
+
+  @property
+  def size(self):
+    return sum(size for _, size, _ in self.chunks)
+
+  def verify_files(self, folder, filenames):
+    """Checks that exactly the chunks in the manifest exist, with the right sizes."""
+    expected = {name: size for name, size, _ in self.chunks}
+    actual = set(filenames)
+
+    missing = sorted(set(expected) - actual)
+    if missing:
+      raise ValueError("{} is missing chunks: {}".format(folder, missing))
+
+    unexpected = sorted(actual - set(expected))
+    if unexpected:
+      raise ValueError("{} has chunks not in the manifest: {}".format(folder, unexpected))
+
+    for name, size in expected.items():
+      actual_size = os.path.getsize(os.path.join(folder, name))
+      if actual_size != size:
+        raise ValueError("{} is {} bytes but the manifest says {}".format(name, actual_size, size))
+
+
+class Checkpoint(object):
+  """
+  Records the progress of an export that has not finished yet. It is rewritten
+  after every sealed chunk, and together with the plaintext hash of every chunk
+  allows a natively encrypted export to continue after the last complete
+  chunk instead of from the start. stream_offset is the number of bytes of the
+  stream cut into chunks (the zfs send output for native encryption) that the
+  recorded chunks hold.
+  """
+
+  def __init__(self, manifest, split_size, salt=None, stream_id=None, plaintext_sha256=None, stream_offset=0):
+    self.manifest = manifest
+    self.split_size = split_size
+    self.salt = salt
+    self.stream_id = stream_id
+    self.plaintext_sha256 = plaintext_sha256 or []
+    self.stream_offset = stream_offset
+
+  @classmethod
+  def load(cls, folder):
+    path = os.path.join(folder, CHECKPOINT_NAME)
+    if not os.path.exists(path):
+      return None
+
+    with open(path) as f:
+      data = json.load(f)
+
+    return cls(
+      Manifest.from_dict(data["manifest"]),
+      data["split_size"],
+      bytes.fromhex(data["salt"]) if data["salt"] else None,
+      bytes.fromhex(data["stream_id"]) if data["stream_id"] else None,
+      data["plaintext_sha256"],
+      data.get("stream_offset", 0),
+    )
+
+  def write(self, folder):
+    _write_atomically(os.path.join(folder, CHECKPOINT_NAME), json.dumps({
+      "manifest": self.manifest.to_dict(),
+      "split_size": self.split_size,
+      "salt": self.salt.hex() if self.salt else None,
+      "stream_id": self.stream_id.hex() if self.stream_id else None,
+      "plaintext_sha256": self.plaintext_sha256,
+      "stream_offset": self.stream_offset,
+    }))
+
+  @staticmethod
+  def remove(folder):
+    try:
+      os.remove(os.path.join(folder, CHECKPOINT_NAME))
+    except FileNotFoundError:
+      pass
+
+  def add_chunk(self, name, size, sha256, plaintext_sha256=None, plaintext_size=None):
+    self.manifest.add_chunk(name, size, sha256)
+    if plaintext_sha256 is not None:
+      self.plaintext_sha256.append(plaintext_sha256)
+
+    self.stream_offset += plaintext_size if plaintext_size is not None else size
+
+  def rewind(self):
+    """
+    Drops the last chunk so it is exported again. It may or may not have been
+    the end of the stream, which decides how it was sealed.
+    """
+    self.manifest.chunks = self.manifest.chunks[:-1]
+    self.plaintext_sha256 = self.plaintext_sha256[:len(self.manifest.chunks)]
+    # Only the last chunk of a stream is shorter than split_size.
+    self.stream_offset = len(self.manifest.chunks) * self.split_size
@@ -1,15 +1,24 @@
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import copy
 import os
+import resource
 import subprocess
+import time
 import traceback
 import shlex
 
 from .command import Command
+from .inventory import SnapshotInventory
+from .stages import record_stats
 
 
 class Perform(Command):
   """Performs all steps outlined in backup_sequences"""
+  per_dataset = False
+
+  EXPORT_STEP = "export-intermediate"
+  UPLOAD_STEP = "upload-intermediate-to-remote"
 
   def run(self):
     try:
@@ -24,19 +33,103 @@ class Perform(Command):
     if self.args.dry_run:
       self.logger.info("in dry run mode")
 
-    for step in self.config.backup_sequences:
+    if self.config.is_single_dataset():
+      self._run_sequence(self.config, self.inventory, self.config.backup_sequences)
+      return
+
+    # All datasets are snapshotted at once, before any of them is backed up.
+    snapshot_steps = [step for step in self.config.backup_sequences if self._is_snapshot_step(step)]
+    steps = [step for step in self.config.backup_sequences if not self._is_snapshot_step(step)]
+    if snapshot_steps and steps and steps[0].startswith("/"):
+      self.logger.warning("{} runs after the snapshot was taken, use presnapshot_hooks to run it before".format(steps[0]))
+
+    self._run_sequence(self.config, self.inventory, snapshot_steps)
+
+    datasets = self._discover_datasets()
+    max_workers = self.config.main.getint("max_concurrent_datasets")
+    self.logger.info("backing up {} datasets, {} at a time".format(len(datasets), max_workers))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      futures = [(zfs_fs, executor.submit(self._run_dataset, zfs_fs, steps)) for zfs_fs in datasets]
+
+    # Every dataset gets its chance, the failures are reported at the end.
+    errors = [(zfs_fs, future.exception()) for zfs_fs, future in futures if future.exception() is not None]
+    for zfs_fs, e in errors:
+      self.logger.error("backing up {} failed: {}".format(zfs_fs, e))
+
+    if errors:
+      raise RuntimeError("backing up {} failed".format(", ".join(zfs_fs for zfs_fs, _ in errors))) from errors[0][1]
+
+  @staticmethod
+  def _is_snapshot_step(step):
+    return not step.startswith("/") and shlex.split(step)[0] == "snapshot"
+
+  def _run_dataset(self, zfs_fs, steps):
+    config = self.config.for_dataset(zfs_fs)
+    inventory = SnapshotInventory(lambda *args: self._zfs(*args, capture=True, log=False), zfs_fs)
+    self._run_sequence(config, inventory, steps)
+
+  def _run_sequence(self, config, inventory, steps):
+    # The cpu time is only known for the whole process, so it cannot be told
+    # apart while several datasets are backed up at once.
+    measure_cpu = self.config.is_single_dataset()
+    # Uploads that failed in earlier runs are finished before anything new is
+    # exported or uploaded.
+    resume = self.UPLOAD_STEP in self._step_names(steps)
+    for step in steps:
+      if resume and self._step_names([step]) & {self.EXPORT_STEP, self.UPLOAD_STEP}:
+        resume = False
+        self._run_step([self.UPLOAD_STEP], config, inventory, resume=True)
+
+      started = time.monotonic()
+      cpu_started = self._cpu_seconds()
+
       if step.startswith("/"):
-        self._execute(step, dry_run=self.args.dry_run)
-        continue
+        # A command of its own keeps the results apart from the scripts of
+        # the datasets running alongside.
+        script = Command(config, self.args, inventory=inventory)
+        script.logger = self.logger
+        script._execute_shell(step, env=dict(os.environ, ZFS2CLOUD_ZFS_FS=config.main["zfs_fs"]), dry_run=self.args.dry_run)
+        results = script.executed
+        # Scripts may create or destroy snapshots behind our back.
+        inventory.invalidate()
+      else:
+        results = self._run_step(shlex.split(step), config, inventory)
 
-      step = shlex.split(step)
-      self.logger.info("executing {}".format(step))
+      wall_seconds = time.monotonic() - started
+      cpu_seconds = round(self._cpu_seconds() - cpu_started, 3) if measure_cpu else None
+      self.logger.info("{}: {} took {:.1f}s, {} of cpu".format(
+        config.main["zfs_fs"], step, wall_seconds, "-" if cpu_seconds is None else "{:.1f}s".format(cpu_seconds),
+      ))
+      if not self.args.dry_run:
+        record_stats(
+          config.stats_file, step,
+          wall_seconds=round(wall_seconds, 3), cpu_seconds=cpu_seconds, commands=[result.to_dict() for result in results],
+        )
 
-      command_cls = self.args._commands[step[0]]
-      parser = argparse.ArgumentParser()
-      command_cls.add_arguments(parser)
-      parent_args = copy.deepcopy(self.args)
-      args = parser.parse_args(step[1:], namespace=parent_args)
+  @staticmethod
+  def _step_names(steps):
+    return set(shlex.split(step)[0] for step in steps if not step.startswith("/"))
 
-      command = command_cls(self.config, args)
+  def _run_step(self, step, config, inventory, resume=False):
+    self.logger.info("{}: {} {}".format(config.main["zfs_fs"], "resuming" if resume else "executing", step))
+
+    command_cls = self.args._commands[step[0]]
+    parser = argparse.ArgumentParser()
+    command_cls.add_arguments(parser)
+    parent_args = copy.deepcopy(self.args)
+    args = parser.parse_args(step[1:], namespace=parent_args)
+
+    command = command_cls(config, args, inventory=inventory)
+    if resume:
+      command.resume()
+    else:
       command.run()
+
+    return command.executed
+
+  @staticmethod
+  def _cpu_seconds():
+    """The cpu time used by zfs2cloud and the commands it ran so far."""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
@@ -0,0 +1,212 @@
+from collections import deque
+from itertools import groupby
+from operator import itemgetter
+import hashlib
+import os
+import threading
+import time
+
+
+READ_SIZE = 1024 * 1024
+MAX_CHUNKS = 10000  # split --suffix-length=4
+
+
+class SpoolAborted(RuntimeError):
+  pass
+
+
+class ResumeMismatch(RuntimeError):
+  pass
+
+
+class ChunkSpool(object):
+  """
+  A bounded hand-off between the chunk writer and the uploaders.
+
+  Space is reserved before a chunk is written and released once the uploader
+  is done with it, so the writer blocks whenever max_bytes or max_chunks worth
+  of chunks are on disk. A value of 0 means no limit.
+  """
+
+  def __init__(self, max_bytes=0, max_chunks=0):
+    self.max_bytes = max_bytes
+    self.max_chunks = max_chunks
+
+    self._cond = threading.Condition()
+    self._queue = deque()
+    self._bytes = 0
+    self._chunks = 0
+    self._closed = False
+    self._error = None
+    # How long the writer waited for room
+    self.blocked_seconds = 0.0
+
+  def reserve(self, nbytes):
+    with self._cond:
+      started = time.monotonic()
+      # An empty spool always accepts a chunk, otherwise we'd never progress.
+      while self._error is None and self._chunks > 0 and not self._has_room(nbytes):
+        self._cond.wait()
+
+      self.blocked_seconds += time.monotonic() - started
+
+      self._raise_if_aborted()
+      self._bytes += nbytes
+      self._chunks += 1
+
+  def put(self, item, reserved, nbytes):
+    with self._cond:
+      self._raise_if_aborted()
+      self._bytes += nbytes - reserved
+      self._queue.append((item, nbytes))
+      self._cond.notify_all()
+
+  def get(self):
+    """Returns (item, nbytes), or None once the spool is closed and drained."""
+    with self._cond:
+      while self._error is None and not self._queue and not self._closed:
+        self._cond.wait()
+
+      self._raise_if_aborted()
+      if self._queue:
+        return self._queue.popleft()
+
+      return None
+
+  def release(self, nbytes):
+    with self._cond:
+      self._bytes -= nbytes
+      self._chunks -= 1
+      self._cond.notify_all()
+
+  def close(self):
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+
+  def abort(self, error):
+    with self._cond:
+      if self._error is None:
+        self._error = error
+      self._cond.notify_all()
+
+  @property
+  def error(self):
+    return self._error
+
+  def _has_room(self, nbytes):
+    if self.max_chunks and self._chunks + 1 > self.max_chunks:
+      return False
+
+    if self.max_bytes and self._bytes + nbytes > self.max_bytes:
+      return False
+
+    return True
+
+  def _raise_if_aborted(self):
+    if self._error is not None:
+      raise SpoolAborted("spool aborted: {}".format(self._error))
+
+
+def read_full(stream, n):
+  """Reads n bytes from stream, or fewer only at its end."""
+  data = stream.read(n)
+  while data and len(data) < n:
+    more = stream.read(n - len(data))
+    if not more:
+      break
+    data += more
+
+  return data
+
+
+def chunk_name(file_prefix, index):
+  if index >= MAX_CHUNKS:
+    raise RuntimeError("output file suffixes exhausted after {} chunks, increase split_size".format(MAX_CHUNKS))
+
+  return "{}{:04d}".format(file_prefix, index)
+
+
+def split_stream(stream, split_size):
+  """Yields (chunk_index, data) pieces so that every chunk holds split_size bytes."""
+  index = 0
+  while True:
+    size = 0
+    while size < split_size:
+      data = stream.read(min(READ_SIZE, split_size - size))
+      if not data:
+        return
+
+      size += len(data)
+      yield index, data
+
+    index += 1
+
+
+def write_chunks(pieces, file_prefix, split_size, spool=None):
+  """
+  Writes (chunk_index, data) pieces into files named like split
+  --suffix-length=4 --numeric-suffixes would. Each chunk is hashed while it is
+  written to a .partial file and renamed once complete, and (path, size,
+  sha256) is yielded after the rename.
+  """
+  for index, chunk in groupby(pieces, key=itemgetter(0)):
+    if spool is not None:
+      spool.reserve(split_size)
+
+    path = chunk_name(file_prefix, index)
+    partial_path = path + ".partial"
+    size = 0
+    sha256 = hashlib.sha256()
+    with open(partial_path, "wb") as f:
+      for _, data in chunk:
+        f.write(data)
+        sha256.update(data)
+        size += len(data)
+
+      f.flush()
+      os.fsync(f.fileno())
+
+    os.rename(partial_path, path)
+
+    if spool is not None:
+      spool.put(path, split_size, size)
+
+    yield path, size, sha256.hexdigest()
+
+
+def read_chunks(pieces, name_prefix, split_size, spool):
+  """
+  Like write_chunks, but keeps every chunk in memory. (name, data) is put into
+  the spool, and (name, size, sha256) is yielded.
+  """
+  for index, chunk in groupby(pieces, key=itemgetter(0)):
+    spool.reserve(split_size)
+    name = chunk_name(name_prefix, index)
+    data = b"".join(data for _, data in chunk)
+    spool.put((name, data), split_size, len(data))
+
+    yield name, len(data), hashlib.sha256(data).hexdigest()
+
+
+def skip_chunks(stream, split_size, plaintext_sha256):
+  """
+  Reads and discards the chunks an interrupted export already sealed, checking
+  that the stream still produces the same bytes for them. Returns the number
+  of bytes read.
+  """
+  for index, expected in enumerate(plaintext_sha256):
+    sha256 = hashlib.sha256()
+    size = 0
+    while size < split_size:
+      data = stream.read(min(READ_SIZE, split_size - size))
+      if not data:
+        break
+
+      sha256.update(data)
+      size += len(data)
+
+    if size != split_size or sha256.hexdigest() != expected:
+      raise ResumeMismatch("chunk {} of the stream differs from the interrupted export".format(index))
+
+  return len(plaintext_sha256) * split_size
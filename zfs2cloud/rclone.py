@@ -0,0 +1,386 @@
+import atexit
+import base64
+import json
+import logging
+import os
+import secrets
+import shlex
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from .bwlimit import BandwidthGovernor, parse_rate, parse_timetable
+from .execution import CommandResult
+
+
+CLI = "cli"
+RCD = "rcd"
+
+
+def connect(command):
+  """Returns the rclone backend configured for command."""
+  if command.config.main["rclone_backend"] == RCD:
+    return RcloneRc(command)
+
+  return Rclone(command)
+
+
+def split_path(path):
+  """Splits remote:a/b into the fs remote:a and the file b, as the rc API wants them."""
+  head, sep, name = path.rpartition("/")
+  if not sep:
+    fs, colon, name = path.rpartition(":")
+    return fs + colon, name
+
+  return head or "/", name
+
+
+class Rclone(object):
+  """Builds rclone command lines from the config and runs them via a Command."""
+
+  def __init__(self, command):
+    self.command = command
+    self.config = command.config
+
+  @property
+  def env(self):
+    return dict(os.environ, RCLONE_CONFIG=self.config.main["rclone_conf"])
+
+  def build(self, subcommand, *args, transfer=True):
+    argv = [self.config.rclone_path]
+    argv.extend(shlex.split(self.config.main["rclone_global_flags"]))
+    argv.append(subcommand)
+    if transfer:
+      argv.extend(shlex.split(self.config.main["rclone_args"]))
+
+      # rclone follows a timetable on its own while the transfer runs.
+      rclone_bwlimit = self.config.main.get("rclone_bwlimit")
+      if rclone_bwlimit:
+        argv.extend(["--bwlimit", rclone_bwlimit])
+
+    argv.extend(args)
+    return argv
+
+  def run(self, subcommand, *args, transfer=True, input=None, capture=False, encoding="utf-8", dry_run=False):
+    # Transfers take as long as they take, anything else gets command_timeout.
+    timeout = None if transfer else self.config.command_timeout
+    return self.command._execute(
+      self.build(subcommand, *args, transfer=transfer),
+      env=self.env, input=input, capture=capture, encoding=encoding, timeout=timeout, dry_run=dry_run,
+    )
+
+  def sync(self, src, dst, filter_from=None, combined=None, dry_run=False):
+    """Syncs src to dst, only the files filter_from lets through if given, writing what happened to each file to combined."""
+    args = []
+    if filter_from is not None:
+      args.extend(["--filter-from", filter_from])
+
+    if combined is not None:
+      args.extend(["--combined", combined])
+
+    return self.run("sync", *args, src, dst, dry_run=dry_run)
+
+  def copy(self, src, dst, dry_run=False):
+    return self.run("copy", src, dst, dry_run=dry_run)
+
+  def copy_files(self, src, dst, files_from, dry_run=False):
+    """Copies the files of src listed in files_from without listing dst."""
+    return self.run("copy", "--files-from", files_from, "--no-traverse", src, dst, dry_run=dry_run)
+
+  def copyto(self, src, dst, dry_run=False):
+    return self.run("copyto", src, dst, dry_run=dry_run)
+
+  def delete_files(self, path, files_from, dry_run=False):
+    """Deletes the files of path listed in files_from."""
+    return self.run("delete", "--files-from", files_from, "--no-traverse", path, dry_run=dry_run)
+
+  def moveto(self, src, dst, dry_run=False):
+    return self.run("moveto", src, dst, dry_run=dry_run)
+
+  def rcat(self, dst, data, dry_run=False):
+    return self.run("rcat", "--size", str(len(data)), dst, input=data, dry_run=dry_run)
+
+  def touch(self, path, dry_run=False):
+    return self.run("touch", path, transfer=False, dry_run=dry_run)
+
+  def cat(self, path, offset=None, count=None):
+    """Returns the bytes of the file path, or count of them from offset on."""
+    args = []
+    if offset is not None:
+      args.extend(["--offset", str(offset), "--count", str(count)])
+
+    return self.run("cat", *args, path, transfer=False, capture=True, encoding=None).stdout
+
+  def list(self, path):
+    """Returns {name: size} of the files in the remote folder path."""
+    entries = json.loads(self.run("lsjson", "--files-only", path, transfer=False, capture=True).stdout)
+    return {entry["Name"]: entry["Size"] for entry in entries}
+
+  def hashes(self, path, hash_type):
+    """Returns {path: hash} of every file under path, the hash being empty where the remote has none."""
+    entries = json.loads(self.run("lsjson", "-R", "--files-only", "--hash", "--hash-type", hash_type, path, transfer=False, capture=True).stdout)
+    return {entry["Path"]: entry.get("Hashes", {}).get(hash_type, "") for entry in entries}
+
+
+class RcError(RuntimeError):
+  pass
+
+
+class RcClient(object):
+  """Calls the remote control API of an rclone rcd over HTTP."""
+
+  def __init__(self, url, user=None, password=None, timeout=60):
+    self.url = url.rstrip("/") + "/"
+    self.timeout = timeout
+    self._headers = {}
+    if user:
+      credentials = "{}:{}".format(user, password or "").encode("utf-8")
+      self._headers["Authorization"] = "Basic " + base64.b64encode(credentials).decode("ascii")
+
+  def call(self, method, **params):
+    data = json.dumps(params).encode("utf-8")
+    return self._post(method, data, "application/json")
+
+  def upload(self, fs, remote, data):
+    """Writes data to remote in fs with operations/uploadfile."""
+    boundary = secrets.token_hex(16)
+    body = b"".join([
+      "--{}\r\n".format(boundary).encode("ascii"),
+      'Content-Disposition: form-data; name="file0"; filename="{}"\r\n'.format(os.path.basename(remote)).encode("utf-8"),
+      b"Content-Type: application/octet-stream\r\n\r\n",
+      data,
+      "\r\n--{}--\r\n".format(boundary).encode("ascii"),
+    ])
+
+    query = urllib.parse.urlencode({"fs": fs, "remote": os.path.dirname(remote)})
+    return self._post("operations/uploadfile?" + query, body, "multipart/form-data; boundary=" + boundary)
+
+  def _post(self, path, data, content_type):
+    request = urllib.request.Request(self.url + path, data=data, headers=dict(self._headers, **{"Content-Type": content_type}))
+    try:
+      with urllib.request.urlopen(request, timeout=self.timeout) as response:
+        return json.loads(response.read() or b"{}")
+    except urllib.error.HTTPError as e:
+      body = e.read()
+      try:
+        message = json.loads(body)["error"]
+      except (ValueError, KeyError, TypeError):
+        message = body.decode("utf-8", "replace") or str(e)
+
+      raise RcError("{} failed: {}".format(path.split("?")[0], message)) from None
+
+
+class RcloneDaemon(object):
+  """
+  One rclone rcd shared by every command and dataset of a run. It is started
+  on first use and stopped when zfs2cloud exits, unless rclone_rc_url points
+  to one that is already running.
+  """
+
+  READY_TIMEOUT = 30
+
+  def __init__(self, config):
+    self.config = config
+    self.logger = logging.getLogger(self.__class__.__name__)
+    self.url = config.main["rclone_rc_url"] or None
+    self.user = config.main["rclone_rc_user"]
+    self.password = config.main["rclone_rc_pass"]
+
+    self.governor = None
+    if config.main["rclone_bwlimit"] or config.main["bwlimit_probe"]:
+      self.governor = BandwidthGovernor(
+        parse_timetable(config.main["rclone_bwlimit"]) if config.main["rclone_bwlimit"] else None,
+        probe=config.main["bwlimit_probe"] or None,
+        max_latency=config.main.getint("bwlimit_probe_max_ms") / 1000,
+        min_rate=parse_rate(config.main["bwlimit_min"]),
+      )
+
+    self._lock = threading.Lock()
+    self._proc = None
+
+  def client(self):
+    with self._lock:
+      if self.url is None:
+        self._start()
+
+    return RcClient(self.url, self.user, self.password)
+
+  def stop(self):
+    with self._lock:
+      if self._proc is None:
+        return
+
+      self._proc.terminate()
+      try:
+        self._proc.wait(timeout=10)
+      except subprocess.TimeoutExpired:
+        self._proc.kill()
+        self._proc.wait()
+
+      self._proc = None
+      self.url = None
+
+  def _start(self):
+    with socket.socket() as s:
+      s.bind(("127.0.0.1", 0))
+      port = s.getsockname()[1]
+
+    user, password = "zfs2cloud", secrets.token_urlsafe(16)
+    argv = [self.config.rclone_path]
+    argv.extend(shlex.split(self.config.main["rclone_global_flags"]))
+    argv.append("rcd")
+    argv.extend(shlex.split(self.config.main["rclone_args"]))
+    if self.config.main["rclone_bwlimit"]:
+      argv.append("--bwlimit={}".format(self.config.main["rclone_bwlimit"]))
+    argv.append("--rc-addr=127.0.0.1:{}".format(port))
+
+    self.logger.info("+ {}".format(shlex.join(argv)))
+    # The credentials go through the environment so they do not show up in ps.
+    env = dict(os.environ, RCLONE_CONFIG=self.config.main["rclone_conf"], RCLONE_RC_USER=user, RCLONE_RC_PASS=password)
+    self._proc = subprocess.Popen(argv, env=env)
+    atexit.register(self.stop)
+
+    url = "http://127.0.0.1:{}/".format(port)
+    client = RcClient(url, user, password, timeout=5)
+    deadline = time.monotonic() + self.READY_TIMEOUT
+    while True:
+      try:
+        client.call("rc/noop")
+        break
+      except (OSError, RcError):
+        if self._proc.poll() is not None:
+          raise RuntimeError("rclone rcd exited with {}".format(self._proc.returncode))
+
+        if time.monotonic() > deadline:
+          raise RuntimeError("rclone rcd did not answer within {} seconds".format(self.READY_TIMEOUT))
+
+        time.sleep(0.1)
+
+    self.url, self.user, self.password = url, user, password
+
+
+class RcloneRc(object):
+  """
+  Does what Rclone does through the remote control API of the rclone rcd of
+  the run, so the config is read and the remote authenticated only once.
+  """
+
+  POLL_SECONDS = 0.5
+  STATS_SECONDS = 60
+
+  def __init__(self, command):
+    self.command = command
+    self.config = command.config
+    self.client = self.config.rclone_daemon.client()
+    self.governor = self.config.rclone_daemon.governor
+
+  def sync(self, src, dst, filter_from=None, combined=None, dry_run=False):
+    """Syncs src to dst, only the files filter_from lets through if given."""
+    if combined is not None:
+      raise ValueError("the rc API cannot report on each file, sync with rclone_backend = cli to get combined")
+
+    params = {}
+    if filter_from is not None:
+      params["_filter"] = {"FilterFrom": [filter_from]}
+
+    return self._job("sync/sync", dry_run, srcFs=src, dstFs=dst, **params)
+
+  def copy(self, src, dst, dry_run=False):
+    return self._job("sync/copy", dry_run, srcFs=src, dstFs=dst)
+
+  def copy_files(self, src, dst, files_from, dry_run=False):
+    """Copies the files of src listed in files_from without listing dst."""
+    return self._job("sync/copy", dry_run, srcFs=src, dstFs=dst, _filter={"FilesFrom": [files_from]}, _config={"NoTraverse": True})
+
+  def copyto(self, src, dst, dry_run=False):
+    return self._file_job("operations/copyfile", src, dst, dry_run)
+
+  def delete_files(self, path, files_from, dry_run=False):
+    """Deletes the files of path listed in files_from."""
+    return self._job("operations/delete", dry_run, fs=path, _filter={"FilesFrom": [files_from]}, _config={"NoTraverse": True})
+
+  def moveto(self, src, dst, dry_run=False):
+    return self._file_job("operations/movefile", src, dst, dry_run)
+
+  def rcat(self, dst, data, dry_run=False):
+    return self._upload(dst, data, dry_run)
+
+  def touch(self, path, dry_run=False):
+    # The rc API has no touch, but the heartbeat file is empty anyway.
+    return self._upload(path, b"", dry_run)
+
+  def list(self, path):
+    """Returns {name: size} of the files in the remote folder path."""
+    entries = self._call("operations/list", fs=path, remote="", opt={"filesOnly": True})["list"]
+    return {entry["Name"]: entry["Size"] for entry in entries}
+
+  def hashes(self, path, hash_type):
+    """Returns {path: hash} of every file under path, the hash being empty where the remote has none."""
+    opt = {"recurse": True, "filesOnly": True, "showHash": True, "hashTypes": [hash_type]}
+    entries = self._call("operations/list", fs=path, remote="", opt=opt)["list"]
+    return {entry["Path"]: entry.get("Hashes", {}).get(hash_type, "") for entry in entries}
+
+  def _file_job(self, method, src, dst, dry_run):
+    src_fs, src_remote = split_path(src)
+    dst_fs, dst_remote = split_path(dst)
+    return self._job(method, dry_run, srcFs=src_fs, srcRemote=src_remote, dstFs=dst_fs, dstRemote=dst_remote)
+
+  def _upload(self, path, data, dry_run):
+    fs, remote = split_path(path)
+    self.command.logger.info("+ rc operations/uploadfile {} ({} bytes)".format(path, len(data)))
+    if dry_run:
+      return
+
+    self._timed(["rc", "operations/uploadfile", path], lambda: self.client.upload(fs, remote, data))
+
+  def _job(self, method, dry_run, **params):
+    """Runs method as an async job, logging its progress until it is done."""
+    self.command.logger.info("+ rc {} {}".format(method, " ".join("{}={}".format(k, v) for k, v in params.items())))
+    if dry_run:
+      return
+
+    def run():
+      jobid = self.client.call(method, _async=True, **params)["jobid"]
+      logged = time.monotonic()
+      while True:
+        status = self.client.call("job/status", jobid=jobid)
+        if status["finished"]:
+          if not status["success"]:
+            raise RcError("{} failed: {}".format(method, status["error"]))
+
+          return status
+
+        if self.governor is not None:
+          self.governor.tick(self.client)
+
+        if time.monotonic() - logged >= self.STATS_SECONDS:
+          stats = self.client.call("core/stats", group="job/{}".format(jobid))
+          self.command.logger.info("{}: {} of {} bytes, {} transfers, {} errors".format(
+            method, stats.get("bytes", 0), stats.get("totalBytes", "?"), stats.get("transfers", 0), stats.get("errors", 0),
+          ))
+          logged = time.monotonic()
+
+        time.sleep(self.POLL_SECONDS)
+
+    return self._timed(["rc", method] + list(params.values()), run)
+
+  def _call(self, method, **params):
+    return self._timed(["rc", method], lambda: self.client.call(method, **params))
+
+  def _timed(self, argv, f):
+    result = CommandResult(argv)
+    started = time.monotonic()
+    try:
+      value = f()
+      result.returncode = 0
+      return value
+    except BaseException:
+      result.returncode = 1
+      raise
+    finally:
+      result.wall_seconds = time.monotonic() - started
+      self.command._record(result)
@@ -1,7 +1,12 @@
 import os
 import getpass
+import hashlib
+import subprocess
 
+from . import compression, crypto, dedup
 from .command import Command
+from .manifest import Manifest
+from .pipeline import READ_SIZE
 
 
 class Restore(Command):
@@ -14,6 +19,7 @@ class Restore(Command):
   @classmethod
   def add_arguments(cls, parser):
     parser.add_argument("--zfs-fs", required=True, help="the name of the zfs filesystem to restore to")
+    parser.add_argument("--workers", type=int, default=0, help="number of processes decrypting natively encrypted backups (default: number of cpus)")
     parser.add_argument("backup_folders", nargs="+", help="The path to the backup folder. This should be to the folder containing the .zfs file, not its parent folder.")
 
   def run(self):
@@ -26,6 +32,90 @@ class Restore(Command):
     for folder in self.args.backup_folders:
       self.logger.info("+ cd {}".format(folder))
       with self.chdir(folder):
-        command = "bash -c \"set -o pipefail; cat * | pv | gpg --decrypt --batch --passphrase '{}' | zfs recv {}\"".format(passphrase, self.args.zfs_fs)
-        self.logger.info("+ {}".format(command.replace(passphrase, "*****")))
-        self._execute(command, log=False, dry_run=self.args.dry_run)
+        manifest = Manifest.load(".")
+        paths = sorted(fn for fn in os.listdir(".") if compression.file_extensions(fn) is not None)
+        if manifest is not None:
+          # Catches missing or truncated chunks before zfs recv starts.
+          manifest.verify_files(folder, paths)
+
+        if dedup.is_recipe(paths):
+          self._restore_dedup(passphrase, paths)
+          continue
+
+        decompress_command = compression.decompress_command(compression.detect(paths))
+        decompress_command = " | {}".format(decompress_command) if decompress_command else ""
+
+        if crypto.detect(paths) == crypto.NATIVE:
+          self._restore_native(passphrase, paths, decompress_command)
+        else:
+          self._restore_gpg(passphrase, paths, manifest, decompress_command)
+
+  def _restore_gpg(self, passphrase, paths, manifest, decompress_command):
+    size = " -s {}".format(manifest.size) if manifest is not None else ""
+    command = "set -o pipefail; pv{} | gpg --decrypt --batch --passphrase '{}'{} | zfs recv {}".format(size, passphrase, decompress_command, self.args.zfs_fs)
+    self.logger.info("+ cat {} chunks | {}".format(len(paths), command.replace(passphrase, "*****")))
+    if self.args.dry_run:
+      return
+
+    if manifest is not None:
+      # Every chunk is checked before zfs recv gets any of the stream.
+      self._verify_chunks(paths, manifest)
+
+    self._feed(command.replace(passphrase, "*****"), command, self._read_chunks(paths))
+
+  def _restore_native(self, passphrase, paths, decompress_command):
+    command = "set -o pipefail; cat{} | zfs recv {}".format(decompress_command, self.args.zfs_fs)
+    self.logger.info("+ decrypt {} chunks | {}".format(len(paths), command))
+    if self.args.dry_run:
+      return
+
+    # The chunks are authenticated as they are decrypted, so they are not hashed.
+    with crypto.ChunkCipher.for_chunk(passphrase, paths[0], workers=self.args.workers) as cipher:
+      self._feed(command, command, cipher.decrypt(paths))
+
+  def _restore_dedup(self, passphrase, paths):
+    command = "set -o pipefail; cat | zfs recv {}".format(self.args.zfs_fs)
+    self.logger.info("+ rebuild from {} recipe chunks | {}".format(len(paths), command))
+    if self.args.dry_run:
+      return
+
+    # Blocks may be stored in the packs of earlier backups, which have to be
+    # downloaded next to this one. The current directory is the backup folder.
+    basedir = os.path.abspath("..")
+    with crypto.ChunkCipher.for_chunk(passphrase, paths[0], workers=self.args.workers) as cipher:
+      self._feed(command, command, dedup.rebuild(cipher.decrypt(paths), basedir, passphrase))
+
+  def _verify_chunks(self, paths, manifest):
+    expected = {name: sha256 for name, _, sha256 in manifest.chunks}
+    for path in paths:
+      sha256 = hashlib.sha256()
+      for data in self._read_chunks([path]):
+        sha256.update(data)
+
+      if expected[path] != sha256.hexdigest():
+        raise ValueError("{} does not match the sha256 in the manifest".format(path))
+
+  def _read_chunks(self, paths):
+    for path in paths:
+      with open(path, "rb") as f:
+        while True:
+          data = f.read(READ_SIZE)
+          if not data:
+            break
+
+          yield data
+
+  def _feed(self, description, command, pieces):
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, shell=True, executable="/bin/bash")
+    try:
+      for data in pieces:
+        proc.stdin.write(data)
+    except BaseException:
+      proc.kill()
+      raise
+    finally:
+      proc.stdin.close()
+      proc.wait()
+
+    if proc.returncode != 0:
+      raise subprocess.CalledProcessError(proc.returncode, description)
@@ -0,0 +1,107 @@
+"""
+Reads the records of a zfs send stream. The layout follows dmu_replay_record_t
+in include/sys/zfs_ioctl.h of OpenZFS: every record is a 312 byte header,
+optionally followed by a payload whose length depends on the record type.
+"""
+import struct
+
+from .pipeline import READ_SIZE, read_full
+
+
+RECORD_SIZE = 312
+BACKUP_MAGIC = 0x2F5BACBAC
+
+BEGIN = 0
+OBJECT = 1
+FREEOBJECTS = 2
+WRITE = 3
+FREE = 4
+END = 5
+WRITE_BYREF = 6
+SPILL = 7
+WRITE_EMBEDDED = 8
+OBJECT_RANGE = 9
+REDACT = 10
+
+# Larger payloads mean the stream was not parsed correctly.
+MAX_PAYLOAD = 64 * 1024 * 1024
+
+
+def _round_up(n, alignment=8):
+  return (n + alignment - 1) // alignment * alignment
+
+
+def _field(order, fmt, header, offset):
+  return struct.unpack_from(order + fmt, header, offset)[0]
+
+
+def payload_size(order, header):
+  """Returns the payload length of the record, or None for unknown records."""
+  record_type = _field(order, "I", header, 0)
+
+  if record_type == BEGIN:
+    return _field(order, "I", header, 4)
+
+  if record_type == OBJECT:
+    raw_bonuslen = _field(order, "I", header, 36)
+    return raw_bonuslen or _round_up(_field(order, "I", header, 28))
+
+  if record_type == WRITE:
+    if header[50] != 0:  # drr_compressiontype
+      return _field(order, "Q", header, 96)
+
+    return _field(order, "Q", header, 32)
+
+  if record_type == SPILL:
+    return _field(order, "Q", header, 40) or _field(order, "Q", header, 16)
+
+  if record_type == WRITE_EMBEDDED:
+    return _round_up(_field(order, "I", header, 52))
+
+  if record_type in (FREEOBJECTS, FREE, END, WRITE_BYREF, OBJECT_RANGE, REDACT):
+    return 0
+
+  return None
+
+
+def _byte_order(header):
+  if len(header) == RECORD_SIZE:
+    for order in ("<", ">"):
+      if _field(order, "I", header, 0) == BEGIN and _field(order, "Q", header, 8) == BACKUP_MAGIC:
+        return order
+
+  return None
+
+
+def records(stream):
+  """
+  Yields (record_type, header, payload) for the records of the stream. Once
+  the stream stops looking like a zfs send stream, the rest of it is yielded
+  as (None, data, b"") pieces, so joining everything always gives back the
+  stream as it was read.
+  """
+  order = None
+  while True:
+    header = read_full(stream, RECORD_SIZE)
+    if not header:
+      return
+
+    order = _byte_order(header) or order
+    size = payload_size(order, header) if order is not None and len(header) == RECORD_SIZE else None
+    if size is None or size > MAX_PAYLOAD:
+      break
+
+    payload = read_full(stream, size) if size else b""
+    if len(payload) < size:
+      yield None, header + payload, b""
+      return
+
+    yield _field(order, "I", header, 0), header, payload
+
+  yield None, header, b""
+  while True:
+    data = stream.read(READ_SIZE)
+    if not data:
+      return
+
+    yield None, data, b""
@@ -0,0 +1,113 @@
+"""
+Splits the files of a snapshot into shards of about the same size that are
+uploaded at the same time, each by its own rclone limited to its subtrees by
+filter rules.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+import stat
+
+
+def scan(root, workers):
+  """
+  Returns {directory: (bytes, files)} of the regular files right in every
+  directory under root, as paths relative to it ("" being root). The
+  subdirectories of root are walked in parallel.
+  """
+  def walk(top):
+    totals = {}
+    for dirpath, _, filenames in os.walk(os.path.join(root, top)):
+      size = 0
+      files = 0
+      for filename in filenames:
+        st = os.lstat(os.path.join(dirpath, filename))
+        if stat.S_ISREG(st.st_mode):
+          size += st.st_size
+          files += 1
+
+      totals[os.path.relpath(dirpath, root)] = (size, files)
+
+    return totals
+
+  directories = {"": (0, 0)}
+  tops = []
+  with os.scandir(root) as entries:
+    for entry in entries:
+      if entry.is_dir(follow_symlinks=False):
+        tops.append(entry.name)
+      elif entry.is_file(follow_symlinks=False):
+        size, files = directories[""]
+        directories[""] = (size + entry.stat(follow_symlinks=False).st_size, files + 1)
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    for totals in executor.map(walk, tops):
+      directories.update(totals)
+
+  return directories
+
+
+def plan(directories, count):
+  """
+  Splits the tree scanned into directories into count shards, returning the
+  subtrees of each. A shard costs its share of the bytes plus its share of the
+  files, as many small files take as long as a few large ones. Subtrees
+  costing more than a shard are split into their subdirectories, the files
+  right in them going to the first shard, which also gets everything no other
+  shard covers.
+  """
+  subtrees = dict(directories)
+  children = {directory: [] for directory in directories}
+  for directory, (size, files) in directories.items():
+    if directory == "":
+      continue
+
+    parent = os.path.dirname(directory)
+    children[parent].append(directory)
+    while True:
+      subtree_size, subtree_files = subtrees[parent]
+      subtrees[parent] = (subtree_size + size, subtree_files + files)
+      if parent == "":
+        break
+
+      parent = os.path.dirname(parent)
+
+  total_size, total_files = subtrees[""]
+
+  def cost(size, files):
+    return size / max(total_size, 1) + files / max(total_files, 1)
+
+  target = cost(total_size, total_files) / count
+  units = list(children[""])
+  loose = cost(*directories[""])
+  while True:
+    splittable = [unit for unit in units if children[unit] and cost(*subtrees[unit]) > target]
+    if not splittable:
+      break
+
+    unit = max(splittable, key=lambda unit: cost(*subtrees[unit]))
+    units.remove(unit)
+    units.extend(children[unit])
+    loose += cost(*directories[unit])
+
+  shards = [[] for _ in range(count)]
+  loads = [loose] + [0] * (count - 1)
+  for unit in sorted(units, key=lambda unit: (-cost(*subtrees[unit]), unit)):
+    i = loads.index(min(loads))
+    shards[i].append(unit)
+    loads[i] += cost(*subtrees[unit])
+
+  return [sorted(shard) for shard in shards]
+
+
+def filter_rules(shards, i):
+  """The rclone filter rules limiting an upload to shard i of shards."""
+  if i > 0:
+    return ["+ /{}/**".format(_escape(unit)) for unit in shards[i]] + ["- **"]
+
+  # The first shard takes what the others leave.
+  return ["- /{}/**".format(_escape(unit)) for shard in shards[1:] for unit in shard] + ["+ **"]
+
+
+def _escape(path):
+  return re.sub(r"([\\*?\[\]{}])", r"\\\1", path)
@@ -1,21 +1,72 @@
 from datetime import datetime
+import os
+import time
 
 from .command import Command
+from .stages import record_stats
 
 
 class Snapshot(Command):
-  """Invokes zfs snapshot."""
+  """
+  Invokes zfs snapshot, for all datasets at once, between the presnapshot and
+  postsnapshot hooks.
+  """
+  per_dataset = False
 
   def run(self):
-    snapshot_id = datetime.now().strftime("%Y%m%d%H%M%S")
-    zfs_name = "{}@{}".format(self.config.main["zfs_fs"], snapshot_id)
+    now = datetime.now().replace(microsecond=0)
+    snapshot_id = now.strftime("%Y%m%d%H%M%S")
 
-    self._execute("{} snapshot {}".format(self.config.zfs_path, zfs_name), dry_run=self.args.dry_run)
+    # One zfs snapshot call takes all snapshots atomically.
+    if self.config.is_single_dataset():
+      zfs_names = ["{}@{}".format(self.config.main["zfs_fs"], snapshot_id)]
+      opts = []
+    else:
+      zfs_names = ["{}@{}".format(zfs_fs, snapshot_id) for zfs_fs in self.config.datasets]
+      opts = ["-r"] if self.config.main.getboolean("zfs_fs_recursive") else []
+
+    started = time.monotonic()
+    try:
+      self._run_hooks("presnapshot", self.config.presnapshot_hooks, zfs_names)
+      self._zfs("snapshot", *opts, *zfs_names, dry_run=self.args.dry_run)
+    finally:
+      # The application has to come back up whatever happened.
+      self._run_hooks("postsnapshot", self.config.postsnapshot_hooks, zfs_names)
+      downtime_ms = int((time.monotonic() - started) * 1000)
+
+    self.logger.info("took {} with {}ms from the start of the presnapshot hooks to the end of the postsnapshot hooks".format(" ".join(zfs_names), downtime_ms))
+
+    if not self.args.dry_run:
+      if self.config.is_single_dataset():
+        self.inventory.add(zfs_names[0], now)
+
+      record_stats(self.config.stats_file, "snapshot-downtime", snapshots=zfs_names, downtime_ms=downtime_ms)
+
+  def _run_hooks(self, kind, hooks, zfs_names):
+    """Runs the hooks in parallel and waits for all of them."""
+    if not hooks:
+      return
+
+    self.logger.info("running {} {} hooks in parallel".format(len(hooks), kind))
+    results = self._execute_all(
+      [[hook] for hook in hooks],
+      env=dict(os.environ, ZFS2CLOUD_SNAPSHOTS=" ".join(zfs_names)),
+      timeout=float(self.config.main["hook_timeout"]) if self.config.main["hook_timeout"] else None,
+      check=False,
+      dry_run=self.args.dry_run,
+    )
+
+    failed = ["{} ({})".format(result.argv[0], "timed out" if result.timed_out else result.returncode) for result in results if result.timed_out or result.returncode != 0]
+    if failed:
+      raise RuntimeError("{} hooks failed: {}".format(kind, ", ".join(failed)))
 
 
 class PruneSnapshots(Command):
   """Prunes zfs snapshots locally according to oldest_snapshot_days. Defaults to dry run mode."""
 
+  # Snapshots destroyed by a single zfs destroy.
+  BATCH_SIZE = 200
+
   @classmethod
   def add_arguments(cls, parser):
     parser.add_argument("-y", "--yes", action="store_true", default=False, help="actually delete the snapshot instead of just dry run")
@@ -28,20 +79,82 @@ class PruneSnapshots(Command):
     now = datetime.now()
     snapshots = self._discover_snapshots()
 
+    use_bookmarks = self.config.main.getboolean("use_bookmarks")
+    if use_bookmarks:
+      bases = self._backup_bases()
+      bookmarks = self._discover_bookmarks()
+      self._prune_bookmarks(now, bookmarks, bases, dry_run)
+      bookmark_names = set(name for name, _ in bookmarks)
+
     if len(snapshots) == 0:
       self.logger.info("no snapshots to prune")
       return
 
+    expired = []
     for snapshot, creation_time in snapshots:
       delta = (now - creation_time).total_seconds() / 86400
       if delta > self.config.main.getint("oldest_snapshot_days"):
-        self.logger.info("expiring {} as it is {:.2f} days old (threshold = {})".format(snapshot, delta, self.config.main.getint("oldest_snapshot_days")))
-        command = "zfs destroy {}".format(snapshot).strip()
-
-        # Extra caution...
-        if command == "zfs destroy {}".format(self.config.main["zfs_fs"]):
-          raise RuntimeError("Whoa what")
+        if use_bookmarks and snapshot in bases and self._bookmark_name(snapshot) not in bookmark_names:
+          self.logger.warning("keeping {} as the next export is based on it and it has no bookmark".format(snapshot))
+          continue
 
-        self._execute(command, dry_run=dry_run)
+        self.logger.info("expiring {} as it is {:.2f} days old (threshold = {})".format(snapshot, delta, self.config.main.getint("oldest_snapshot_days")))
+        expired.append(snapshot)
       else:
         self.logger.debug("ignoring {} as it is only {:.2f} days old".format(snapshot, delta))
+
+    # Oldest first, a batch at a time, each in a single transaction group.
+    expired.reverse()
+    for i in range(0, len(expired), self.BATCH_SIZE):
+      self._destroy_snapshots(expired[i:i + self.BATCH_SIZE], dry_run)
+
+  def _destroy_snapshots(self, snapshots, dry_run):
+    """Destroys snapshots of zfs_fs with one zfs destroy fs@a,b,c."""
+    prefix = self.config.main["zfs_fs"] + "@"
+    names = []
+    for snapshot in snapshots:
+      # Extra caution...
+      if not snapshot.startswith(prefix) or len(snapshot) == len(prefix) or "," in snapshot:
+        raise RuntimeError("Whoa what")
+
+      names.append(snapshot[len(prefix):])
+
+    target = prefix + ",".join(names)
+    if target == self.config.main["zfs_fs"]:
+      raise RuntimeError("Whoa what")
+
+    if not self.args.dry_run:
+      self.logger.info("destroying {} snapshots reclaims {} bytes".format(len(snapshots), self._reclaimed_bytes(prefix, names)))
+
+    self._zfs("destroy", target, dry_run=dry_run)
+    if not dry_run:
+      for snapshot in snapshots:
+        self.inventory.remove(snapshot)
+
+  def _reclaimed_bytes(self, prefix, names):
+    output = self._zfs("destroy", "-nvp", prefix + ",".join(names), capture=True, log=False).stdout
+    for line in output.strip().split("\n"):
+      fields = line.split("\t")
+      if fields[0] == "reclaim" and len(fields) == 2:
+        return int(fields[1])
+
+    raise RuntimeError("cannot find the reclaimed space in the output of zfs destroy -nvp: {}".format(output))
+
+  def _prune_bookmarks(self, now, bookmarks, bases, dry_run):
+    """Destroys bookmarks over oldest_snapshot_days old that no export is based on."""
+    for bookmark, creation_time in bookmarks:
+      delta = (now - creation_time).total_seconds() / 86400
+      if delta <= self.config.main.getint("oldest_snapshot_days"):
+        continue
+
+      if bookmark.replace("#", "@", 1) in bases:
+        self.logger.debug("keeping {} as an export is based on it".format(bookmark))
+        continue
+
+      if not bookmark.startswith(self.config.main["zfs_fs"] + "#"):
+        raise RuntimeError("Whoa what")
+
+      self.logger.info("expiring {} as it is {:.2f} days old (threshold = {})".format(bookmark, delta, self.config.main.getint("oldest_snapshot_days")))
+      self._zfs("destroy", bookmark, dry_run=dry_run)
+      if not dry_run:
+        self.inventory.remove(bookmark)
@@ -0,0 +1,255 @@
+from datetime import datetime
+import json
+import os
+import subprocess
+import threading
+import time
+
+from .pipeline import READ_SIZE
+
+
+class StageStats(object):
+  """
+  What a stage of a pipeline did. blocked_seconds is how long its output
+  waited on the next stage, i.e. the time it was blocked writing to a full
+  pipe, or for the last stage, the time its reader spent working instead of
+  reading. Bytes that could not be measured are None.
+  """
+
+  def __init__(self, name):
+    self.name = name
+    self.bytes_in = None
+    self.bytes_out = 0
+    self.wall_seconds = 0.0
+    self.cpu_seconds = None
+    self.blocked_seconds = 0.0
+
+  def to_dict(self):
+    return {
+      "name": self.name,
+      "bytes_in": self.bytes_in,
+      "bytes_out": self.bytes_out,
+      "wall_seconds": round(self.wall_seconds, 3),
+      "cpu_seconds": round(self.cpu_seconds, 3) if self.cpu_seconds is not None else None,
+      "blocked_seconds": round(self.blocked_seconds, 3),
+    }
+
+
+class _MeteredReader(object):
+  """Counts the bytes read from the last stage and the time spent outside of read()."""
+
+  def __init__(self, stream, stats, started):
+    self._stream = stream
+    self._stats = stats
+    self._started = started
+    self._returned = None
+
+  def read(self, n=-1):
+    now = time.monotonic()
+    if self._returned is not None:
+      self._stats.blocked_seconds += now - self._returned
+
+    data = self._stream.read(n)
+    self._stats.bytes_out += len(data)
+    self._returned = time.monotonic()
+    if not data and n != 0:
+      self._stats.wall_seconds = self._returned - self._started
+
+    return data
+
+  def close(self):
+    self._stream.close()
+
+
+class StagePipeline(object):
+  """
+  Runs shell commands as a pipeline like bash would, connected by OS pipes,
+  and measures every stage from the outside: its cpu time with wait4, the
+  bytes it wrote from /proc/<pid>/io and the time it was blocked writing to
+  the next stage by sampling /proc/<pid>/wchan. The output of the last stage
+  is read from stdout.
+
+  With relay, the data is instead moved between the stages in python, which
+  times every write exactly at the cost of copying every byte, for when the
+  sampled numbers are not enough.
+  """
+
+  # How often the stages are sampled, in seconds.
+  SAMPLE_INTERVAL = 0.1
+
+  def __init__(self, stages, relay=False):
+    # [(name, command)]
+    self.stages = stages
+    self.relay = relay
+    self.stats = [StageStats(name) for name, _ in stages]
+    self.returncode = None
+    self.stdout = None
+
+    self._procs = []
+    self._relays = []
+    self._sampler = None
+    self._done = threading.Event()
+    self._started = None
+
+  def start(self):
+    self._started = time.monotonic()
+    for i, (_, command) in enumerate(self.stages):
+      kwargs = {}
+      if i > 0:
+        kwargs["stdin"] = subprocess.PIPE if self.relay else self._procs[-1].stdout
+
+      self._procs.append(subprocess.Popen(command, stdout=subprocess.PIPE, shell=True, executable="/bin/bash", **kwargs))
+      if i > 0 and not self.relay:
+        # Only the stages hold the pipe between them, so that they see its
+        # end when the other side exits.
+        self._procs[-2].stdout.close()
+
+    if self.relay:
+      for i in range(len(self._procs) - 1):
+        relay = threading.Thread(target=self._relay, args=(i,), name="relay-{}".format(i))
+        relay.start()
+        self._relays.append(relay)
+    elif len(self._procs) > 1:
+      self._sampler = threading.Thread(target=self._sample, name="stage-sampler")
+      self._sampler.start()
+
+    self.stdout = _MeteredReader(self._procs[-1].stdout, self.stats[-1], self._started)
+    return self
+
+  def kill(self):
+    for proc in self._procs:
+      proc.kill()
+
+  def wait(self):
+    """Waits for every stage and sets returncode like set -o pipefail would."""
+    self.stdout.close()
+    for relay in self._relays:
+      relay.join()
+
+    # The sampler stops before any stage is reaped, so that it never looks at
+    # a pid that was reused.
+    self._done.set()
+    if self._sampler is not None:
+      self._sampler.join()
+
+    self.returncode = 0
+    for i, (proc, stats) in enumerate(zip(self._procs, self.stats)):
+      returncode, stats.cpu_seconds, written = self._reap(proc)
+      if not self.relay and i < len(self._procs) - 1:
+        # What a stage wrote into the pipe is what the next one got.
+        stats.bytes_out = self.stats[i + 1].bytes_in = written
+
+      if not stats.wall_seconds:
+        # It never finished its output, or exited between two samples.
+        stats.wall_seconds = time.monotonic() - self._started
+
+      if returncode != 0:
+        self.returncode = returncode
+
+    return self.returncode
+
+  def _sample(self):
+    last = time.monotonic()
+    while not self._done.wait(self.SAMPLE_INTERVAL):
+      now = time.monotonic()
+      for proc, stats in zip(self._procs[:-1], self.stats):
+        if stats.wall_seconds:
+          continue
+
+        state, wchan = _proc_state(proc.pid)
+        if state == "Z":
+          stats.wall_seconds = now - self._started
+        elif wchan is not None and "pipe_write" in wchan:
+          # Blocked writing to the next stage, which has not read what came
+          # before.
+          stats.blocked_seconds += now - last
+
+      last = now
+
+  def _relay(self, i):
+    src = self._procs[i].stdout
+    dst = self._procs[i + 1].stdin
+    stats = self.stats[i]
+    next_stats = self.stats[i + 1]
+    next_stats.bytes_in = 0
+    try:
+      while True:
+        data = src.read(READ_SIZE)
+        if not data:
+          stats.wall_seconds = time.monotonic() - self._started
+          break
+
+        started = time.monotonic()
+        dst.write(data)
+        stats.blocked_seconds += time.monotonic() - started
+        stats.bytes_out += len(data)
+        next_stats.bytes_in += len(data)
+    except (OSError, ValueError):
+      # The next stage exited or the pipeline was killed; its exit status
+      # tells what happened.
+      pass
+    finally:
+      src.close()
+      try:
+        dst.close()
+      except OSError:
+        pass
+
+  def _reap(self, proc):
+    """
+    Waits for proc, returning its exit status, the cpu time it used and the
+    bytes it wrote (None if /proc cannot tell).
+    """
+    written = None
+    if not self.relay:
+      # It stays a zombie until wait4, so its io counters can still be read.
+      os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+      written = _proc_io(proc.pid).get("wchar")
+
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, rusage.ru_utime + rusage.ru_stime, written
+
+
+def _proc_state(pid):
+  """Returns the state and wchan of pid, None for what /proc cannot tell."""
+  state = wchan = None
+  try:
+    with open("/proc/{}/stat".format(pid)) as f:
+      # The name in parentheses may contain spaces.
+      state = f.read().rsplit(")", 1)[1].split()[0]
+
+    with open("/proc/{}/wchan".format(pid)) as f:
+      wchan = f.read()
+  except (OSError, IndexError):
+    pass
+
+  return state, wchan
+
+
+def _proc_io(pid):
+  """Returns the io counters of pid as {name: value}, empty if /proc cannot tell."""
+  try:
+    with open("/proc/{}/io".format(pid)) as f:
+      return {name: int(value) for name, value in (line.split(": ") for line in f.read().splitlines())}
+  except (OSError, ValueError):
+    return {}
+
+
+def log_stats(logger, stats):
+  for s in stats:
+    logger.info("{: <10} in {: >14} out {: >14} wall {:8.1f}s cpu {: >9} blocked on next {:8.1f}s".format(
+      s.name,
+      "-" if s.bytes_in is None else s.bytes_in,
+      "-" if s.bytes_out is None else s.bytes_out,
+      s.wall_seconds,
+      "-" if s.cpu_seconds is None else "{:.1f}s".format(s.cpu_seconds),
+      s.blocked_seconds,
+    ))
+
+
+def record_stats(path, step, **record):
+  """Appends a line of json about step to the stats file."""
+  record = dict(record, step=step, time=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+  with open(path, "a") as f:
+    f.write(json.dumps(record, sort_keys=True) + "\n")